@@ -0,0 +1,237 @@
+"""
+In-memory stand-ins for the Firestore and Cloud Storage clients used by
+firestore_utils, so the whole pipeline can be benchmarked offline.
+
+Only the calls the service makes are implemented. An optional latency per
+call approximates network round-trips.
+"""
+import copy
+import threading
+import time
+
+
+class FakePreconditionFailed(Exception):
+    """Stands in for the 412 a generation precondition fails with"""
+
+
+class FakeSnapshot:
+    def __init__(self, reference: "FakeDocumentReference", data: dict):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> dict:
+        return copy.deepcopy(self._data)
+
+
+class FakeDocumentReference:
+    def __init__(self, store: "FakeFirestore", collection: str, doc_id: str):
+        self._store = store
+        self.collection = collection
+        self.id = doc_id
+
+    @property
+    def path(self) -> str:
+        return f"{self.collection}/{self.id}"
+
+    def get(self, **kwargs) -> FakeSnapshot:
+        self._store.pause()
+        return self._store.snapshot(self)
+
+    def update(self, data: dict, **kwargs) -> None:
+        self._store.pause()
+        self._store.apply(self.collection, self.id, data)
+
+
+class FakeCollection:
+    def __init__(self, store: "FakeFirestore", name: str):
+        self._store = store
+        self.name = name
+
+    def document(self, doc_id: str) -> FakeDocumentReference:
+        return FakeDocumentReference(self._store, self.name, doc_id)
+
+
+class FakeBatch:
+    def __init__(self, store: "FakeFirestore"):
+        self._store = store
+        self._writes = []
+
+    def update(self, ref: FakeDocumentReference, data: dict) -> None:
+        self._writes.append((ref.collection, ref.id, data))
+
+    def commit(self, **kwargs) -> None:
+        self._store.pause()
+        for collection, doc_id, data in self._writes:
+            self._store.apply(collection, doc_id, data)
+
+
+class FakeFirestore:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+        self._docs = {}
+        self._lock = threading.Lock()
+
+    def pause(self) -> None:
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def set(self, collection: str, doc_id: str, data: dict) -> None:
+        with self._lock:
+            self._docs[(collection, doc_id)] = copy.deepcopy(data)
+
+    def snapshot(self, ref: FakeDocumentReference) -> FakeSnapshot:
+        with self._lock:
+            return FakeSnapshot(ref, self._docs.get((ref.collection, ref.id)))
+
+    def apply(self, collection: str, doc_id: str, data: dict) -> None:
+        with self._lock:
+            if (collection, doc_id) not in self._docs:
+                raise KeyError(f"No document to update: {collection}/{doc_id}")
+            self._docs[(collection, doc_id)].update(data)
+
+    def collection(self, name: str) -> FakeCollection:
+        return FakeCollection(self, name)
+
+    def get_all(self, refs, **kwargs):
+        self.pause()
+        return [self.snapshot(ref) for ref in refs]
+
+    def batch(self) -> FakeBatch:
+        return FakeBatch(self)
+
+
+class FakeBlob:
+    def __init__(self, bucket: "FakeBucket", name: str):
+        self.bucket = bucket
+        self.name = name
+        self.content_disposition = None
+        self.cache_control = None
+        self.content_type = None
+
+    @property
+    def _stored(self):
+        return self.bucket.objects.get(self.name)
+
+    @property
+    def generation(self):
+        stored = self._stored
+        return stored["generation"] if stored else None
+
+    @property
+    def size(self):
+        stored = self._stored
+        return len(stored["data"]) if stored else None
+
+    @property
+    def public_url(self) -> str:
+        return f"https://storage.googleapis.com/{self.bucket.name}/{self.name}"
+
+    def exists(self, **kwargs) -> bool:
+        self.bucket.client.pause()
+        return self._stored is not None
+
+    def download_as_bytes(self, **kwargs) -> bytes:
+        self.bucket.client.pause()
+        stored = self._stored
+        if stored is None:
+            raise FileNotFoundError(self.name)
+        return stored["data"]
+
+    def download_to_filename(self, path: str, **kwargs) -> None:
+        with open(path, "wb") as f:
+            f.write(self.download_as_bytes())
+
+    def upload_from_string(self, data, content_type: str = None, **kwargs) -> None:
+        self.bucket.client.pause()
+        if isinstance(data, str):
+            data = data.encode()
+        self.bucket.store(self.name, bytes(data), content_type)
+
+    def upload_from_filename(self, path: str, content_type: str = None, **kwargs) -> None:
+        with open(path, "rb") as f:
+            self.upload_from_string(f.read(), content_type)
+
+    def delete(self, **kwargs) -> None:
+        self.bucket.client.pause()
+        if self.bucket.objects.pop(self.name, None) is None:
+            raise FileNotFoundError(self.name)
+
+    def patch(self, **kwargs) -> None:
+        self.bucket.client.pause()
+
+    def make_public(self, **kwargs) -> None:
+        self.bucket.client.pause()
+
+    def generate_signed_url(self, **kwargs) -> str:
+        return self.public_url + "?X-Goog-Signature=fake"
+
+
+class FakeIamConfiguration:
+    uniform_bucket_level_access_enabled = False
+
+
+class FakeBucket:
+    def __init__(self, client: "FakeStorageClient", name: str):
+        self.client = client
+        self.name = name
+        self.objects = {}
+        self.iam_configuration = FakeIamConfiguration()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def store(self, name: str, data: bytes, content_type: str = None) -> None:
+        with self._lock:
+            self._generation += 1
+            self.objects[name] = {
+                "data": data,
+                "content_type": content_type,
+                "generation": self._generation,
+            }
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
+
+    def get_blob(self, name: str, **kwargs):
+        self.client.pause()
+        return FakeBlob(self, name) if name in self.objects else None
+
+    def list_blobs(self, prefix: str = "", **kwargs):
+        self.client.pause()
+        return [FakeBlob(self, name) for name in list(self.objects) if name.startswith(prefix)]
+
+    def copy_blob(self, blob: FakeBlob, destination_bucket: "FakeBucket", new_name: str,
+                  if_source_generation_match=None, **kwargs) -> FakeBlob:
+        self.client.pause()
+        stored = self.objects[blob.name]
+        if if_source_generation_match is not None and stored["generation"] != if_source_generation_match:
+            raise FakePreconditionFailed(f"{blob.name} is no longer generation {if_source_generation_match}")
+        destination_bucket.store(new_name, stored["data"], stored["content_type"])
+        return FakeBlob(destination_bucket, new_name)
+
+
+class FakeStorageClient:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def pause(self) -> None:
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def bucket(self, name: str) -> FakeBucket:
+        with self._lock:
+            if name not in self._buckets:
+                self._buckets[name] = FakeBucket(self, name)
+            return self._buckets[name]
@@ -0,0 +1,284 @@
+"""
+Offline benchmarks for the document generation path.
+
+Generates synthetic templates over a matrix of sizes and measures each stage
+(placeholder extraction, template compile, fill with each engine, PDF
+conversion) and the whole pipeline against in-memory Firestore and Cloud
+Storage fakes.
+
+Usage (from cloud-run/):
+    python benchmarks/run_benchmarks.py --quick --output results.json
+    python benchmarks/run_benchmarks.py --fake-convert --iterations 10
+    python benchmarks/run_benchmarks.py --compare baseline.json --output results.json
+
+Results are written as JSON; --compare prints the p50 change per stage
+against an earlier results file.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+CLOUD_RUN_DIR = Path(__file__).resolve().parent.parent
+REPO_DIR = CLOUD_RUN_DIR.parent
+sys.path.insert(0, str(CLOUD_RUN_DIR))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import fakes
+import synthetic_templates
+
+OUTPUT_BUCKET = "benchmark-output"
+TEMPLATE_BUCKET = "benchmark-templates"
+
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def peak_rss_kb(who=resource.RUSAGE_SELF) -> int:
+    return resource.getrusage(who).ru_maxrss
+
+
+def measure(fn, iterations: int, warmup: int = 1) -> dict:
+    """Runs fn repeatedly and summarises its latency, throughput and peak RSS"""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - started
+    return {
+        "iterations": iterations,
+        "throughput_per_s": round(iterations / elapsed, 3) if elapsed else None,
+        "mean_ms": round(1000 * sum(samples) / len(samples), 3),
+        "p50_ms": round(1000 * percentile(samples, 0.50), 3),
+        "p90_ms": round(1000 * percentile(samples, 0.90), 3),
+        "p99_ms": round(1000 * percentile(samples, 0.99), 3),
+        "max_ms": round(1000 * max(samples), 3),
+        "peak_rss_kb": peak_rss_kb(),
+        "children_peak_rss_kb": peak_rss_kb(resource.RUSAGE_CHILDREN),
+    }
+
+
+def load_extractor():
+    """Loads the Cloud Function's streaming placeholder extractor"""
+    path = REPO_DIR / "functions" / "python" / "placeholder_extractor.py"
+    try:
+        spec = importlib.util.spec_from_file_location("placeholder_extractor", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module.extract
+    except Exception as e:
+        print(f"Skipping extraction benchmark: {e}")
+        return None
+
+
+def install_fakes(latency: float):
+    """Imports firestore_utils with the Firestore and Storage clients swapped for fakes"""
+    import google.auth
+    from google.auth.credentials import AnonymousCredentials
+
+    os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "benchmark")
+    os.environ["OUTPUT_BUCKET"] = OUTPUT_BUCKET
+    google.auth.default = lambda *args, **kwargs: (AnonymousCredentials(), "benchmark")
+
+    import firestore_utils
+    firestore_utils.db = fakes.FakeFirestore(latency)
+    firestore_utils.storage_client = fakes.FakeStorageClient(latency)
+    return firestore_utils
+
+
+def fake_convert(docx_path: str, filter_data: dict = None) -> str:
+    """Stands in for LibreOffice so the rest of the pipeline can be measured alone"""
+    pdf_path = os.path.splitext(docx_path)[0] + ".pdf"
+    shutil.copyfile(docx_path, pdf_path)
+    return pdf_path
+
+
+def run_scenario(scenario, args, extractor, firestore_utils, workdir: str) -> dict:
+    import incremental
+    import libreoffice_utils
+    import pipeline
+    import render_cache
+    import template_cache
+
+    content = synthetic_templates.build_template(scenario)
+    form_data = synthetic_templates.form_data_for(scenario)
+    template_path = os.path.join(workdir, f"{scenario.name}.docx")
+    with open(template_path, "wb") as f:
+        f.write(content)
+
+    result = {"scenario": scenario.to_dict(), "template_bytes": len(content), "stages": {}}
+    stages = result["stages"]
+    print(f"\n== {scenario.name} ({len(content) // 1024} KiB)")
+
+    if extractor:
+        stages["extract"] = measure(lambda: extractor(template_path), args.iterations)
+
+    stages["compile"] = measure(
+        lambda: template_cache.compile_template(scenario.name, "1", content), args.iterations
+    )
+    compiled = template_cache.compile_template(scenario.name, "1", content)
+    stages["fill"] = measure(lambda: libreoffice_utils.render_docx(compiled, form_data), args.iterations)
+    stages["fill_ooxml"] = measure(
+        lambda: libreoffice_utils.render_docx(compiled, form_data, "ooxml"), args.iterations
+    )
+    stages["fill_unindexed"] = measure(
+        lambda: libreoffice_utils.render_docx(template_path, form_data), args.iterations
+    )
+
+    if args.fake_convert:
+        libreoffice_utils.convert_to_pdf = fake_convert
+    elif shutil.which("libreoffice") or shutil.which("soffice"):
+        with libreoffice_utils.job_workspace() as workspace:
+            file_name, filled = libreoffice_utils.render_docx(compiled, form_data)
+            filled_path = os.path.join(workspace, file_name)
+            with open(filled_path, "wb") as f:
+                f.write(filled)
+            stages["convert"] = measure(
+                lambda: libreoffice_utils.convert_to_pdf(filled_path), args.convert_iterations
+            )
+    else:
+        print("Skipping conversion and pipeline: LibreOffice not found (use --fake-convert)")
+        return result
+
+    # Whole pipeline against the fakes, with a warm and a cold template cache,
+    # regenerations served from the render cache and ones that reuse or
+    # patch the form's last files
+    db = firestore_utils.db
+    firestore_utils.storage_client.bucket(TEMPLATE_BUCKET).store(f"templates/{scenario.name}.docx", content)
+    db.set("templates", scenario.name, {
+        "downloadURL": f"https://firebasestorage.googleapis.com/v0/b/{TEMPLATE_BUCKET}/o/{scenario.name}",
+        "storagePath": f"templates/{scenario.name}.docx",
+    })
+    db.set("forms", scenario.name, {
+        "templateId": scenario.name,
+        "officeId": "benchmark-office",
+        "formData": form_data,
+    })
+    counter = {"job": 0}
+
+    def run_job(cold: bool, formats: tuple = None):
+        if cold:
+            template_cache._cache = template_cache.TemplateCache()
+        counter["job"] += 1
+        job_id = f"{scenario.name}-{counter['job']}"
+        db.set("document_jobs", job_id, {"formId": scenario.name})
+        pipeline.process_job(job_id, scenario.name, formats=formats)
+
+    def edit_one_field():
+        form = db.collection("forms").document(scenario.name).get().to_dict()
+        first = synthetic_templates.placeholder_names(1)[0]
+        form["formData"][first] = {"value": f"Edited value {counter['job']}"}
+        db.set("forms", scenario.name, form)
+
+    iterations = args.convert_iterations if not args.fake_convert else args.iterations
+    # The same form is rendered every time, so keep the render cache and
+    # incremental rendering out of the warm and cold runs and measure
+    # repeats on their own
+    render_cache.RENDER_CACHE = False
+    incremental.INCREMENTAL_RENDER = False
+    stages["pipeline_warm"] = measure(lambda: run_job(False), iterations)
+    stages["pipeline_cold"] = measure(lambda: run_job(True), iterations)
+    render_cache.RENDER_CACHE = True
+    stages["pipeline_repeat"] = measure(lambda: run_job(False), iterations)
+    render_cache.RENDER_CACHE = False
+    incremental.INCREMENTAL_RENDER = True
+    run_job(False)
+    stages["pipeline_unchanged"] = measure(lambda: run_job(False), iterations)
+    stages["pipeline_patch_docx"] = measure(
+        lambda: (edit_one_field(), run_job(False, ("docx",))), iterations
+    )
+    render_cache.RENDER_CACHE = True
+    return result
+
+
+def environment() -> dict:
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        revision = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "git_revision": revision,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+
+
+def compare(previous: dict, current: dict) -> None:
+    old = {r["scenario"]["name"]: r["stages"] for r in previous["results"]}
+    print(f"\n{'scenario':45} {'stage':20} {'old p50':>10} {'new p50':>10} {'change':>8}")
+    for result in current["results"]:
+        name = result["scenario"]["name"]
+        for stage, stats in result["stages"].items():
+            before = old.get(name, {}).get(stage)
+            if not before:
+                continue
+            change = (stats["p50_ms"] - before["p50_ms"]) / before["p50_ms"] * 100 if before["p50_ms"] else 0
+            print(f"{name:45} {stage:20} {before['p50_ms']:10.2f} {stats['p50_ms']:10.2f} {change:+7.1f}%")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="Run a reduced scenario matrix")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--convert-iterations", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Simulated seconds per Firestore/GCS call")
+    parser.add_argument("--fake-convert", action="store_true",
+                        help="Replace LibreOffice with a file copy")
+    parser.add_argument("--only", help="Run only scenarios whose name contains this text")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    args = parser.parse_args()
+
+    firestore_utils = install_fakes(args.latency)
+    extractor = load_extractor()
+    scenarios = [
+        s for s in synthetic_templates.build_matrix(args.quick)
+        if not args.only or args.only in s.name
+    ]
+
+    workdir = tempfile.mkdtemp(prefix="docgen-bench-")
+    try:
+        results = [run_scenario(s, args, extractor, firestore_utils, workdir) for s in scenarios]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {"environment": environment(), "arguments": vars(args), "results": results}
+    for result in results:
+        for stage, stats in result["stages"].items():
+            print(f"{result['scenario']['name']:45} {stage:20} p50 {stats['p50_ms']:9.2f} ms"
+                  f"  p99 {stats['p99_ms']:9.2f} ms  {stats['throughput_per_s']:8.2f}/s"
+                  f"  rss {stats['peak_rss_kb'] // 1024} MiB")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Synthetic .docx templates for the generation benchmarks.
+
+Templates are built with python-docx from a Scenario describing how many
+paragraphs, tables, placeholders and images they hold and how many of the
+placeholders are split across runs, the way Word often saves them.
+"""
+import io
+import random
+import struct
+import zlib
+
+from docx import Document
+from docx.shared import Inches
+
+
+class Scenario:
+    def __init__(self, name: str, paragraphs: int, tables: int, placeholders: int,
+                 split_ratio: float = 0.0, images: int = 0):
+        self.name = name
+        self.paragraphs = paragraphs
+        self.tables = tables
+        self.placeholders = placeholders
+        self.split_ratio = split_ratio
+        self.images = images
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "paragraphs": self.paragraphs,
+            "tables": self.tables,
+            "placeholders": self.placeholders,
+            "split_ratio": self.split_ratio,
+            "images": self.images,
+        }
+
+
+def build_matrix(quick: bool = False) -> list:
+    """Returns the benchmark scenarios, a reduced set when quick is True"""
+    if quick:
+        return [
+            Scenario("small", 50, 2, 10),
+            Scenario("medium-split", 500, 10, 100, split_ratio=0.5),
+        ]
+
+    scenarios = []
+    for paragraphs, tables, placeholders in ((50, 2, 10), (500, 10, 100), (2000, 50, 500)):
+        for split_ratio in (0.0, 0.5):
+            for images in (0, 5):
+                name = f"p{paragraphs}-t{tables}-ph{placeholders}-split{int(split_ratio * 100)}-img{images}"
+                scenarios.append(Scenario(name, paragraphs, tables, placeholders, split_ratio, images))
+    return scenarios
+
+
+def placeholder_names(count: int) -> list:
+    return [f"field_{i}" for i in range(count)]
+
+
+def form_data_for(scenario: Scenario) -> dict:
+    """Form data shaped like the one saved by the form modals"""
+    return {
+        name: {"value": f"Value for {name} " * 3}
+        for name in placeholder_names(scenario.placeholders)
+    }
+
+
+def noise_png(width: int = 600, height: int = 400, seed: int = 0) -> bytes:
+    """Builds an incompressible RGB PNG so images weigh what real photos do"""
+    rng = random.Random(seed)
+    raw = b"".join(
+        b"\x00" + rng.randbytes(width * 3)
+        for _ in range(height)
+    )
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return (struct.pack(">I", len(data)) + kind + data
+                + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(raw, 6)) + chunk(b"IEND", b""))
+
+
+def build_template(scenario: Scenario, seed: int = 42) -> bytes:
+    """Generates the template for a scenario and returns the .docx bytes"""
+    rng = random.Random(seed)
+    names = placeholder_names(scenario.placeholders)
+    document = Document()
+
+    section = document.sections[0]
+    section.header.paragraphs[0].text = "Header {{" + names[0] + "}}" if names else "Header"
+    section.footer.paragraphs[0].text = "Page footer"
+
+    # Spread the placeholders evenly over paragraphs and table cells
+    slots = scenario.paragraphs + scenario.tables * 4
+    per_slot = {}
+    for i, name in enumerate(names):
+        per_slot.setdefault(i * slots // max(len(names), 1), []).append(name)
+
+    def add_text(paragraph, slot):
+        paragraph.add_run(f"Clause {slot}. " + "Lorem ipsum dolor sit amet. " * rng.randint(1, 4))
+        for name in per_slot.get(slot, []):
+            if rng.random() < scenario.split_ratio:
+                # Split the placeholder over three runs with different formatting
+                paragraph.add_run("{{" + name[:3])
+                paragraph.add_run(name[3:]).bold = True
+                paragraph.add_run("}} ")
+            else:
+                paragraph.add_run("{{" + name + "}} ")
+
+    slot = 0
+    images_left = scenario.images
+    image_every = max(scenario.paragraphs // (scenario.images + 1), 1)
+    for i in range(scenario.paragraphs):
+        add_text(document.add_paragraph(), slot)
+        slot += 1
+        if images_left and i % image_every == image_every - 1:
+            document.add_picture(io.BytesIO(noise_png(seed=images_left)), width=Inches(4))
+            images_left -= 1
+
+    for _ in range(scenario.tables):
+        table = document.add_table(rows=2, cols=2)
+        for cell in table._cells:
+            add_text(cell.paragraphs[0], slot)
+            slot += 1
+
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
@@ -0,0 +1,81 @@
+import math
+import os
+
+# Memory kept for the Flask process, its threads and in-flight buffers
+RESERVED_MEMORY_MB = int(os.getenv("RESERVED_MEMORY_MB", "512"))
+# Peak resident memory of one soffice worker converting a large document
+LIBREOFFICE_WORKER_MEMORY_MB = int(os.getenv("LIBREOFFICE_WORKER_MEMORY_MB", "512"))
+# Peak resident memory of one fill process
+FILL_PROCESS_MEMORY_MB = int(os.getenv("FILL_PROCESS_MEMORY_MB", "200"))
+
+
+def _read(path: str) -> str:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def available_cpus() -> int:
+    """CPUs this container may use: affinity mask capped by the cgroup quota"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    # cgroup v2 "quota period", then cgroup v1
+    quota, _, period = _read("/sys/fs/cgroup/cpu.max").partition(" ")
+    if not quota:
+        quota = _read("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+        period = _read("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota and quota not in ("max", "-1") and period:
+        cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    return max(1, cpus)
+
+
+def available_memory_mb() -> int:
+    """Memory limit of this container, or the machine's memory when unlimited"""
+    limit = _read("/sys/fs/cgroup/memory.max") or _read("/sys/fs/cgroup/memory/memory.limit_in_bytes")
+    total = 0
+    for line in _read("/proc/meminfo").splitlines():
+        if line.startswith("MemTotal:"):
+            total = int(line.split()[1]) // 1024
+            break
+    if limit.isdigit():
+        limited = int(limit) // (1024 * 1024)
+        # Unlimited cgroups v1 report a huge number rather than "max"
+        if not total or limited < total:
+            return limited
+    return total or 2048
+
+
+def size_from_env(name: str, automatic: int) -> int:
+    """Reads a worker count from the environment; "auto" or unset uses automatic"""
+    value = os.getenv(name, "auto").strip().lower()
+    if value in ("", "auto"):
+        return automatic
+    return max(0, int(value))
+
+
+def libreoffice_workers() -> int:
+    """One soffice per CPU, as many as fit in memory next to the fill processes"""
+    budget = available_memory_mb() - RESERVED_MEMORY_MB - fill_processes() * FILL_PROCESS_MEMORY_MB
+    return max(1, min(available_cpus(), budget // LIBREOFFICE_WORKER_MEMORY_MB))
+
+
+def fill_processes() -> int:
+    """Processes for filling templates; 0 fills in the request thread"""
+    cpus = available_cpus()
+    # A single CPU gains nothing from a separate process
+    return size_from_env("FILL_PROCESSES", cpus if cpus > 1 else 0)
+
+
+def job_memory_mb(libreoffice_workers: int, fill_processes: int) -> int:
+    """Memory left for jobs in the web process once the workers have theirs"""
+    budget = (
+        available_memory_mb() - RESERVED_MEMORY_MB
+        - libreoffice_workers * LIBREOFFICE_WORKER_MEMORY_MB
+        - fill_processes * FILL_PROCESS_MEMORY_MB
+    )
+    return max(256, budget)
@@ -0,0 +1,29 @@
+"""
+Template filling run in the fill process pool (see libreoffice_utils).
+
+Kept free of the service's clients so worker processes start quickly and
+hold only what filling needs.
+"""
+import io
+
+from docx import Document
+
+import ooxml_fill
+import placeholder_engine
+
+
+def render(content: bytes, index: dict, form_data: dict, engine: str) -> tuple[bytes, int]:
+    """
+    Fills template bytes with form data.
+
+    Returns:
+        Tuple of (docx_bytes, placeholders_replaced)
+    """
+    buffer = io.BytesIO()
+    if engine == "ooxml":
+        replaced = ooxml_fill.fill_package(io.BytesIO(content), buffer, form_data, index)
+    else:
+        document = Document(io.BytesIO(content))
+        replaced = placeholder_engine.fill_document(document, form_data, index)
+        document.save(buffer)
+    return buffer.getvalue(), replaced
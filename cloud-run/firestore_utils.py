@@ -2,23 +2,116 @@ import os
 import json
 from google.cloud import firestore, storage
 from google.auth import default
+import google.auth.transport.requests
 from google.oauth2 import service_account
-from tempfile import NamedTemporaryFile
 import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import timedelta
 from pathlib import Path
-
-# Initialize Firebase clients
-credentials, project_id = default()
-db = firestore.Client(project=project_id, credentials=credentials)
-storage_client = storage.Client(credentials=credentials)
+from concurrent.futures import Future, ThreadPoolExecutor
+import metrics
+import resilience
+import template_cache
 
 logger = logging.getLogger(__name__)
 
+# Firebase clients are created on first use, or ahead of the first job by
+# startup.warm_up, so importing this module never waits on credentials
+db = None
+storage_client = None
+_clients_lock = threading.Lock()
+
+# Signed URLs end up stored on forms, so one is reused only during this
+# first fraction of its lifetime and a stored link stays valid for the rest
+SIGNED_URL_REUSE_FRACTION = float(os.getenv("SIGNED_URL_REUSE_FRACTION", "0.1"))
+SIGNED_URL_CACHE_SIZE = int(os.getenv("SIGNED_URL_CACHE_SIZE", "10000"))
+
+_signing_credentials = None
+_signing_credentials_loaded = False
+_signing_lock = threading.Lock()
+# (blob_path, expiration_hours) -> (url, reusable_until)
+_signed_urls = OrderedDict()
+_signed_urls_lock = threading.Lock()
+
+# Form field holding what the last generation used and produced (see incremental)
+RENDER_STATE_FIELD = "renderState"
+
+# Fetches of a template that keeps being evicted before it can be leased
+TEMPLATE_LEASE_ATTEMPTS = 3
+
+# Intermediate job statuses are written at most this often; the final one
+# always goes out together with the form's URLs
+JOB_STATUS_INTERVAL_SECONDS = float(os.getenv("JOB_STATUS_INTERVAL_SECONDS", "5"))
+
+# Shared pool for concurrent uploads of a job's artifacts
+_upload_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("UPLOAD_THREADS", "8")),
+    thread_name_prefix="upload"
+)
+
+def init_clients() -> None:
+    """
+    Looks up the default credentials once and builds the Firestore and
+    Storage clients side by side, fetching the first access token meanwhile.
+    """
+    global db, storage_client
+    with _clients_lock:
+        if db is not None and storage_client is not None:
+            return
+        with metrics.stage("init_clients"):
+            credentials, project_id = default()
+            with ThreadPoolExecutor(max_workers=3, thread_name_prefix="init-clients") as pool:
+                firestore_future = pool.submit(firestore.Client, project=project_id, credentials=credentials)
+                storage_future = pool.submit(storage.Client, credentials=credentials)
+                pool.submit(_refresh_credentials, credentials)
+                if db is None:
+                    db = firestore_future.result()
+                if storage_client is None:
+                    storage_client = storage_future.result()
+
+def _refresh_credentials(credentials) -> None:
+    # Best effort: the clients refresh the token themselves when this fails
+    try:
+        if not credentials.valid:
+            credentials.refresh(google.auth.transport.requests.Request())
+    except Exception as e:
+        logger.warning(f"Could not prefetch access token: {str(e)}")
+
+def get_db() -> firestore.Client:
+    if db is None:
+        init_clients()
+    return db
+
+def get_storage_client() -> storage.Client:
+    if storage_client is None:
+        init_clients()
+    return storage_client
+
+def _firestore_call(fn, *args, stage: str, **kwargs):
+    return resilience.call(fn, *args, stage=stage, timeout=resilience.FIRESTORE_TIMEOUT_SECONDS, **kwargs)
+
+def _storage_call(fn, *args, stage: str, **kwargs):
+    return resilience.call(fn, *args, stage=stage, timeout=resilience.STORAGE_TIMEOUT_SECONDS, **kwargs)
+
+def _get_all(db, refs: list, timeout: float = None) -> list:
+    # get_all streams; read it whole so a retry starts over
+    return list(db.get_all(refs, timeout=timeout))
+
+def _commit(db, writes: list, timeout: float = None) -> None:
+    """Commits (reference, update) pairs as one batch, built afresh for every attempt"""
+    batch = db.batch()
+    for ref, update in writes:
+        batch.update(ref, update)
+    batch.commit(timeout=timeout)
+
 def fetch_form_data(form_id: str) -> dict:
     try:
-        doc_ref = db.collection("forms").document(form_id)
-        doc = doc_ref.get()
+        doc_ref = get_db().collection("forms").document(form_id)
+        with metrics.stage("fetch_form"):
+            doc = _firestore_call(doc_ref.get, stage="fetch_form")
         if not doc.exists:
             print(f"Form {form_id} not found")
             return None
@@ -27,41 +120,181 @@ def fetch_form_data(form_id: str) -> dict:
         print(f"Error fetching form data: {str(e)}")
         raise
 
-def download_template(form_data: dict) -> str:
+def fetch_forms(form_ids: list) -> dict:
+    """Fetches many forms in one round-trip, returning {form_id: data} for those that exist"""
+    try:
+        db = get_db()
+        refs = [db.collection("forms").document(form_id) for form_id in dict.fromkeys(form_ids)]
+        with metrics.stage("fetch_form", forms=len(refs)):
+            docs = _firestore_call(_get_all, db, refs, stage="fetch_form")
+        return {doc.id: doc.to_dict() for doc in docs if doc.exists}
+    except Exception as e:
+        print(f"Error fetching forms: {str(e)}")
+        raise
+
+def get_template(form_data: dict, template_data: dict = None) -> template_cache.CompiledTemplate:
+    """
+    Returns the compiled template for a form, serving repeat jobs from the
+    template cache. The cache is keyed on templateId plus the blob
+    generation, so a re-uploaded template is downloaded and indexed again.
+
+    template_data is the template document when the caller already read it.
+    """
     try:
         template_id = form_data.get("templateId")
         if not template_id:
             raise ValueError("Missing templateId in form data")
 
-        # Get template metadata from Firestore
-        template_ref = db.collection("templates").document(template_id)
-        template_doc = template_ref.get()
-        if not template_doc.exists:
-            raise ValueError(f"Template {template_id} not found")
+        cache = template_cache.get_cache()
+        generation = cache.known_generation(template_id)
+        if generation:
+            compiled = cache.get(template_id, generation)
+            if compiled:
+                return compiled
 
-        template_data = template_doc.to_dict()
+        # Get template metadata from Firestore
+        if template_data is None:
+            template_ref = get_db().collection("templates").document(template_id)
+            with metrics.stage("fetch_template"):
+                template_doc = _firestore_call(template_ref.get, stage="fetch_template")
+            if not template_doc.exists:
+                raise ValueError(f"Template {template_id} not found")
+            template_data = template_doc.to_dict()
         bucket_name = template_data["downloadURL"].split('/')[5]
         blob_path = template_data["storagePath"]
 
         try:
-            # Download to a temporary file
-            bucket = storage_client.bucket(bucket_name)
-            blob = bucket.blob(blob_path)
-            
-            with NamedTemporaryFile(suffix=".docx", delete=False) as temp_file:
-                blob.download_to_filename(temp_file.name)
-                print(f"Downloaded template to {temp_file.name}")
-                return temp_file.name
-            
+            # Metadata-only request to learn the current generation
+            bucket = get_storage_client().bucket(bucket_name)
+            with metrics.stage("template_metadata"):
+                blob = _storage_call(bucket.get_blob, blob_path, stage="template_metadata")
+            if blob is None:
+                raise ValueError(f"Template file {blob_path} not found")
+            cache.remember_generation(template_id, blob.generation)
+
+            compiled = cache.get(template_id, blob.generation)
+            if compiled:
+                print(f"Using cached template {template_id} (generation {blob.generation})")
+                return compiled
+
+            # Large templates go to disk and are streamed from there
+            spooled_path = None
+            if (blob.size or 0) > template_cache.STREAM_TEMPLATE_BYTES:
+                spooled_path = _spool_template(blob, template_id)
+            else:
+                with metrics.stage("download", template_bytes=blob.size or 0):
+                    content = _storage_call(
+                        blob.download_as_bytes, if_generation_match=blob.generation, stage="download"
+                    )
+                metrics.observe_size("template", len(content))
+                print(f"Downloaded template {template_id} (generation {blob.generation})")
+
+        except ValueError:
+            raise
         except Exception as storage_error:
             print(f"Storage access error: {str(storage_error)}")
-            raise PermissionError(f"Access denied to template storage. Please check service account permissions.")
+            # Chained, so a transient cause can still be retried with the job
+            raise PermissionError(
+                "Access denied to template storage. Please check service account permissions."
+            ) from storage_error
+
+        index = load_template_index(bucket, template_data, blob.generation)
+        if spooled_path:
+            if not index:
+                with metrics.stage("compile_template", streaming=True) as attributes:
+                    index = template_cache.build_package_index(spooled_path)
+                    attributes["placeholders"] = len({
+                        name for part in index["parts"].values() for name in part["placeholders"]
+                    })
+            compiled = template_cache.CompiledTemplate(
+                template_id, blob.generation, None, index, path=spooled_path
+            )
+        elif index:
+            compiled = template_cache.CompiledTemplate(template_id, blob.generation, content, index)
+        else:
+            with metrics.stage("compile_template") as attributes:
+                compiled = template_cache.compile_template(template_id, blob.generation, content)
+                attributes["placeholders"] = len(compiled.placeholders)
+        cache.put(compiled)
+        return compiled
 
     except Exception as e:
         print(f"Error downloading template: {str(e)}")
         raise
 
-def upload_result(form_id: str, file_path: str, file_type: str, office_id: str) -> tuple[str, str]:
+@contextmanager
+def template_lease(form_data: dict, template_data: dict = None):
+    """
+    get_template for the duration of a block. A spooled template keeps its
+    file until the block ends, even when the cache evicts it meanwhile.
+
+    Yields:
+        The compiled template
+    """
+    cache = template_cache.get_cache()
+    for _ in range(TEMPLATE_LEASE_ATTEMPTS):
+        template = get_template(form_data, template_data)
+        if cache.acquire(template):
+            break
+    else:
+        raise RuntimeError(f"Template {form_data.get('templateId')} kept being evicted before it could be used")
+    try:
+        yield template
+    finally:
+        cache.release(template)
+
+def _spool_template(blob, template_id: str) -> str:
+    """Downloads a large template to the spool directory in chunks and returns its path"""
+    path = template_cache.spool_path(template_id, blob.generation)
+    try:
+        with metrics.stage("download", template_bytes=blob.size, streaming=True):
+            _storage_call(
+                blob.download_to_filename, path, if_generation_match=blob.generation, stage="download"
+            )
+    except Exception:
+        os.remove(path)
+        raise
+    metrics.observe_size("template", blob.size)
+    print(f"Spooled template {template_id} (generation {blob.generation}, {blob.size} bytes)")
+    return path
+
+def load_template_index(bucket, template_data: dict, generation) -> dict:
+    """
+    Loads the placeholder location index saved next to the template by
+    processtemplate. Returns None when there is none, or when it was built
+    from another generation of the template, so the caller indexes it itself.
+    """
+    index_path = template_data.get("indexPath")
+    if not index_path or str(template_data.get("indexGeneration")) != str(generation):
+        return None
+    try:
+        with metrics.stage("load_index"):
+            index = json.loads(_storage_call(bucket.blob(index_path).download_as_bytes, stage="load_index"))
+    except Exception as e:
+        logger.warning(f"Could not load template index {index_path}: {e}")
+        return None
+    if not template_cache.index_matches(index, generation):
+        logger.warning(f"Ignoring stale template index {index_path}")
+        return None
+    return index
+
+def upload_result(form_id: str, source, file_type: str, office_id: str,
+                  file_name: str = None, on_uploaded=None) -> tuple[str, str]:
+    """
+    Uploads a generated file for a form.
+
+    Args:
+        form_id: ID of the form the file belongs to
+        source: Local file path, or the file content as bytes
+        file_type: "pdf" or "docx"
+        office_id: Office that owns the form
+        file_name: Name to store the file under; required when source is bytes
+        on_uploaded: Called with the file type and the uploaded blob, whose
+            generation is the one this upload wrote
+
+    Returns:
+        Tuple of (blob_path, url)
+    """
     try:
         print(f"Uploading {file_type.upper()} file...")
 
@@ -69,10 +302,14 @@ def upload_result(form_id: str, file_path: str, file_type: str, office_id: str)
         if not bucket_name:
             raise ValueError("OUTPUT_BUCKET environment variable not set")
 
-        bucket = storage_client.bucket(bucket_name)
+        bucket = get_storage_client().bucket(bucket_name)
         
         # Generate a unique filename with officeId in path
-        file_name = Path(file_path).name
+        if isinstance(source, (bytes, bytearray)):
+            if not file_name:
+                raise ValueError("file_name is required when uploading from memory")
+        else:
+            file_name = file_name or Path(source).name
         blob_name = f"generated_documents/{office_id}/{form_id}/{file_name}"
         blob = bucket.blob(blob_name)
 
@@ -82,67 +319,147 @@ def upload_result(form_id: str, file_path: str, file_type: str, office_id: str)
             "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
         }.get(file_type.lower(), "application/octet-stream")
 
-        # Upload file with appropriate metadata
-        blob.upload_from_filename(
-            file_path,
-            content_type=content_type
-        )
-
-        # Set download-friendly headers
+        # Download-friendly headers go out with the upload itself
         blob.content_disposition = f'attachment; filename="{file_name}"'
         blob.cache_control = "public, max-age=3600"
-        blob.patch()
+
+        # Upload file with appropriate metadata
+        output_size = len(source) if isinstance(source, (bytes, bytearray)) else os.path.getsize(source)
+        metrics.observe_size(file_type.lower(), output_size)
+        with metrics.stage("upload", format=file_type.lower(), output_bytes=output_size):
+            # Uploads overwrite the same blob, so retrying one is safe
+            if isinstance(source, (bytes, bytearray)):
+                _storage_call(blob.upload_from_string, bytes(source), content_type=content_type, stage="upload")
+            else:
+                _storage_call(
+                    blob.upload_from_filename,
+                    source,
+                    content_type=content_type,
+                    stage="upload"
+                )
 
         print(f"Successfully uploaded {file_type.upper()} file: {blob_name}")
-        return blob_name, generate_signed_url(blob_name)
+        if on_uploaded:
+            on_uploaded(file_type, blob)
+        # The blob was just written, no need to check that it exists
+        return blob_name, generate_signed_url(blob_name, verify_exists=False)
         
     except Exception as e:
         print(f"Error uploading result: {str(e)}")
         raise
 
-def get_signing_credentials():
-    """Get credentials with private key for signing URLs"""
+def download_result(blob_path: str, destination: str) -> tuple[str, int]:
+    """
+    Downloads an earlier generated file to a local path.
+
+    Returns:
+        Tuple of (local_path, generation) of the downloaded file
+    """
     try:
-        # Try to load from explicit JSON content
-        key_json = os.getenv('URL_SIGNER_SA_KEY')
-        if key_json:
-            return service_account.Credentials.from_service_account_info(json.loads(key_json))
-        
-        print("No private key available for signing URLs")
-        return None
-        
+        bucket_name = os.getenv("OUTPUT_BUCKET", "")
+        if not bucket_name:
+            raise ValueError("OUTPUT_BUCKET environment variable not set")
+        blob = get_storage_client().bucket(bucket_name).blob(blob_path)
+        with metrics.stage("download_result") as attributes:
+            _storage_call(blob.download_to_filename, destination, stage="download_result")
+            attributes["output_bytes"] = os.path.getsize(destination)
+        return destination, blob.generation
     except Exception as e:
-        print(f"Error loading signing credentials: {str(e)}")
-        return None
+        print(f"Error downloading result {blob_path}: {str(e)}")
+        raise
+
+def delete_result(blob_path: str) -> None:
+    """Deletes a generated file that was never recorded on its form; failures are only logged"""
+    try:
+        bucket = get_storage_client().bucket(os.getenv("OUTPUT_BUCKET", ""))
+        _storage_call(bucket.blob(blob_path).delete, stage="delete_result")
+    except Exception as e:
+        logger.warning(f"Could not delete unused result {blob_path}: {str(e)}")
+
+def submit_upload(form_id: str, source, file_type: str, office_id: str,
+                  file_name: str = None, on_uploaded=None) -> Future:
+    """Starts upload_result on the shared upload pool and returns its future"""
+    return submit_storage_task(
+        upload_result, form_id, source, file_type, office_id, file_name, on_uploaded
+    )
+
+def submit_storage_task(fn, *args) -> Future:
+    """Runs fn(*args) on the shared upload pool with the caller's job trace"""
+    return _upload_executor.submit(metrics.in_current_context(fn), *args)
+
+def get_signing_credentials():
+    """Get credentials with private key for signing URLs, loaded once per process"""
+    global _signing_credentials, _signing_credentials_loaded
+    if _signing_credentials_loaded:
+        return _signing_credentials
+    with _signing_lock:
+        if _signing_credentials_loaded:
+            return _signing_credentials
+        try:
+            # Try to load from explicit JSON content
+            key_json = os.getenv('URL_SIGNER_SA_KEY')
+            if key_json:
+                _signing_credentials = service_account.Credentials.from_service_account_info(json.loads(key_json))
+            else:
+                print("No private key available for signing URLs")
+            _signing_credentials_loaded = True
+            return _signing_credentials
+
+        except Exception as e:
+            print(f"Error loading signing credentials: {str(e)}")
+            return None
+
+def generate_signed_url(blob_path: str, expiration_hours: int = 1, verify_exists: bool = True) -> str:
+    """
+    Generate a temporary access URL or public URL if signing not available.
+
+    URLs are signed locally with the cached service account key and reused
+    during the first SIGNED_URL_REUSE_FRACTION of their lifetime, so
+    repeated requests for the same file are served without signing again.
+    With verify_exists the cache is bypassed, so a deleted blob is noticed.
+    """
+    key = (blob_path, expiration_hours)
+    with _signed_urls_lock:
+        cached = None if verify_exists else _signed_urls.get(key)
+        if cached and cached[1] > time.monotonic():
+            _signed_urls.move_to_end(key)
+            return cached[0]
+
+    with metrics.stage("sign"):
+        url, lifetime = _generate_signed_url(blob_path, expiration_hours, verify_exists)
 
-def generate_signed_url(blob_path: str, expiration_hours: int = 1) -> str:
-    """Generate a temporary access URL or public URL if signing not available"""
+    with _signed_urls_lock:
+        _signed_urls[key] = (url, time.monotonic() + lifetime * SIGNED_URL_REUSE_FRACTION)
+        _signed_urls.move_to_end(key)
+        while len(_signed_urls) > SIGNED_URL_CACHE_SIZE:
+            _signed_urls.popitem(last=False)
+    return url
+
+def _generate_signed_url(blob_path: str, expiration_hours: int, verify_exists: bool) -> tuple[str, float]:
+    """Returns the URL and how many seconds it stays valid"""
     try:
         bucket_name = os.getenv("OUTPUT_BUCKET", "")
         if not bucket_name:
             raise ValueError("OUTPUT_BUCKET environment variable not set")
         
-        bucket = storage_client.bucket(bucket_name)
+        bucket = get_storage_client().bucket(bucket_name)
         blob = bucket.blob(blob_path)
         
-        # Check if blob exists and is public
-        if not blob.exists():
+        # Callers that just uploaded the blob skip this round-trip
+        if verify_exists and not _storage_call(blob.exists, stage="sign"):
             raise ValueError(f"Blob {blob_path} does not exist")
             
-        if blob.public_url:
-            print(f"Using public URL for {blob_path}")
-            return blob.public_url
-            
-        # Try to generate signed URL if we have credentials
+        # Sign locally when we have a private key; no request is made
         signing_credentials = get_signing_credentials()
         if signing_credentials:
             print('There are credentials. Generating signed URL')
-            return blob.generate_signed_url(
+            url = blob.generate_signed_url(
                 version="v4",
                 expiration=timedelta(hours=expiration_hours),
                 method="GET",
                 credentials=signing_credentials
             )
+            return url, expiration_hours * 3600
         
         print('There are no credentials. Generating public URL')
         
@@ -150,47 +467,254 @@ def generate_signed_url(blob_path: str, expiration_hours: int = 1) -> str:
         if bucket.iam_configuration.uniform_bucket_level_access_enabled:
             raise RuntimeError("Bucket has uniform access enabled, cannot generate public URL")
             
-        # Make the blob public temporarily
-        blob.make_public()
+        # Make the blob public; the URL then never expires
+        _storage_call(blob.make_public, stage="sign")
         print(f"Using public URL as fallback for {blob_path}")
-        return blob.public_url
+        return blob.public_url, expiration_hours * 3600
         
     except Exception as e:
-        print(f"Error generating URL: {str(e)}", exc_info=True)
+        logger.error(f"Error generating URL: {str(e)}", exc_info=True)
         raise
 
-def update_document_urls(form_id: str, pdf_path: str, docx_path: str) -> None:
+def _document_urls_update(pdf_path: str, docx_path: str, pdf_url: str = None, docx_url: str = None,
+                          render_state: dict = None) -> dict:
+    # A file that was not generated this time is cleared rather than left stale
+    update = {
+        "generatedPdfUrl": (pdf_url or generate_signed_url(pdf_path)) if pdf_path else None,
+        "generatedPdfPath": pdf_path,
+        "generatedDocxUrl": (docx_url or generate_signed_url(docx_path)) if docx_path else None,
+        "generatedDocxPath": docx_path,
+        "status": "completed",
+        "updatedAt": firestore.SERVER_TIMESTAMP
+    }
+    if render_state is not None:
+        update[RENDER_STATE_FIELD] = render_state
+    return update
+
+def _document_job_update(status: str, error: str = None, **fields) -> dict:
+    update_data = {
+        "status": status,
+        "updatedAt": firestore.SERVER_TIMESTAMP,
+        **fields
+    }
+    if error:
+        update_data["error"] = error
+    return update_data
+
+def update_document_urls(form_id: str, pdf_path: str, docx_path: str,
+                         pdf_url: str = None, docx_url: str = None, render_state: dict = None) -> None:
+    """Finalize a form with its generated files, reusing URLs signed at upload time"""
     try:
-        doc_ref = db.collection("forms").document(form_id)
+        doc_ref = get_db().collection("forms").document(form_id)
+        update_data = _document_urls_update(pdf_path, docx_path, pdf_url, docx_url, render_state)
         
-        pdf_url = generate_signed_url(pdf_path)
-        docx_url = generate_signed_url(docx_path)
-        
-        doc_ref.update({
-            "generatedPdfUrl": pdf_url,
-            "generatedPdfPath": pdf_path,
-            "generatedDocxUrl": docx_url,
-            "generatedDocxPath": docx_path,
-            "status": "completed",
-            "updatedAt": firestore.SERVER_TIMESTAMP
-        })
+        with metrics.stage("firestore_update"):
+            _firestore_call(doc_ref.update, update_data, stage="firestore_update")
         
         logger.info(f"Updated document {form_id} with generated file URLs and paths")
     except Exception as e:
         logger.error(f"Error updating document URLs: {str(e)}", exc_info=True)
         raise
 
-def update_document_job(job_id: str, status: str, error: str = None) -> None:
-    """Update a document generation job record"""
+def add_generated_pdf(form_id: str, pdf_path: str, pdf_url: str, previous_state: dict,
+                      render_state: dict) -> bool:
+    """
+    Adds a PDF converted after its generation, e.g. a deferred one, to the
+    form, unless the form was generated again in the meantime.
+
+    Args:
+        form_id: ID of the form
+        pdf_path: Blob path of the PDF
+        pdf_url: Signed URL of the PDF
+        previous_state: Render state the PDF was converted for
+        render_state: Render state including the PDF
+
+    Returns:
+        Whether the form was updated
+    """
     try:
-        doc_ref = db.collection("document_jobs").document(job_id)
-        update_data = {
-            "status": status,
+        db = get_db()
+        doc_ref = db.collection("forms").document(form_id)
+        update = {
+            "generatedPdfUrl": pdf_url,
+            "generatedPdfPath": pdf_path,
+            RENDER_STATE_FIELD: render_state,
             "updatedAt": firestore.SERVER_TIMESTAMP
         }
-        if error:
-            update_data["error"] = error
-        doc_ref.update(update_data)
+        with metrics.stage("firestore_update"):
+            updated = _firestore_call(
+                _update_if_render_state, db, doc_ref, previous_state, update, stage="firestore_update"
+            )
+        if not updated:
+            logger.info(f"Form {form_id} was generated again while its PDF was converted")
+        return updated
+    except Exception as e:
+        logger.error(f"Error adding PDF to form {form_id}: {str(e)}", exc_info=True)
+        raise
+
+def _update_if_render_state(db, doc_ref, render_state: dict, update: dict, timeout: float = None) -> bool:
+    """Applies update if the form still has render_state, reading and writing in one transaction"""
+    @firestore.transactional
+    def apply(transaction) -> bool:
+        snapshot = doc_ref.get(transaction=transaction, timeout=timeout)
+        if (snapshot.to_dict() or {}).get(RENDER_STATE_FIELD) != render_state:
+            return False
+        transaction.update(doc_ref, update)
+        return True
+
+    return apply(db.transaction())
+
+def update_document_job(job_id: str, status: str, error: str = None, **fields) -> None:
+    """Update a document generation job record; fields are written along with the status"""
+    try:
+        doc_ref = get_db().collection("document_jobs").document(job_id)
+        with metrics.stage("firestore_update"):
+            _firestore_call(doc_ref.update, _document_job_update(status, error, **fields), stage="firestore_update")
     except Exception as e:
         logger.error(f"Error updating document job: {str(e)}")
-        raise
\ No newline at end of file
+        raise
+
+def update_document_jobs(updates: list) -> None:
+    """
+    Update many document generation job records with batched writes.
+
+    Args:
+        updates: List of (job_id, status, error) tuples, each optionally
+            followed by a dictionary of fields to write along
+    """
+    try:
+        db = get_db()
+        # Firestore allows at most 500 writes per batch
+        for start in range(0, len(updates), 500):
+            writes = []
+            for job_id, status, error, *fields in updates[start:start + 500]:
+                update = _document_job_update(status, error, **(fields[0] if fields else {}))
+                writes.append((db.collection("document_jobs").document(job_id), update))
+            with metrics.stage("firestore_update", writes=len(writes)):
+                _firestore_call(_commit, db, writes, stage="firestore_update")
+    except Exception as e:
+        logger.error(f"Error updating document jobs: {str(e)}")
+        raise
+
+def existing_document_jobs(job_ids: list) -> set:
+    """Returns the ids among job_ids that have a document_jobs record"""
+    try:
+        db = get_db()
+        refs = [db.collection("document_jobs").document(job_id) for job_id in dict.fromkeys(job_ids)]
+        with metrics.stage("fetch_jobs", jobs=len(refs)):
+            docs = _firestore_call(_get_all, db, refs, stage="fetch_jobs")
+        return {doc.id for doc in docs if doc.exists}
+    except Exception as e:
+        print(f"Error fetching document jobs: {str(e)}")
+        raise
+
+class JobContext:
+    """
+    Firestore state of one document job.
+
+    The form (and the template, when its id is known up front) is read with
+    a single get_all. Intermediate statuses are buffered and written at most
+    every JOB_STATUS_INTERVAL_SECONDS, so a quick job writes none of them.
+    Completion updates the form's URLs and the job status in one atomic
+    batched write.
+    """
+
+    def __init__(self, job_id: str, form_id: str, template_id: str = None, form_data: dict = None,
+                 max_attempts: int = resilience.JOB_MAX_ATTEMPTS):
+        self.job_id = job_id
+        self.form_id = form_id
+        self.template_id = template_id
+        self.form_data = form_data
+        self.template_data = None
+        # Retry budget, written with the job's status
+        self.attempt = 1
+        self.max_attempts = max_attempts
+        self._job_ref = get_db().collection("document_jobs").document(job_id)
+        self._status = None
+        self._written_status = None
+        self._last_write = time.monotonic()
+        self._lock = threading.Lock()
+
+    def load(self) -> dict:
+        """Reads the form, and the template if its id was given; returns the form data or None"""
+        if self.form_data is not None and not self.template_id:
+            # Already read when the job was admitted
+            return self.form_data
+        try:
+            db = get_db()
+            form_ref = db.collection("forms").document(self.form_id)
+            refs = [form_ref]
+            if self.template_id:
+                refs.append(db.collection("templates").document(self.template_id))
+            with metrics.stage("fetch_form", documents=len(refs)):
+                docs = _firestore_call(_get_all, db, refs, stage="fetch_form")
+            snapshots = {doc.reference.path: doc for doc in docs}
+
+            form_doc = snapshots.get(form_ref.path)
+            if form_doc is None or not form_doc.exists:
+                print(f"Form {self.form_id} not found")
+                return None
+            form_data = form_doc.to_dict()
+
+            template_doc = snapshots.get(refs[-1].path) if self.template_id else None
+            # Only trust the prefetched template if the form really uses it
+            if template_doc is not None and template_doc.exists and form_data.get("templateId") == self.template_id:
+                self.template_data = template_doc.to_dict()
+            return form_data
+        except Exception as e:
+            print(f"Error fetching form data: {str(e)}")
+            raise
+
+    def set_status(self, status: str, force: bool = False) -> None:
+        """Records an intermediate status, writing it only if the last write is old enough"""
+        with self._lock:
+            self._status = status
+            due = force or time.monotonic() - self._last_write >= JOB_STATUS_INTERVAL_SECONDS
+        if due:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            status = self._status
+            if status is None or status == self._written_status:
+                return
+            self._written_status = status
+            self._last_write = time.monotonic()
+        update_document_job(self.job_id, status)
+
+    def complete(self, pdf_path: str, docx_path: str, pdf_url: str = None, docx_url: str = None,
+                 render_state: dict = None) -> None:
+        """Writes the form's generated files and the completed job status atomically"""
+        try:
+            db = get_db()
+            writes = [
+                (
+                    db.collection("forms").document(self.form_id),
+                    _document_urls_update(pdf_path, docx_path, pdf_url, docx_url, render_state)
+                ),
+                (self._job_ref, _document_job_update("completed", **self._budget())),
+            ]
+            with metrics.stage("firestore_update", writes=2):
+                _firestore_call(_commit, db, writes, stage="firestore_update")
+            with self._lock:
+                self._status = self._written_status = "completed"
+            logger.info(f"Completed job {self.job_id} for form {self.form_id}")
+        except Exception as e:
+            logger.error(f"Error completing document job: {str(e)}", exc_info=True)
+            raise
+
+    def retry(self, error: str) -> None:
+        """Records that the attempt failed and the job will run again"""
+        with self._lock:
+            self._status = self._written_status = "retrying"
+        # Kept apart from "error", which only a failed job carries
+        update_document_job(self.job_id, "retrying", lastError=error, **self._budget())
+        self.attempt += 1
+
+    def fail(self, error: str) -> None:
+        with self._lock:
+            self._status = self._written_status = "failed"
+        update_document_job(self.job_id, "failed", error, **self._budget())
+
+    def _budget(self) -> dict:
+        return {"attempts": self.attempt, "maxAttempts": self.max_attempts}
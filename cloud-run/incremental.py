@@ -0,0 +1,176 @@
+"""
+Incremental re-rendering of forms.
+
+Every generation records a render state on the form: the template version
+it used, a digest of the value of each placeholder that template uses, the
+PDF export options and the files it produced. When the form is generated
+again:
+
+* nothing the template uses changed: the earlier files are still right and
+  are handed out again, without filling, converting or uploading; the PDF
+  only if it was exported with the same options;
+* only the DOCX is wanted: the earlier DOCX is downloaded and only the
+  paragraphs holding changed placeholders are filled again from the
+  template, while every other zip member is copied as is;
+* anything else: the form is rendered in full.
+"""
+import copy
+import hashlib
+import logging
+import os
+import zipfile
+
+from lxml import etree
+
+import firestore_utils
+import metrics
+import ooxml_fill
+import placeholder_engine
+import render_cache
+
+logger = logging.getLogger(__name__)
+
+INCREMENTAL_RENDER = os.getenv("INCREMENTAL_RENDER", "true").lower() == "true"
+
+FILE_TYPES = render_cache.FILE_TYPES
+
+
+class PatchMismatch(ValueError):
+    """Raised when the earlier DOCX no longer lines up with its template."""
+
+
+def field_digests(template, field_data: dict) -> dict:
+    """Digest of the value of every placeholder the template uses; None when the field is missing"""
+    values = placeholder_engine.normalize_values(field_data)
+    return {
+        name: hashlib.sha256(values[name].encode("utf-8")).hexdigest()[:16] if name in values else None
+        for name in sorted(template.placeholders)
+    }
+
+
+def render_state(template, digests: dict, uploads: dict, filter_data: dict = None) -> dict:
+    """The state recorded on the form after a generation"""
+    return {
+        "version": render_cache.RENDER_VERSION,
+        "templateId": template.template_id,
+        "generation": template.generation,
+        "fields": digests,
+        "pdfOptions": filter_data or {},
+        "files": {file_type: blob_path for file_type, (blob_path, _) in uploads.items()},
+    }
+
+
+def changed_fields(state: dict, template, digests: dict) -> set:
+    """
+    Placeholders whose value differs from the recorded generation.
+
+    Returns:
+        Set of placeholder names, or None when there is no usable state, e.g.
+        the form was never generated or the template has changed since
+    """
+    if not INCREMENTAL_RENDER or not isinstance(state, dict):
+        return None
+    if (
+        state.get("version") != render_cache.RENDER_VERSION
+        or state.get("templateId") != template.template_id
+        or str(state.get("generation")) != template.generation
+        or not isinstance(state.get("fields"), dict)
+    ):
+        return None
+    previous = state["fields"]
+    return {name for name, digest in digests.items() if name not in previous or previous[name] != digest}
+
+
+def reuse_files(state: dict, formats: tuple, filter_data: dict = None) -> dict:
+    """
+    Hands out every file of the recorded generation again; they are all
+    still current when no placeholder value changed, except a PDF exported
+    with other options than filter_data.
+
+    Returns:
+        Dictionary of file type to (blob_path, url), or None when a wanted
+        file was not produced last time or no longer exists
+    """
+    files = {file_type: path for file_type, path in (state.get("files") or {}).items() if file_type in FILE_TYPES}
+    if (state.get("pdfOptions") or {}) != (filter_data or {}):
+        files.pop("pdf", None)
+    if any(file_type not in files for file_type in formats):
+        return None
+    try:
+        with metrics.stage("reuse_previous", formats=",".join(files)):
+            # Signing checks that each file is still there
+            return {
+                file_type: (blob_path, firestore_utils.generate_signed_url(blob_path))
+                for file_type, blob_path in files.items()
+            }
+    except Exception as e:
+        logger.warning(f"Earlier files are not reusable, rendering again: {str(e)}")
+        return None
+
+
+def patch_docx(template, previous, output, form_data: dict, changed: set) -> int:
+    """
+    Writes the earlier filled DOCX with only the changed placeholders
+    filled again.
+
+    Filling never adds or removes paragraphs, so paragraph ordinals in the
+    earlier output match those in the template. Every paragraph that holds
+    a changed placeholder is replaced by a fresh copy of the template
+    paragraph filled with the current values; parts without changed
+    placeholders are copied with their compressed bytes untouched.
+
+    Args:
+        template: Compiled template the earlier DOCX was filled from
+        previous: Path or seekable file-like object of the earlier DOCX
+        output: Path or file-like object to write the patched DOCX to
+        form_data: Current field data
+        changed: Names of the placeholders whose value changed
+
+    Returns:
+        Number of placeholders filled
+    """
+    values = placeholder_engine.normalize_values(form_data)
+    parts = {
+        name: located
+        for name, located in template.index["parts"].items()
+        if changed.intersection(located["placeholders"])
+    }
+    replaced = 0
+
+    with template.open() as source, zipfile.ZipFile(source) as template_package, \
+            zipfile.ZipFile(previous) as previous_package:
+
+        def rewrite(info: zipfile.ZipInfo) -> bytes:
+            nonlocal replaced
+            located = parts.get(info.filename)
+            if not located:
+                return None
+            template_root = etree.fromstring(template_package.read(info.filename), ooxml_fill._parser)
+            root = etree.fromstring(previous_package.read(info), ooxml_fill._parser)
+            template_paragraphs = list(placeholder_engine.iter_paragraphs(template_root))
+            paragraphs = list(placeholder_engine.iter_paragraphs(root))
+            if len(template_paragraphs) != len(paragraphs):
+                raise PatchMismatch(f"{info.filename} no longer matches its template")
+
+            for ordinal in located["paragraphs"]:
+                template_paragraph = template_paragraphs[ordinal]
+                nodes = placeholder_engine.paragraph_text_nodes(template_paragraph)
+                names = placeholder_engine.PLACEHOLDER_PATTERN.findall("".join(node.text or "" for node in nodes))
+                if not changed.intersection(names):
+                    continue
+                old = paragraphs[ordinal]
+                if old.getroottree().getroot() is not root:
+                    # Nested in a paragraph that was already replaced whole
+                    continue
+                fresh = copy.deepcopy(template_paragraph)
+                # Also refills paragraphs nested in this one, e.g. in text boxes
+                replaced += placeholder_engine.fill_part(fresh, values)
+                old.getparent().replace(old, fresh)
+            return etree.tostring(root, encoding="UTF-8", standalone=True)
+
+        if isinstance(output, str):
+            with open(output, "wb") as f:
+                ooxml_fill.copy_package(previous_package, f, rewrite)
+        else:
+            ooxml_fill.copy_package(previous_package, output, rewrite)
+    return replaced
@@ -0,0 +1,316 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import firestore_utils
+import metrics
+import pipeline
+
+logger = logging.getLogger(__name__)
+
+# Accept jobs with 202 and run them in the background; set to false to
+# process them inside the request as before
+ASYNC_JOBS = os.getenv("ASYNC_JOBS", "true").lower() == "true"
+# Global cap: jobs running at once across all offices
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+# Per-office caps on running and waiting jobs; by default one worker is
+# always left for other offices
+OFFICE_MAX_RUNNING = int(os.getenv("OFFICE_MAX_RUNNING", str(max(1, JOB_WORKERS - 1))))
+OFFICE_QUEUE_SIZE = int(os.getenv("OFFICE_QUEUE_SIZE", "50"))
+# Jobs an office may submit per second, with bursts of OFFICE_SUBMIT_BURST;
+# 0 disables the limit
+OFFICE_SUBMIT_RATE = float(os.getenv("OFFICE_SUBMIT_RATE", "0"))
+OFFICE_SUBMIT_BURST = int(os.getenv("OFFICE_SUBMIT_BURST", "20"))
+# Share of capacity per office, e.g. {"office-a": 2}; others weigh 1
+OFFICE_WEIGHTS = json.loads(os.getenv("OFFICE_WEIGHTS", "{}") or "{}")
+# On shutdown, how long running jobs may finish before they are marked
+# failed; Cloud Run kills the instance 10 seconds after SIGTERM
+SHUTDOWN_GRACE_SECONDS = float(os.getenv("JOB_SHUTDOWN_GRACE_SECONDS", "5"))
+
+UNKNOWN_OFFICE = "unknown"
+
+
+class QueueFull(Exception):
+    """Raised when the job queue cannot accept more work."""
+
+
+class _Office:
+    def __init__(self, weight: float):
+        self.weight = weight
+        self.jobs = deque()
+        self.running = 0
+        # Stride scheduling: the office with the lowest pass runs next, and
+        # each dispatch advances it by 1 / weight
+        self.pass_value = 0.0
+        self.tokens = float(OFFICE_SUBMIT_BURST)
+        self.refilled_at = time.monotonic()
+
+
+class JobQueue:
+    """
+    In-process work queue that shares the generation workers fairly between
+    offices.
+
+    Every office has its own FIFO. Free workers pick the next job from the
+    office that has received the least service relative to its weight, while
+    no office may run more than max_running jobs at once. A burst from one
+    office therefore waits behind its own jobs, not in front of everyone
+    else's.
+
+    Work that runs inside a request, i.e. the jobs of a batch and the
+    conversions of a merge, takes its slots through hold(), so it counts
+    against the same caps and waits its turn like queued jobs.
+
+    Job progress is not tracked here; handlers report it through the
+    document_jobs status field. A job submitted again while it is still
+    queued or running, e.g. by a caller retrying after a lost response, is
+    accepted without being queued twice.
+
+    On shutdown, drain() fails the jobs that never started and, after a
+    grace period, the ones still running, so their records do not stay
+    "processing" with nobody left to finish them.
+    """
+
+    def __init__(self, handler, workers: int = JOB_WORKERS, max_size: int = JOB_QUEUE_SIZE,
+                 max_running: int = OFFICE_MAX_RUNNING, office_queue_size: int = OFFICE_QUEUE_SIZE,
+                 submit_rate: float = OFFICE_SUBMIT_RATE, weights: dict = None):
+        self.handler = handler
+        self.workers = workers
+        self.max_size = max_size
+        self.max_running = max(1, max_running)
+        self.office_queue_size = office_queue_size
+        self.submit_rate = submit_rate
+        self.weights = OFFICE_WEIGHTS if weights is None else weights
+        self._offices = {}
+        self._queued = 0
+        self._running = 0
+        self._active = set()
+        # Jobs picked by a worker and not finished yet, job_id -> form_id
+        self._in_progress = {}
+        self._threads = []
+        self._condition = threading.Condition()
+        self._stopping = False
+
+    def start(self) -> None:
+        with self._condition:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        print(f"Job queue started with {self.workers} workers")
+
+    def submit(self, job_id: str, form_id: str, options: dict = None, office_id: str = None) -> None:
+        """Queues a job; options are passed to the handler as keyword arguments"""
+        if self._stopping:
+            raise QueueFull("Service is shutting down")
+        self.start()
+        office_id = office_id or UNKNOWN_OFFICE
+        with self._condition:
+            if job_id in self._active:
+                print(f"Job {job_id} is already queued or running")
+                return
+            office = self._office(office_id)
+            if self._queued >= self.max_size:
+                raise QueueFull(f"Job queue is full ({self._queued} jobs waiting)")
+            if len(office.jobs) >= self.office_queue_size:
+                raise QueueFull(f"Office {office_id} has {len(office.jobs)} jobs waiting")
+            if self.submit_rate and not self._take_token(office):
+                raise QueueFull(f"Office {office_id} is submitting jobs too fast")
+
+            if not office.jobs and not office.running:
+                # A returning office starts level with the busiest ones instead
+                # of cashing in the time it was idle
+                office.pass_value = max(office.pass_value, self._min_pass())
+            office.jobs.append((job_id, form_id, options or {}, time.monotonic()))
+            self._active.add(job_id)
+            self._queued += 1
+            self._report(office_id, office)
+            # Wakes a worker, and holders that must now let this job go first
+            self._condition.notify_all()
+
+    @contextmanager
+    def hold(self, office_id: str = None):
+        """
+        Holds one of the office's running slots, and one of the workers',
+        for the duration of the block. Waits while the office is at its cap,
+        every slot is taken, or another office with waiting jobs is due first.
+        """
+        office_id = office_id or UNKNOWN_OFFICE
+        with self._condition:
+            office = self._office(office_id)
+            if not office.jobs and not office.running:
+                office.pass_value = max(office.pass_value, self._min_pass())
+            while not self._may_hold(office):
+                self._condition.wait()
+            office.pass_value += 1 / max(office.weight, 0.01)
+            office.running += 1
+            self._running += 1
+            self._report(office_id, office)
+        try:
+            yield
+        finally:
+            with self._condition:
+                office.running -= 1
+                self._running -= 1
+                self._report(office_id, office)
+                self._condition.notify_all()
+
+    def _may_hold(self, office: _Office) -> bool:
+        if office.running >= self.max_running or self._running >= self.workers:
+            return False
+        # Queued jobs of offices that received less service go first
+        return not any(
+            other is not office and other.jobs and other.running < self.max_running
+            and other.pass_value < office.pass_value
+            for other in self._offices.values()
+        )
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "workers": self.workers,
+                "running": self._running,
+                "queued": self._queued,
+                "capacity": self.max_size,
+                "offices": {
+                    office_id: {"queued": len(office.jobs), "running": office.running}
+                    for office_id, office in self._offices.items()
+                    if office.jobs or office.running
+                },
+            }
+
+    def drain(self, on_dropped, on_interrupted=None, grace: float = SHUTDOWN_GRACE_SECONDS) -> None:
+        """
+        Stops accepting work and hands every job that never started to
+        on_dropped. Jobs still running after grace seconds are handed to
+        on_interrupted.
+        """
+        self._stopping = True
+        with self._condition:
+            dropped = []
+            for office_id, office in self._offices.items():
+                dropped.extend((job_id, form_id) for job_id, form_id, _, _ in office.jobs)
+                self._active.difference_update(job_id for job_id, _, _, _ in office.jobs)
+                office.jobs.clear()
+                self._report(office_id, office)
+            self._queued = 0
+        for job_id, form_id in dropped:
+            try:
+                on_dropped(job_id, form_id)
+            except Exception as e:
+                logger.error(f"Error releasing queued job {job_id}: {str(e)}")
+        if on_interrupted is None:
+            return
+
+        with self._condition:
+            self._condition.wait_for(lambda: not self._in_progress, timeout=grace)
+            interrupted = list(self._in_progress.items())
+        for job_id, form_id in interrupted:
+            try:
+                on_interrupted(job_id, form_id)
+            except Exception as e:
+                logger.error(f"Error releasing running job {job_id}: {str(e)}")
+
+    def _office(self, office_id: str) -> _Office:
+        office = self._offices.get(office_id)
+        if office is None:
+            office = self._offices[office_id] = _Office(float(self.weights.get(office_id, 1)))
+        return office
+
+    def _min_pass(self) -> float:
+        active = [o.pass_value for o in self._offices.values() if o.jobs or o.running]
+        return min(active) if active else 0.0
+
+    def _take_token(self, office: _Office) -> bool:
+        now = time.monotonic()
+        office.tokens = min(
+            float(OFFICE_SUBMIT_BURST), office.tokens + (now - office.refilled_at) * self.submit_rate
+        )
+        office.refilled_at = now
+        if office.tokens < 1:
+            return False
+        office.tokens -= 1
+        return True
+
+    def _next(self):
+        """Picks the next job, or None when every office with work is at its cap"""
+        eligible = [
+            (office.pass_value, office_id, office)
+            for office_id, office in self._offices.items()
+            if office.jobs and office.running < self.max_running
+        ]
+        # Slots held by batches and merges count against the workers
+        if not eligible or self._running >= self.workers:
+            return None
+        _, office_id, office = min(eligible, key=lambda item: (item[0], item[1]))
+        office.pass_value += 1 / max(office.weight, 0.01)
+        office.running += 1
+        self._queued -= 1
+        self._running += 1
+        job = office.jobs.popleft()
+        self._in_progress[job[0]] = job[1]
+        self._report(office_id, office)
+        # Holders waiting for this office's turn may go now
+        self._condition.notify_all()
+        return office_id, office, job
+
+    def _report(self, office_id: str, office: _Office) -> None:
+        metrics.observe_queue(office_id, len(office.jobs), office.running)
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                picked = self._next()
+                while picked is None:
+                    self._condition.wait()
+                    picked = self._next()
+            office_id, office, (job_id, form_id, options, queued_at) = picked
+            metrics.observe_queue_wait(time.monotonic() - queued_at)
+            try:
+                self.handler(job_id, form_id, **options)
+            except Exception as e:
+                # The handler already recorded the failure on the job
+                logger.error(f"Background job {job_id} failed: {str(e)}")
+            finally:
+                with self._condition:
+                    self._active.discard(job_id)
+                    self._in_progress.pop(job_id, None)
+                    office.running -= 1
+                    self._running -= 1
+                    self._report(office_id, office)
+                    # A finished job can unblock a capped office for any worker
+                    self._condition.notify_all()
+
+
+def _release_job(job_id: str, form_id: str) -> None:
+    firestore_utils.update_document_job(
+        job_id, "failed", "Service shut down before the job started"
+    )
+
+
+def _interrupt_job(job_id: str, form_id: str) -> None:
+    firestore_utils.update_document_job(
+        job_id, "failed", "Service shut down while the job was running; submit it again"
+    )
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue() -> JobQueue:
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = JobQueue(pipeline.process_job)
+                atexit.register(_queue.drain, _release_job, _interrupt_job)
+    return _queue
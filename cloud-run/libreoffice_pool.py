@@ -0,0 +1,416 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import select
+import shutil
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import capacity
+import metrics
+import pdf_export
+import resilience
+
+logger = logging.getLogger(__name__)
+
+# Concurrent conversions; "auto" runs one soffice per CPU that fits in memory
+POOL_SIZE = capacity.size_from_env("LIBREOFFICE_POOL_SIZE", capacity.libreoffice_workers()) or 1
+MAX_CONVERSIONS_PER_WORKER = int(os.getenv("LIBREOFFICE_MAX_CONVERSIONS", "200"))
+CONVERT_TIMEOUT_SECONDS = float(os.getenv("LIBREOFFICE_CONVERT_TIMEOUT", "120"))
+START_TIMEOUT_SECONDS = float(os.getenv("LIBREOFFICE_START_TIMEOUT", "60"))
+PROFILE_ROOT = os.getenv("LIBREOFFICE_PROFILE_ROOT", "/tmp/libreoffice-profiles")
+BASE_PORT = int(os.getenv("LIBREOFFICE_BASE_PORT", "2002"))
+UNO_PYTHON = os.getenv("UNO_PYTHON", "/usr/bin/python3")
+# "uno" keeps a listening soffice per worker, "subprocess" launches soffice per
+# conversion against the worker's warm profile, "auto" picks uno when available.
+POOL_MODE = os.getenv("LIBREOFFICE_POOL_MODE", "auto")
+# How long the health endpoint waits for one worker to answer a ping
+HEALTH_CHECK_TIMEOUT_SECONDS = float(os.getenv("LIBREOFFICE_HEALTH_CHECK_TIMEOUT", "2"))
+
+BRIDGE_SCRIPT = str(Path(__file__).with_name("uno_bridge.py"))
+
+
+class ConversionTimeout(RuntimeError):
+    """Raised when a worker does not finish a conversion in time."""
+
+
+def find_libreoffice() -> str:
+    libreoffice_path = shutil.which("libreoffice") or shutil.which("soffice")
+    if not libreoffice_path:
+        raise RuntimeError("LibreOffice not found in PATH")
+    return libreoffice_path
+
+
+def uno_available() -> bool:
+    """Check whether the UNO interpreter can import the uno module"""
+    if not os.path.exists(UNO_PYTHON):
+        return False
+    try:
+        result = subprocess.run(
+            [UNO_PYTHON, "-c", "import uno"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=15,
+        )
+        return result.returncode == 0
+    except Exception:
+        return False
+
+
+def kill_process_group(process: subprocess.Popen) -> None:
+    """Kill a process started with start_new_session and everything it spawned"""
+    if process is None or process.poll() is not None:
+        return
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        logger.warning(f"Process {process.pid} did not exit after SIGKILL")
+
+
+class LibreOfficeWorker:
+    """
+    A single headless LibreOffice worker with its own user profile.
+
+    In "uno" mode the worker keeps one soffice listener alive and talks to it
+    through uno_bridge.py. In "subprocess" mode it launches soffice per
+    conversion, but always against the same already-initialised profile.
+    """
+
+    def __init__(self, worker_id: int, mode: str):
+        self.worker_id = worker_id
+        self.mode = mode
+        self.port = BASE_PORT + worker_id
+        self.profile_dir = os.path.join(PROFILE_ROOT, f"worker-{worker_id}")
+        self.profile_url = Path(self.profile_dir).as_uri()
+        self.conversions = 0
+        self.started_at = None
+        # Set by the pool health check; the next checkout restarts the worker
+        self.restart_reason = None
+        self._soffice = None
+        self._bridge = None
+
+    def start(self) -> None:
+        os.makedirs(self.profile_dir, exist_ok=True)
+        self.conversions = 0
+        self.restart_reason = None
+        self.started_at = time.monotonic()
+        if self.mode != "uno":
+            return
+
+        self._soffice = subprocess.Popen(
+            [
+                find_libreoffice(),
+                f"-env:UserInstallation={self.profile_url}",
+                "--headless",
+                "--invisible",
+                "--nologo",
+                "--nodefault",
+                "--norestore",
+                "--nolockcheck",
+                f"--accept=socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext",
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        self._bridge = subprocess.Popen(
+            [UNO_PYTHON, BRIDGE_SCRIPT, str(self.port), str(START_TIMEOUT_SECONDS)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        try:
+            self._read_reply(START_TIMEOUT_SECONDS)
+        except Exception:
+            self.stop()
+            raise
+        print(f"LibreOffice worker {self.worker_id} listening on port {self.port}")
+
+    def stop(self) -> None:
+        for process in (self._bridge, self._soffice):
+            kill_process_group(process)
+        self._bridge = None
+        self._soffice = None
+
+    def restart(self, reason: str) -> None:
+        logger.warning(f"Restarting LibreOffice worker {self.worker_id}: {reason}")
+        self.stop()
+        self.start()
+
+    def is_running(self) -> bool:
+        if self.mode != "uno":
+            return self.started_at is not None
+        return (
+            self._soffice is not None and self._soffice.poll() is None
+            and self._bridge is not None and self._bridge.poll() is None
+        )
+
+    def health_check(self, timeout: float = 10) -> bool:
+        if not self.is_running():
+            return False
+        if self.mode != "uno":
+            return True
+        try:
+            self._send({"op": "ping"}, timeout)
+            return True
+        except Exception as e:
+            logger.warning(f"LibreOffice worker {self.worker_id} failed health check: {e}")
+            return False
+
+    def convert(self, input_path: str, output_dir: str, timeout: float, filter_data: dict = None) -> None:
+        self.convert_many([input_path], output_dir, timeout, filter_data)
+
+    def convert_many(self, input_paths: list, output_dir: str, timeout: float,
+                     filter_data: dict = None) -> None:
+        """
+        Converts several documents in one soffice invocation or bridge
+        round-trip, with filter_data as the PDF export FilterData.
+        """
+        if self.mode == "uno":
+            documents = [
+                {
+                    "input": input_path,
+                    "output": os.path.join(
+                        output_dir, os.path.splitext(os.path.basename(input_path))[0] + ".pdf"
+                    ),
+                }
+                for input_path in input_paths
+            ]
+            options = {"filter_data": filter_data} if filter_data else {}
+            if len(documents) == 1:
+                self._send({"op": "convert", **documents[0], **options}, timeout)
+            else:
+                self._send({"op": "convert_many", "documents": documents, **options}, timeout)
+        else:
+            self._convert_subprocess(input_paths, output_dir, timeout, filter_data)
+        self.conversions += len(input_paths)
+
+    def _convert_subprocess(self, input_paths: list, output_dir: str, timeout: float,
+                            filter_data: dict = None) -> None:
+        cmd = [
+            find_libreoffice(),
+            f"-env:UserInstallation={self.profile_url}",
+            "--headless",
+            "--convert-to", pdf_export.convert_to_argument(filter_data),
+            "--outdir", output_dir,
+            *input_paths
+        ]
+        print(f"Running command: {' '.join(cmd)}")
+        process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            start_new_session=True,
+            # Keep LibreOffice's scratch files inside the job's workspace
+            env={**os.environ, "TMPDIR": output_dir},
+        )
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            kill_process_group(process)
+            raise ConversionTimeout(f"LibreOffice conversion exceeded {timeout}s")
+
+        if stdout:
+            print(f"LibreOffice stdout: {stdout}")
+        if stderr:
+            print(f"LibreOffice stderr: {stderr}")
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd, stdout, stderr)
+
+    def _send(self, request: dict, timeout: float) -> dict:
+        self._bridge.stdin.write((json.dumps(request) + "\n").encode())
+        self._bridge.stdin.flush()
+        return self._read_reply(timeout)
+
+    def _read_reply(self, timeout: float) -> dict:
+        ready, _, _ = select.select([self._bridge.stdout], [], [], timeout)
+        if not ready:
+            raise ConversionTimeout(
+                f"LibreOffice worker {self.worker_id} did not answer within {timeout}s"
+            )
+        line = self._bridge.stdout.readline()
+        if not line:
+            raise RuntimeError(f"LibreOffice worker {self.worker_id} bridge exited")
+        reply = json.loads(line)
+        if not reply.get("ok"):
+            raise RuntimeError(f"LibreOffice conversion failed: {reply.get('error')}")
+        return reply
+
+
+class LibreOfficePool:
+    """
+    Fixed-size pool of warm LibreOffice workers.
+
+    Workers are started lazily on first checkout, recycled after
+    max_conversions jobs and restarted whenever a conversion hangs or a
+    worker fails its health check.
+    """
+
+    def __init__(self, size: int = POOL_SIZE, max_conversions: int = MAX_CONVERSIONS_PER_WORKER,
+                 timeout: float = CONVERT_TIMEOUT_SECONDS, mode: str = POOL_MODE):
+        if mode == "auto":
+            mode = "uno" if uno_available() else "subprocess"
+        self.mode = mode
+        self.size = size
+        self.max_conversions = max_conversions
+        self.timeout = timeout
+        self._workers = [LibreOfficeWorker(i, mode) for i in range(size)]
+        self._idle = queue.Queue()
+        for worker in self._workers:
+            self._idle.put(worker)
+        print(f"LibreOffice pool created with {size} {mode} workers")
+
+    def convert(self, input_path: str, output_dir: str, timeout: float = None,
+                filter_data: dict = None) -> None:
+        self.convert_many([input_path], output_dir, timeout, filter_data)
+
+    def convert_many(self, input_paths: list, output_dir: str, timeout: float = None,
+                     filter_data: dict = None) -> None:
+        """
+        Converts documents on a single worker, paying the per-invocation
+        overhead once. The timeout applies per document, and neither the
+        wait for a worker nor the conversion outlasts the job's deadline
+        (see resilience); filter_data is the PDF export FilterData (see
+        pdf_export).
+        """
+        timeout = (timeout or self.timeout) * len(input_paths)
+        # Callers queue here when every worker is busy
+        with metrics.stage("convert_wait"):
+            left = resilience.remaining()
+            try:
+                worker = self._idle.get(timeout=None if left is None else max(0, left))
+            except queue.Empty:
+                raise resilience.DeadlineExceeded("Job deadline exceeded waiting for a LibreOffice worker")
+        try:
+            if worker.started_at is None:
+                worker.start()
+            elif worker.restart_reason:
+                worker.restart(worker.restart_reason)
+            elif worker.conversions >= self.max_conversions:
+                worker.restart(f"reached {worker.conversions} conversions")
+            elif not worker.is_running():
+                worker.restart("process exited")
+
+            # A conversion cut short by the deadline restarts the worker like any other hang
+            timeout = resilience.stage_timeout(timeout)
+            try:
+                worker.convert_many(input_paths, output_dir, timeout, filter_data)
+            except ConversionTimeout:
+                worker.restart("conversion timed out")
+                raise
+            except Exception:
+                if not worker.health_check():
+                    worker.restart("unhealthy after failed conversion")
+                raise
+        finally:
+            self._idle.put(worker)
+
+    def warm_up(self, sample_path: str, output_root: str) -> float:
+        """
+        Starts every idle worker and converts a throwaway document on each, so
+        the profile, font cache and first-load costs are paid before any job.
+
+        Returns:
+            Seconds until the first worker finished its conversion
+        """
+        workers = []
+        while True:
+            try:
+                workers.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        started = time.monotonic()
+        first_done = []
+
+        def warm(worker: LibreOfficeWorker) -> None:
+            output_dir = os.path.join(output_root, f"worker-{worker.worker_id}")
+            os.makedirs(output_dir, exist_ok=True)
+            if worker.started_at is None:
+                worker.start()
+            worker.convert(sample_path, output_dir, self.timeout)
+            first_done.append(time.monotonic() - started)
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, len(workers)), thread_name_prefix="warm-up") as executor:
+                futures = {executor.submit(warm, worker): worker for worker in workers}
+                for future, worker in futures.items():
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error(f"Warm-up conversion failed on LibreOffice worker {worker.worker_id}: {e}")
+        finally:
+            for worker in workers:
+                self._idle.put(worker)
+        if not first_done:
+            raise RuntimeError("No LibreOffice worker completed the warm-up conversion")
+        print(f"Warmed {len(first_done)} of {len(workers)} LibreOffice workers")
+        return min(first_done)
+
+    def health_check(self) -> dict:
+        """
+        Ping idle workers and report the state of the pool.
+
+        Workers are taken one at a time and put back as soon as they answer,
+        so the check never holds more than one worker away from conversions.
+        An unhealthy worker is not restarted here; it is marked and the next
+        conversion that checks it out restarts it.
+        """
+        workers = {}
+        for _ in range(self.size):
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                if worker.worker_id in workers:
+                    # Every idle worker has been seen once
+                    break
+                healthy = worker.started_at is None or worker.health_check(HEALTH_CHECK_TIMEOUT_SECONDS)
+                if not healthy:
+                    worker.restart_reason = "failed health check"
+                workers[worker.worker_id] = {
+                    "started": worker.started_at is not None,
+                    "healthy": healthy,
+                    "conversions": worker.conversions,
+                }
+            finally:
+                self._idle.put(worker)
+
+        for worker in self._workers:
+            workers.setdefault(worker.worker_id, {"busy": True, "conversions": worker.conversions})
+        return {
+            "mode": self.mode,
+            "size": self.size,
+            "healthy": all(w.get("healthy", True) for w in workers.values()),
+            "workers": workers,
+        }
+
+    def shutdown(self) -> None:
+        for worker in self._workers:
+            worker.stop()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> LibreOfficePool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = LibreOfficePool()
+                atexit.register(_pool.shutdown)
+    return _pool
@@ -1,128 +1,228 @@
 import subprocess
 import os
+import io
+import atexit
 import logging
-from pathlib import Path
+import multiprocessing
 import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from pathlib import Path
 from docx import Document
 import tempfile
+import capacity
+import fill_worker
+import libreoffice_pool
+import ooxml_fill
+import placeholder_engine
+import template_cache
+import metrics
 
 logger = logging.getLogger(__name__)
 
-def fill_template_and_convert(template_path: str, form_data: dict) -> tuple[str, str]:
+# "docx" fills through the python-docx object model; "ooxml" rewrites only the
+# XML parts holding placeholders and copies every other zip member as is
+FILL_ENGINES = ("docx", "ooxml")
+FILL_ENGINE = os.getenv("FILL_ENGINE", "docx")
+
+# Fill templates in separate processes so filling is not serialized by the
+# GIL; "auto" uses one process per CPU, 0 fills in the calling thread
+FILL_PROCESSES = capacity.fill_processes()
+
+_fill_pool = None
+_fill_pool_lock = threading.Lock()
+
+# Per-job scratch space; tmpfs when available so no job touches the disk
+WORKSPACE_ROOT = os.getenv(
+    "JOB_WORKSPACE_ROOT",
+    "/dev/shm" if os.access("/dev/shm", os.W_OK) else tempfile.gettempdir()
+)
+
+@contextmanager
+def job_workspace():
     """
-    Fills a Word template with form data and converts it to both DOCX and PDF formats.
-    
+    Creates a scratch directory for one job on tmpfs and removes it when the
+    job ends, whether it succeeded or not.
+
+    Yields:
+        Path to the workspace directory
+    """
+    workspace = tempfile.mkdtemp(prefix="job-", dir=WORKSPACE_ROOT)
+    try:
+        yield workspace
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+def get_fill_pool() -> ProcessPoolExecutor:
+    global _fill_pool
+    if _fill_pool is None:
+        with _fill_pool_lock:
+            if _fill_pool is None:
+                # forkserver: never fork the threaded web process itself
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload(["fill_worker"])
+                _fill_pool = ProcessPoolExecutor(max_workers=FILL_PROCESSES, mp_context=context)
+                atexit.register(_fill_pool.shutdown, wait=False, cancel_futures=True)
+                print(f"Fill pool created with {FILL_PROCESSES} processes")
+    return _fill_pool
+
+def _discard_fill_pool(pool: ProcessPoolExecutor) -> None:
+    global _fill_pool
+    with _fill_pool_lock:
+        if _fill_pool is pool:
+            logger.error("Fill process pool broke, recreating it")
+            _fill_pool = None
+            pool.shutdown(wait=False, cancel_futures=True)
+
+def _fill_in_process(content: bytes, index: dict, form_data: dict, engine: str) -> tuple[bytes, int]:
+    pool = get_fill_pool()
+    # A fill process that died (usually OOM) breaks the whole pool; replace
+    # it for the next jobs and fill this one in the calling thread
+    try:
+        future = pool.submit(fill_worker.render, content, index, form_data, engine)
+    except (BrokenProcessPool, RuntimeError, OSError):
+        _discard_fill_pool(pool)
+        return fill_worker.render(content, index, form_data, engine)
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        _discard_fill_pool(pool)
+        return fill_worker.render(content, index, form_data, engine)
+
+def render_docx(template, form_data: dict, engine: str = None) -> tuple[str, bytes]:
+    """
+    Fills a Word template with form data entirely in memory.
+
     Args:
-        template_path: Path to the Word template file
+        template: Compiled template from the template cache, or a path to
+            the Word template file
         form_data: Dictionary containing form data to fill in the template
-        
+        engine: One of FILL_ENGINES; FILL_ENGINE when not given
+
     Returns:
-        Tuple of (filled_docx_path, pdf_path)
+        Tuple of (file_name, docx_bytes)
     """
-    try:
+    engine = engine or FILL_ENGINE
+    if engine not in FILL_ENGINES:
+        raise ValueError(f"Unknown fill engine: {engine}")
+
+    if isinstance(template, template_cache.CompiledTemplate):
+        template_source = template.open()
+        index = template.index
+        base_name = template.template_id
+    else:
         # Validate input file
-        if not os.path.exists(template_path):
-            raise FileNotFoundError(f"Template file not found: {template_path}")
+        if not os.path.exists(template):
+            raise FileNotFoundError(f"Template file not found: {template}")
+        template_source = template
+        index = None
+        base_name = os.path.splitext(os.path.basename(template))[0]
 
-        # Create a temporary directory for output files
-        temp_dir = tempfile.mkdtemp()
-        base_name = os.path.splitext(os.path.basename(template_path))[0]
-        filled_docx_path = os.path.join(temp_dir, f"{base_name}_filled.docx")
-        
-        # Fill the template with form data
-        fill_word_template(template_path, filled_docx_path, form_data)
-        
-        # Convert to PDF
-        pdf_path = convert_to_pdf(filled_docx_path)
-        
-        return filled_docx_path, pdf_path
-        
-    except Exception as e:
-        print(f"Template processing failed: {str(e)}")
-        raise
+    try:
+        with metrics.stage("fill", engine=engine) as attributes:
+            if FILL_PROCESSES:
+                if isinstance(template_source, str):
+                    with open(template_source, "rb") as f:
+                        content = f.read()
+                else:
+                    content = template_source.read()
+                output, replaced = _fill_in_process(content, index, form_data, engine)
+            else:
+                buffer = io.BytesIO()
+                if engine == "ooxml":
+                    replaced = ooxml_fill.fill_package(template_source, buffer, form_data, index)
+                else:
+                    replaced = fill_word_template(template_source, buffer, form_data, index)
+                output = buffer.getvalue()
+            attributes["placeholders"] = replaced
+            attributes["output_bytes"] = len(output)
+    finally:
+        if not isinstance(template_source, str):
+            template_source.close()
+    metrics.observe_placeholders(replaced)
+    return f"{base_name}_filled.docx", output
+
+def stream_docx(template: template_cache.CompiledTemplate, form_data: dict, output_path: str) -> str:
+    """
+    Fills a compiled template straight into a file, for templates too large
+    to handle in memory. Always uses the ooxml engine in the calling thread:
+    the package is read from the spooled file (or the cached bytes) and
+    written part by part, with untouched members copied in chunks.
+
+    Args:
+        template: Compiled template from the template cache
+        form_data: Dictionary containing form data to fill in the template
+        output_path: Where to write the filled DOCX
+
+    Returns:
+        output_path
+    """
+    with metrics.stage("fill", engine="ooxml", streaming=True) as attributes:
+        with template.open() as source:
+            replaced = ooxml_fill.fill_package(source, output_path, form_data, template.index)
+        attributes["placeholders"] = replaced
+        attributes["output_bytes"] = os.path.getsize(output_path)
+    metrics.observe_placeholders(replaced)
+    return output_path
 
-def fill_word_template(template_path: str, output_path: str, form_data: dict):
+def fill_word_template(template_path, output_path: str, form_data: dict, index: dict = None):
     """
     Fills a Word template with form data by replacing parameter placeholders
     while preserving all formatting.
     
     Args:
-        template_path: Path to the Word template file
-        output_path: Path to save the filled document
+        template_path: Path or file-like object of the Word template
+        output_path: Path or file-like object to save the filled document
         form_data: Dictionary containing form data to fill in the template
+        index: Optional placeholder location index; when given only the
+            indexed paragraphs are visited
+
+    Returns:
+        Number of placeholders replaced
     """
     try:
         doc = Document(template_path)
-        
-        def replace_text_in_paragraph(paragraph, key, value):
-            """Replace text in a paragraph while preserving formatting"""
-            if f"{{{{{key}}}}}" in paragraph.text:
-                for run in paragraph.runs:
-                    if f"{{{{{key}}}}}" in run.text:
-                        run.text = run.text.replace(f"{{{{{key}}}}}", value)
-        
-        # Replace parameters in paragraphs
-        for paragraph in doc.paragraphs:
-            for key, field_data in form_data.items():
-                # Extract the actual value from the field data object
-                value = str(field_data.get('value', '')) if isinstance(field_data, dict) else str(field_data)
-                replace_text_in_paragraph(paragraph, key, value)
-        
-        # Replace parameters in tables
-        for table in doc.tables:
-            for row in table.rows:
-                for cell in row.cells:
-                    for paragraph in cell.paragraphs:
-                        for key, field_data in form_data.items():
-                            # Extract the actual value from the field data object
-                            value = str(field_data.get('value', '')) if isinstance(field_data, dict) else str(field_data)
-                            replace_text_in_paragraph(paragraph, key, value)
+
+        # Single pass over every paragraph of the body, headers, footers,
+        # text boxes and nested tables
+        replaced = placeholder_engine.fill_document(doc, form_data, index)
+        print(f"Replaced {replaced} placeholders")
 
         doc.save(output_path)
-        print(f"Successfully filled template: {output_path}")
+        print(f"Successfully filled template: {output_path if isinstance(output_path, str) else 'in memory'}")
+        return replaced
         
     except Exception as e:
         print(f"Failed to fill Word template: {str(e)}")
         raise
 
-def convert_to_pdf(docx_path: str) -> str:
+def convert_to_pdf(docx_path: str, filter_data: dict = None) -> str:
+    """
+    Converts a DOCX file to PDF on a warm worker from the LibreOffice pool.
+
+    Args:
+        docx_path: Path to the DOCX file to convert
+        filter_data: PDF export FilterData (see pdf_export); LibreOffice's
+            defaults when not given
+
+    Returns:
+        Path to the generated PDF, next to the input file
+    """
     try:
         # Validate input file
         if not os.path.exists(docx_path):
             raise FileNotFoundError(f"Input file not found: {docx_path}")
 
-        # Find LibreOffice binary
-        libreoffice_path = shutil.which("libreoffice") or shutil.which("soffice")
-        if not libreoffice_path:
-            raise RuntimeError("LibreOffice not found in PATH")
-
         # Prepare output directory
         output_dir = os.path.dirname(docx_path)
         output_pdf = os.path.splitext(docx_path)[0] + ".pdf"
 
-        # Run LibreOffice in headless mode
-        cmd = [
-            libreoffice_path,
-            "--headless",
-            "--convert-to", "pdf",
-            "--outdir", output_dir,
-            docx_path
-        ]
-        
-        print(f"Running command: {' '.join(cmd)}")
-        result = subprocess.run(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            check=True
-        )
-        
-        # Log LibreOffice output
-        if result.stdout:
-            print(f"LibreOffice stdout: {result.stdout}")
-        if result.stderr:
-            print(f"LibreOffice stderr: {result.stderr}")
+        with metrics.stage("convert", input_bytes=os.path.getsize(docx_path)) as attributes:
+            libreoffice_pool.get_pool().convert(docx_path, output_dir, filter_data=filter_data)
+            if os.path.exists(output_pdf):
+                attributes["output_bytes"] = os.path.getsize(output_pdf)
 
         if not os.path.exists(output_pdf):
             raise RuntimeError(f"PDF not generated at {output_pdf}")
@@ -135,4 +235,67 @@ def convert_to_pdf(docx_path: str) -> str:
         raise
     except Exception as e:
         print(f"PDF conversion failed: {str(e)}")
-        raise
\ No newline at end of file
+        raise
+
+def convert_many_to_pdf(docx_paths: list, filter_data: dict = None) -> list:
+    """
+    Converts several DOCX files from the same directory to PDF in a single
+    LibreOffice invocation on one pool worker.
+
+    Args:
+        docx_paths: Paths to the DOCX files to convert
+        filter_data: PDF export FilterData (see pdf_export)
+
+    Returns:
+        Paths to the generated PDFs, in the same order
+    """
+    try:
+        output_dirs = {os.path.dirname(path) for path in docx_paths}
+        if len(output_dirs) != 1:
+            raise ValueError("All documents converted together must share a directory")
+        output_dir = output_dirs.pop()
+        output_pdfs = [os.path.splitext(path)[0] + ".pdf" for path in docx_paths]
+
+        input_bytes = sum(os.path.getsize(path) for path in docx_paths)
+        with metrics.stage("convert", input_bytes=input_bytes, documents=len(docx_paths)) as attributes:
+            libreoffice_pool.get_pool().convert_many(docx_paths, output_dir, filter_data=filter_data)
+            attributes["output_bytes"] = sum(
+                os.path.getsize(path) for path in output_pdfs if os.path.exists(path)
+            )
+
+        missing = [path for path in output_pdfs if not os.path.exists(path)]
+        if missing:
+            raise RuntimeError(f"PDF not generated for {len(missing)} documents, e.g. {missing[0]}")
+
+        print(f"Successfully converted {len(output_pdfs)} documents to PDF")
+        return output_pdfs
+
+    except subprocess.CalledProcessError as e:
+        print(f"LibreOffice failed with code {e.returncode}: {e.stderr}")
+        raise
+    except Exception as e:
+        print(f"PDF conversion failed: {str(e)}")
+        raise
+
+def merge_pdfs(pdf_paths: list, output_path: str) -> str:
+    """
+    Concatenates PDFs into a single file, in order.
+
+    Args:
+        pdf_paths: Paths of the PDFs to combine
+        output_path: Path of the combined PDF
+
+    Returns:
+        The output path
+    """
+    from pypdf import PdfWriter
+
+    with metrics.stage("merge_pdf", documents=len(pdf_paths)) as attributes:
+        writer = PdfWriter()
+        for path in pdf_paths:
+            writer.append(path)
+        with open(output_path, "wb") as f:
+            writer.write(f)
+        writer.close()
+        attributes["output_bytes"] = os.path.getsize(output_path)
+    return output_path
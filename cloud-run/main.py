@@ -1,14 +1,57 @@
-from flask import Flask, request, jsonify
+# First, so the import of everything below is timed
+import startup
+from flask import Flask, Response, request, jsonify
 import firestore_utils
+import job_queue
+import libreoffice_pool
 import libreoffice_utils
+import memory_budget
+import metrics
+import pdf_export
+import pipeline
 import logging
 import os
-from datetime import datetime
-from google.events.cloud.firestore import DocumentEventData
+import uuid
 
 app = Flask(__name__)
 logger = logging.getLogger(__name__)
 
+FORMATS_ERROR = "formats must be a non-empty list of pdf and docx"
+FILL_ENGINE_ERROR = f"fillEngine must be one of {', '.join(libreoffice_utils.FILL_ENGINES)}"
+
+
+def _valid_fill_engine(fill_engine) -> bool:
+    """fillEngine is optional; when given it names one of the fill engines"""
+    return not fill_engine or (isinstance(fill_engine, str) and fill_engine in libreoffice_utils.FILL_ENGINES)
+
+
+def _valid_formats(formats) -> bool:
+    """formats is optional; when given it names the file types to produce"""
+    if formats is None:
+        return True
+    return (
+        isinstance(formats, list) and bool(formats)
+        and all(isinstance(file_type, str) for file_type in formats)
+        and set(formats) <= {"pdf", "docx"}
+    )
+
+
+def _output_error(payload: dict) -> str:
+    """Checks a job's formats, pdfOptions and deferPdf; returns the error, if any"""
+    if not _valid_formats(payload.get("formats")):
+        return FORMATS_ERROR
+    defer_pdf = payload.get("deferPdf")
+    if defer_pdf is not None and not isinstance(defer_pdf, bool):
+        return "deferPdf must be true or false"
+    if defer_pdf and "pdf" not in (payload.get("formats") or ["pdf"]):
+        return "deferPdf needs pdf in formats"
+    try:
+        pdf_export.filter_data(payload.get("pdfOptions"))
+    except ValueError as e:
+        return str(e)
+    return None
+
+
 @app.route("/", methods=["POST"])
 def handle_firestore_event():
     print("Received event:", request.json)
@@ -26,89 +69,189 @@ def handle_firestore_event():
         response.headers.add('Access-Control-Allow-Origin', 'http://localhost:5173')
         return response, 400
 
-    try:
-        job_id = doc_data.get("jobId")
-        if not job_id:
-            response = jsonify({"error": "jobId is required"})
-            response.headers.add('Access-Control-Allow-Origin', 'http://localhost:5173')
-            return response, 400
-        
-        firestore_utils.update_document_job(job_id, "pending")
-        
-        form_id = doc_data.get("formId")
-        if not form_id:
-            raise ValueError("formId is required in payload")
-
-        logger.info(f"Started processing document job {job_id} for form: {form_id}")
-
-        # Fetch form data and template
-        form_data = firestore_utils.fetch_form_data(form_id)
-        if not form_data:
-            raise ValueError(f"Form {form_id} not found")
-            
-        template_path = firestore_utils.download_template(form_data)
-        
-        # Process document
-        filled_docx_path, output_pdf = libreoffice_utils.fill_template_and_convert(
-            template_path,
-            form_data.get("formData", {})
-        )
+    job_id = doc_data.get("jobId")
+    if not job_id:
+        response = jsonify({"error": "jobId is required"})
+        response.headers.add('Access-Control-Allow-Origin', 'http://localhost:5173')
+        return response, 400
 
-        # Verify office ID
-        office_id = form_data.get("officeId")
-        if not office_id:
-            raise ValueError("officeId is required in form data")
+    fill_engine = doc_data.get("fillEngine")
+    if not _valid_fill_engine(fill_engine):
+        response = jsonify({"error": FILL_ENGINE_ERROR})
+        response.headers.add('Access-Control-Allow-Origin', 'http://localhost:5173')
+        return response, 400
+    output_error = _output_error(doc_data)
+    if output_error:
+        response = jsonify({"error": output_error})
+        response.headers.add('Access-Control-Allow-Origin', 'http://localhost:5173')
+        return response, 400
+    options = {"fill_engine": fill_engine} if fill_engine else {}
+    if doc_data.get("formats"):
+        options["formats"] = tuple(doc_data["formats"])
+    if doc_data.get("pdfOptions"):
+        options["pdf_options"] = doc_data["pdfOptions"]
+    if doc_data.get("deferPdf"):
+        options["defer_pdf"] = True
+    # Lets the form and its template be read in one round-trip
+    if doc_data.get("templateId"):
+        options["template_id"] = doc_data["templateId"]
 
-        # Upload results
-        pdf_path, pdf_url = firestore_utils.upload_result(
-            form_id, output_pdf, "pdf", office_id
-        )
-        docx_path, docx_url = firestore_utils.upload_result(
-            form_id, filled_docx_path, "docx", office_id
-        )
+    if job_queue.ASYNC_JOBS:
+        # Jobs are scheduled fairly per office; read the form to find it
+        # unless the caller says, and hand the data on to the job
+        office_id = doc_data.get("officeId")
+        if not office_id and doc_data.get("formId"):
+            try:
+                form_data = firestore_utils.fetch_form_data(doc_data["formId"])
+            except Exception as e:
+                # The job still runs and reports its own error; it is only
+                # scheduled under the unknown office
+                logger.warning(f"Could not read form {doc_data['formId']} to schedule job {job_id}: {str(e)}")
+                metrics.observe_office_lookup_failure()
+                form_data = None
+            if form_data:
+                office_id = form_data.get("officeId")
+                options["form_data"] = form_data
 
-        # Update form with generated files
-        firestore_utils.update_document_urls(form_id, pdf_path, docx_path)
-        
-        # Mark job as completed
-        firestore_utils.update_document_job(job_id, "completed")
-        
-        # Clean up temporary files
+        # Accept right away; progress is reported on the document_jobs status
         try:
-            os.unlink(template_path)
-            os.unlink(filled_docx_path)
-            os.unlink(output_pdf)
-        except Exception as cleanup_error:
-            logger.warning(f"Error cleaning up temp files: {cleanup_error}")
+            job_queue.get_queue().submit(job_id, doc_data.get("formId"), options, office_id)
+        except job_queue.QueueFull as e:
+            response = jsonify({"error": str(e), "jobId": job_id})
+            response.headers.add('Access-Control-Allow-Origin', 'http://localhost:5173')
+            response.headers.add('Retry-After', '30')
+            return response, 429
 
-        response = jsonify({
-            "status": "success",
-            "jobId": job_id,
-            "formId": form_id,
-            "pdf_url": pdf_url,
-            "docx_url": docx_url
-        })
+        response = jsonify({"status": "accepted", "jobId": job_id})
+        response.headers.add('Access-Control-Allow-Origin', 'http://localhost:5173')
+        return response, 202
+
+    try:
+        result = pipeline.process_job(job_id, doc_data.get("formId"), **options)
+        response = jsonify(result)
         response.headers.add('Access-Control-Allow-Origin', 'http://localhost:5173')
         return response
 
     except Exception as e:
-        logger.error(f"Failed to process document job: {str(e)}", exc_info=True)
-        
-        # Update job status with error if we have jobId
-        if 'job_id' in locals():
-            firestore_utils.update_document_job(
-                job_id, 
-                "failed", 
-                str(e)[:500]  # Truncate long error messages
-            )
-        
         response = jsonify({
             "error": "Document processing failed",
-            "jobId": job_id if 'job_id' in locals() else None,
+            "jobId": job_id,
             "details": str(e)
         })
         response.headers.add('Access-Control-Allow-Origin', 'http://localhost:5173')
         return response, 500
 
+@app.route("/batch", methods=["POST"])
+def handle_batch():
+    """
+    Processes a list of document jobs in one request.
+
+    Expects {"jobs": [{"jobId": ..., "formId": ...}, ...]} and streams one
+    JSON line per job as it finishes. A job may pick its "fillEngine", the
+    "formats" to produce, "pdfOptions" and "deferPdf" as for a single job.
+    """
+    payload = request.get_json(silent=True) or {}
+    jobs = payload.get("jobs")
+    if not jobs or not isinstance(jobs, list):
+        return jsonify({"error": "jobs list is required"}), 400
+
+    invalid = [job for job in jobs if not isinstance(job, dict) or not job.get("jobId") or not job.get("formId")]
+    if invalid:
+        return jsonify({"error": "Every job needs a jobId and a formId", "invalid": invalid[:10]}), 400
+
+    for job in jobs:
+        if not _valid_fill_engine(job.get("fillEngine")):
+            return jsonify({"error": FILL_ENGINE_ERROR, "jobId": job["jobId"]}), 400
+        output_error = _output_error(job)
+        if output_error:
+            return jsonify({"error": output_error, "jobId": job["jobId"]}), 400
+
+    print(f"Received batch of {len(jobs)} jobs")
+    # Jobs take their office's slots in the job queue, like queued jobs
+    return Response(
+        pipeline.process_batch(jobs, job_queue.get_queue().hold), mimetype="application/x-ndjson"
+    )
+
+@app.route("/merge", methods=["POST"])
+def handle_merge():
+    """
+    Generates many forms from their templates in bulk.
+
+    Expects {"formIds": [...], "combine": true, "mergeId": optional,
+    "fillEngine": optional, "pdfOptions": optional}. With combine (the default) one PDF per template
+    holding every form, in order, is produced; otherwise each form gets its
+    own files as with a regular job.
+    """
+    payload = request.get_json(silent=True) or {}
+    form_ids = payload.get("formIds")
+    if not form_ids or not isinstance(form_ids, list) or not all(isinstance(f, str) and f for f in form_ids):
+        return jsonify({"error": "formIds list is required"}), 400
+
+    fill_engine = payload.get("fillEngine")
+    if not _valid_fill_engine(fill_engine):
+        return jsonify({"error": FILL_ENGINE_ERROR}), 400
+
+    merge_id = str(payload.get("mergeId") or uuid.uuid4().hex)
+    if "/" in merge_id:
+        return jsonify({"error": "mergeId cannot contain '/'"}), 400
+
+    print(f"Received merge {merge_id} of {len(form_ids)} forms")
+    try:
+        result = pipeline.process_merge(
+            form_ids, merge_id, bool(payload.get("combine", True)), fill_engine, payload.get("pdfOptions"),
+            job_queue.get_queue().hold
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e), "mergeId": merge_id}), 400
+    except Exception as e:
+        logger.error(f"Merge {merge_id} failed: {str(e)}", exc_info=True)
+        return jsonify({"error": "Merge failed", "mergeId": merge_id, "details": str(e)}), 500
+    return jsonify(result), 200 if result["results"] else 500
+
+@app.route("/pdf", methods=["POST"])
+def handle_pdf():
+    """
+    Returns the URL of a form's PDF, converting it first when its job
+    deferred it with "deferPdf".
+
+    Expects {"formId": ...}.
+    """
+    payload = request.get_json(silent=True) or {}
+    form_id = payload.get("formId")
+    if not form_id or not isinstance(form_id, str):
+        return jsonify({"error": "formId is required"}), 400
+
+    try:
+        result = pipeline.generate_deferred_pdf(form_id)
+    except ValueError as e:
+        return jsonify({"error": str(e), "formId": form_id}), 404
+    except Exception as e:
+        logger.error(f"PDF for form {form_id} failed: {str(e)}", exc_info=True)
+        return jsonify({"error": "PDF conversion failed", "formId": form_id, "details": str(e)}), 500
+    return jsonify(result)
+
+@app.route("/healthz", methods=["GET"])
+def health_check():
+    pool_status = libreoffice_pool.get_pool().health_check()
+    status_code = 200 if pool_status["healthy"] else 503
+    return jsonify({
+        "libreoffice": pool_status,
+        "jobs": job_queue.get_queue().stats(),
+        "memory": memory_budget.get_budget().stats(),
+        "startup": startup.status()
+    }), status_code
+
+@app.route("/readyz", methods=["GET"])
+def readiness_check():
+    """Startup probe: 503 until the instance has finished warming up"""
+    return jsonify(startup.status()), 200 if startup.is_ready() else 503
+
+@app.route("/metrics", methods=["GET"])
+def export_metrics():
+    body, content_type = metrics.render()
+    return Response(body, mimetype=content_type)
+
+startup.begin()
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
\ No newline at end of file
+    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
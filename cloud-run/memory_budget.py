@@ -0,0 +1,211 @@
+"""
+Memory accounting for document jobs.
+
+Before a job fills its template it reserves an estimate of the memory it
+will hold in this process: template and output buffers plus the parsed XML
+of the parts it rewrites. Reservations come out of one budget sized for
+what the instance has left after the LibreOffice and fill workers, and a
+job that does not fit waits, in arrival order, until running jobs release
+enough.
+
+A job whose in-memory estimate is above the per-job budget runs in
+streaming mode instead: the template is read from its spooled file and the
+filled package is written part by part straight into the job workspace.
+Its streaming estimate may still be above the per-job budget; it is
+reserved like any other, and a job larger than the whole budget runs alone.
+"""
+import logging
+import os
+import resource
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import capacity
+import libreoffice_pool
+import metrics
+import placeholder_engine
+import resilience
+
+logger = logging.getLogger(__name__)
+
+# Memory all running jobs may reserve together; "auto" is what the instance
+# has left after the LibreOffice and fill workers
+MEMORY_BUDGET_MB = capacity.size_from_env(
+    "MEMORY_BUDGET_MB",
+    capacity.job_memory_mb(libreoffice_pool.POOL_SIZE, capacity.fill_processes()),
+)
+# Jobs whose in-memory estimate is above this are streamed
+JOB_MEMORY_BUDGET_MB = int(os.getenv("JOB_MEMORY_BUDGET_MB", "256"))
+# "auto" streams jobs that would not fit JOB_MEMORY_BUDGET_MB in memory,
+# "always" streams every job, "never" keeps the in-memory path
+STREAMING_MODE = os.getenv("STREAMING_MODE", "auto").lower()
+MEMORY_WAIT_TIMEOUT_SECONDS = float(os.getenv("MEMORY_WAIT_TIMEOUT_SECONDS", "600"))
+# Resident size of a parsed lxml tree relative to the XML it was parsed from
+XML_DOM_FACTOR = int(os.getenv("XML_DOM_FACTOR", "10"))
+# Read buffers used while streaming a package
+STREAM_BUFFER_BYTES = 4 * 1024 * 1024
+
+MB = 1024 * 1024
+
+
+class MemoryBudgetExceeded(RuntimeError):
+    """Raised when a job waited too long for its memory."""
+
+
+def estimate(template, engine: str, streaming: bool) -> int:
+    """
+    Estimates the bytes a job holds in this process while filling template.
+
+    Args:
+        template: Compiled template (see template_cache)
+        engine: Fill engine the job uses
+        streaming: Whether the job runs in streaming mode
+
+    Returns:
+        Estimated peak bytes
+    """
+    members = template.members
+    largest_part = max(
+        (size for name, size in members.items() if placeholder_engine.is_template_part(name)),
+        default=0,
+    )
+    # One parsed part, its text and its serialized replacement
+    part_bytes = largest_part * (XML_DOM_FACTOR + 2)
+    if streaming:
+        return part_bytes + STREAM_BUFFER_BYTES
+
+    # Template bytes, the filled package in a buffer and the bytes taken from it
+    package_bytes = 3 * template.package_size
+    if engine == "docx":
+        # python-docx loads every part and parses every XML part
+        xml_bytes = sum(size for name, size in members.items() if name.endswith((".xml", ".rels")))
+        return package_bytes + sum(members.values()) + xml_bytes * XML_DOM_FACTOR
+    return package_bytes + part_bytes
+
+
+def use_streaming(template, engine: str) -> bool:
+    """Decides whether a job filling template should run in streaming mode"""
+    if STREAMING_MODE == "always":
+        return True
+    if STREAMING_MODE == "never":
+        return False
+    return template.spooled or estimate(template, engine, False) > JOB_MEMORY_BUDGET_MB * MB
+
+
+def rss_bytes() -> int:
+    """Current resident set size of this process"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def peak_rss_bytes() -> int:
+    """Highest resident set size this process has reached"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryBudget:
+    """
+    Counting budget of bytes shared by the jobs running in this process.
+
+    Waiting jobs are admitted strictly in arrival order, so a large job is
+    not starved by a stream of small ones. A job larger than the whole
+    budget runs once it has the budget to itself.
+    """
+
+    def __init__(self, total_bytes: int = MEMORY_BUDGET_MB * MB,
+                 job_bytes: int = JOB_MEMORY_BUDGET_MB * MB,
+                 timeout: float = MEMORY_WAIT_TIMEOUT_SECONDS):
+        self.total_bytes = total_bytes
+        self.job_bytes = job_bytes
+        self.timeout = timeout
+        self._reserved = 0
+        self._running = 0
+        self._waiting = deque()
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, size: int, **attributes):
+        """
+        Holds size bytes of the budget for the duration of the block.
+
+        The time spent waiting is recorded as the "memory_wait" stage; the
+        block itself as "memory_held", together with the reservation and
+        the process peak RSS while it ran.
+        """
+        with metrics.stage("memory_wait", reserved_bytes=size):
+            self._acquire(size)
+        try:
+            with metrics.stage("memory_held", reserved_bytes=size, **attributes) as held:
+                peak_before = peak_rss_bytes()
+                rss_before = rss_bytes()
+                try:
+                    yield
+                finally:
+                    peak_after = peak_rss_bytes()
+                    # The process only reached a new high if ru_maxrss moved
+                    peak = peak_after if peak_after > peak_before else max(rss_before, rss_bytes())
+                    held["peak_rss_bytes"] = peak
+                    metrics.observe_job_memory(size, peak)
+        finally:
+            self._release(size)
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "budget_bytes": self.total_bytes,
+                "job_budget_bytes": self.job_bytes,
+                "reserved_bytes": self._reserved,
+                "running": self._running,
+                "waiting": len(self._waiting),
+            }
+
+    def _acquire(self, size: int) -> None:
+        ticket = object()
+        now = time.monotonic()
+        deadline = now + self.timeout
+        # Never wait past the job's own deadline
+        job_left = resilience.remaining()
+        job_deadline = None if job_left is None else now + job_left
+        with self._condition:
+            self._waiting.append(ticket)
+            try:
+                while not (self._waiting[0] is ticket and self._fits(size)):
+                    now = time.monotonic()
+                    if job_deadline is not None and job_deadline <= min(now, deadline):
+                        raise resilience.DeadlineExceeded(
+                            f"Job deadline exceeded waiting for {size // MB} MB of memory"
+                        )
+                    if deadline <= now:
+                        raise MemoryBudgetExceeded(
+                            f"Timed out after {self.timeout:.0f}s waiting for {size // MB} MB of memory"
+                        )
+                    self._condition.wait(min(deadline, job_deadline or deadline) - now)
+            finally:
+                self._waiting.remove(ticket)
+                # The next in line may fit now, or may have become the head
+                self._condition.notify_all()
+            self._reserved += size
+            self._running += 1
+            metrics.observe_memory_reserved(self._reserved)
+
+    def _fits(self, size: int) -> bool:
+        return self._running == 0 or self._reserved + size <= self.total_bytes
+
+    def _release(self, size: int) -> None:
+        with self._condition:
+            self._reserved -= size
+            self._running -= 1
+            metrics.observe_memory_reserved(self._reserved)
+            self._condition.notify_all()
+
+
+_budget = MemoryBudget()
+
+
+def get_budget() -> MemoryBudget:
+    return _budget
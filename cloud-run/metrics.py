@@ -0,0 +1,224 @@
+import contextvars
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager, nullcontext
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+logger = logging.getLogger(__name__)
+
+# Traces are exported over OTLP only when an endpoint is configured
+OTEL_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "")
+SERVICE_NAME = os.getenv("K_SERVICE", "doc-generator")
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(11))  # 1 KiB .. 1 GiB
+COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+if prometheus_client:
+    STAGE_SECONDS = prometheus_client.Histogram(
+        "docgen_stage_seconds", "Time spent in each document generation stage",
+        ["stage"], buckets=SECONDS_BUCKETS,
+    )
+    STAGE_ERRORS = prometheus_client.Counter(
+        "docgen_stage_errors_total", "Document generation stages that raised", ["stage"],
+    )
+    SIZE_BYTES = prometheus_client.Histogram(
+        "docgen_size_bytes", "Size of templates and generated files",
+        ["kind"], buckets=BYTES_BUCKETS,
+    )
+    PLACEHOLDERS = prometheus_client.Histogram(
+        "docgen_placeholders", "Placeholders replaced per document", buckets=COUNT_BUCKETS,
+    )
+    QUEUE_DEPTH = prometheus_client.Gauge(
+        "docgen_queue_depth", "Jobs waiting in the generation queue", ["office"],
+    )
+    QUEUE_RUNNING = prometheus_client.Gauge(
+        "docgen_queue_running", "Jobs running from the generation queue", ["office"],
+    )
+    QUEUE_WAIT_SECONDS = prometheus_client.Histogram(
+        "docgen_queue_wait_seconds", "Time jobs wait in the queue before they start",
+        buckets=SECONDS_BUCKETS,
+    )
+    JOB_MEMORY_BYTES = prometheus_client.Histogram(
+        "docgen_job_memory_bytes",
+        "Memory reserved by each job, and the process peak RSS while it ran",
+        ["kind"], buckets=BYTES_BUCKETS,
+    )
+    MEMORY_RESERVED_BYTES = prometheus_client.Gauge(
+        "docgen_memory_reserved_bytes", "Memory currently reserved by running jobs",
+    )
+    STARTUP_SECONDS = prometheus_client.Gauge(
+        "docgen_startup_seconds", "Time each startup phase took on this instance", ["phase"],
+    )
+    RETRIES = prometheus_client.Counter(
+        "docgen_retries_total", "Calls and jobs run again after a transient failure", ["stage"],
+    )
+    OFFICE_LOOKUP_FAILURES = prometheus_client.Counter(
+        "docgen_office_lookup_failures_total",
+        "Jobs scheduled under the unknown office because their form could not be read",
+    )
+    OVERLAP_SAVED_SECONDS = prometheus_client.Histogram(
+        "docgen_overlap_saved_seconds",
+        "Time saved by uploading the DOCX while the PDF converts",
+        buckets=SECONDS_BUCKETS,
+    )
+
+
+def _init_tracer():
+    if not OTEL_ENDPOINT:
+        return None
+    try:
+        from opentelemetry import trace
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:
+        logger.warning("OTEL_EXPORTER_OTLP_ENDPOINT is set but OpenTelemetry is not installed")
+        return None
+
+    provider = TracerProvider(resource=Resource.create({"service.name": SERVICE_NAME}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    return trace.get_tracer(__name__)
+
+
+_tracer = _init_tracer()
+# Stage timings of the job running in the current context
+_job_trace = contextvars.ContextVar("job_trace", default=None)
+
+
+@contextmanager
+def stage(name: str, **attributes):
+    """
+    Times one stage of the generation pipeline.
+
+    The duration goes to the docgen_stage_seconds histogram, to the current
+    job's timing log line and, when configured, to an OpenTelemetry span.
+    Callers can add attributes known only at the end, such as output size,
+    to the yielded dictionary.
+    """
+    span_context = _tracer.start_as_current_span(name) if _tracer else nullcontext()
+    started = time.perf_counter()
+    failed = False
+    with span_context as span:
+        try:
+            yield attributes
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            if prometheus_client:
+                STAGE_SECONDS.labels(stage=name).observe(elapsed)
+                if failed:
+                    STAGE_ERRORS.labels(stage=name).inc()
+            if span is not None:
+                # OpenTelemetry rejects None, e.g. a job without an officeId
+                for key, value in attributes.items():
+                    if value is not None:
+                        span.set_attribute(f"docgen.{key}", value)
+            job_trace = _job_trace.get()
+            if job_trace is not None:
+                entry = {"stage": name, "seconds": round(elapsed, 4), **attributes}
+                if failed:
+                    entry["error"] = True
+                job_trace["stages"].append(entry)
+
+
+@contextmanager
+def job_trace(**fields):
+    """Collects the stages of one job and logs them as a single JSON line"""
+    trace = {"fields": fields, "stages": []}
+    with stage("job", **fields):
+        token = _job_trace.set(trace)
+        started = time.perf_counter()
+        try:
+            yield trace
+        finally:
+            _job_trace.reset(token)
+            logger.info(json.dumps({
+                "event": "job_timing",
+                **fields,
+                "total_seconds": round(time.perf_counter() - started, 4),
+                "retries": trace.get("retries", 0),
+                "stages": trace["stages"],
+            }))
+
+
+def in_current_context(fn):
+    """
+    Wraps fn so it runs with the caller's job trace when submitted to a
+    thread pool. Each call gets its own copy of the context, so the wrapper
+    can run on several threads at once.
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+
+def observe_size(kind: str, size: int) -> None:
+    if prometheus_client:
+        SIZE_BYTES.labels(kind=kind).observe(size)
+
+
+def observe_placeholders(count: int) -> None:
+    if prometheus_client:
+        PLACEHOLDERS.observe(count)
+
+
+def observe_overlap_saved(seconds: float) -> None:
+    if prometheus_client:
+        OVERLAP_SAVED_SECONDS.observe(seconds)
+
+
+def observe_queue(office: str, queued: int, running: int) -> None:
+    if prometheus_client:
+        QUEUE_DEPTH.labels(office=office).set(queued)
+        QUEUE_RUNNING.labels(office=office).set(running)
+
+
+def observe_office_lookup_failure() -> None:
+    if prometheus_client:
+        OFFICE_LOOKUP_FAILURES.inc()
+
+
+def observe_queue_wait(seconds: float) -> None:
+    if prometheus_client:
+        QUEUE_WAIT_SECONDS.observe(seconds)
+
+
+def observe_job_memory(reserved: int, peak_rss: int) -> None:
+    if prometheus_client:
+        JOB_MEMORY_BYTES.labels(kind="reserved").observe(reserved)
+        JOB_MEMORY_BYTES.labels(kind="peak_rss").observe(peak_rss)
+
+
+def observe_memory_reserved(reserved: int) -> None:
+    if prometheus_client:
+        MEMORY_RESERVED_BYTES.set(reserved)
+
+
+def observe_startup(phase: str, seconds: float) -> None:
+    if prometheus_client:
+        STARTUP_SECONDS.labels(phase=phase).set(seconds)
+
+
+def observe_retry(stage: str) -> None:
+    if prometheus_client:
+        RETRIES.labels(stage=stage).inc()
+    job_trace = _job_trace.get()
+    if job_trace is not None:
+        job_trace["retries"] = job_trace.get("retries", 0) + 1
+
+
+def render() -> tuple[bytes, str]:
+    """Returns the Prometheus exposition body and its content type"""
+    if not prometheus_client:
+        return b"# prometheus_client is not installed\n", "text/plain"
+    return prometheus_client.generate_latest(), prometheus_client.CONTENT_TYPE_LATEST
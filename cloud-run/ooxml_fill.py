@@ -0,0 +1,155 @@
+import struct
+import zipfile
+import zlib
+
+from lxml import etree
+
+import placeholder_engine
+
+# Same settings python-docx parses parts with, so filled parts serialize to
+# the same bytes as with the python-docx engine
+_parser = etree.XMLParser(remove_blank_text=True, resolve_entities=False)
+
+_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+_CENTRAL_HEADER = struct.Struct("<4s6H3L5H2L")
+_END_RECORD = struct.Struct("<4s4H2LH")
+_UTF8_FLAG = 0x800
+# Sizes live in the local header we write, never in a trailing data descriptor
+_DATA_DESCRIPTOR_FLAG = 0x08
+_ZIP64_LIMIT = 0xFFFFFFFF
+# Untouched members are copied in pieces of this size, never read whole
+_COPY_CHUNK_BYTES = 1024 * 1024
+
+
+def fill_package(template, output, form_data: dict, index: dict = None) -> int:
+    """
+    Fills a .docx template working directly on the zip package.
+
+    Only the XML parts that hold placeholders are parsed and rewritten;
+    every other member (images, fonts, styles, ...) is copied with its
+    compressed bytes untouched, so nothing is inflated or recompressed.
+    Parts are filled one at a time as they are written, so memory use is
+    bounded by the largest template part rather than by the package.
+
+    Args:
+        template: Path or seekable file-like object of the template
+        output: Path or file-like object to write the filled document to
+        form_data: Dictionary containing form data to fill in the template
+        index: Optional placeholder location index (see template_cache);
+            when given only the indexed parts and paragraphs are visited
+
+    Returns:
+        Number of placeholders replaced
+    """
+    values = placeholder_engine.normalize_values(form_data)
+    replaced = 0
+
+    def rewrite(info: zipfile.ZipInfo) -> bytes:
+        nonlocal replaced
+        if not placeholder_engine.is_template_part(info.filename):
+            return None
+        ordinals = None
+        if index is not None:
+            located = index["parts"].get(info.filename)
+            if not located:
+                return None
+            ordinals = located["paragraphs"]
+        root = etree.fromstring(package.read(info), _parser)
+        count = placeholder_engine.fill_part(root, values, ordinals)
+        if not count:
+            return None
+        replaced += count
+        return etree.tostring(root, encoding="UTF-8", standalone=True)
+
+    with zipfile.ZipFile(template) as package:
+        if isinstance(output, str):
+            with open(output, "wb") as f:
+                copy_package(package, f, rewrite)
+        else:
+            copy_package(package, output, rewrite)
+    return replaced
+
+
+def copy_package(package: zipfile.ZipFile, output, rewrite) -> None:
+    """
+    Writes the members of package to output in their original order,
+    deflating the members rewrite(info) returns new bytes for and copying
+    the rest as raw compressed bytes.
+    """
+    start = output.tell()
+    entries = []
+    for info in package.infolist():
+        if info.file_size > _ZIP64_LIMIT or info.compress_size > _ZIP64_LIMIT:
+            raise ValueError(f"Zip64 member {info.filename} is not supported")
+        if info.flag_bits & 0x1:
+            raise ValueError(f"Encrypted member {info.filename} is not supported")
+
+        data = rewrite(info)
+        if data is not None:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            raw = compressor.compress(data) + compressor.flush()
+            method, crc, size, compressed = zipfile.ZIP_DEFLATED, zlib.crc32(data), len(data), len(raw)
+            del data
+        else:
+            raw = None
+            method, crc, size, compressed = info.compress_type, info.CRC, info.file_size, info.compress_size
+
+        name = info.filename.encode("utf-8")
+        flags = info.flag_bits & ~_DATA_DESCRIPTOR_FLAG
+        if not name.isascii():
+            flags |= _UTF8_FLAG
+        dos_time, dos_date = _dos_timestamp(info.date_time)
+        version = max(info.extract_version, 20)
+
+        offset = output.tell() - start
+        output.write(_LOCAL_HEADER.pack(
+            b"PK\x03\x04", version, flags, method, dos_time, dos_date,
+            crc, compressed, size, len(name), 0
+        ))
+        output.write(name)
+        if raw is not None:
+            output.write(raw)
+        else:
+            _copy_raw(package, info, output)
+        entries.append((info, name, flags, method, dos_time, dos_date, crc, compressed, size, offset, version))
+
+    directory_offset = output.tell() - start
+    for info, name, flags, method, dos_time, dos_date, crc, compressed, size, offset, version in entries:
+        output.write(_CENTRAL_HEADER.pack(
+            b"PK\x01\x02", info.create_version, version, flags, method, dos_time, dos_date,
+            crc, compressed, size, len(name), 0, 0, 0, info.internal_attr, info.external_attr,
+            offset
+        ))
+        output.write(name)
+    directory_size = output.tell() - start - directory_offset
+
+    if len(entries) > 0xFFFF or directory_offset > _ZIP64_LIMIT:
+        raise ValueError("Package too large to write without Zip64")
+    output.write(_END_RECORD.pack(
+        b"PK\x05\x06", 0, 0, len(entries), len(entries), directory_size, directory_offset, 0
+    ))
+
+
+def _copy_raw(package: zipfile.ZipFile, info: zipfile.ZipInfo, output) -> None:
+    """Copies a member's data exactly as stored, without decompressing it"""
+    package.fp.seek(info.header_offset)
+    header = package.fp.read(_LOCAL_HEADER.size)
+    if header[:4] != b"PK\x03\x04":
+        raise zipfile.BadZipFile(f"Bad local header for {info.filename}")
+    fields = _LOCAL_HEADER.unpack(header)
+    name_length, extra_length = fields[9], fields[10]
+    package.fp.seek(info.header_offset + _LOCAL_HEADER.size + name_length + extra_length)
+    remaining = info.compress_size
+    while remaining:
+        chunk = package.fp.read(min(remaining, _COPY_CHUNK_BYTES))
+        if not chunk:
+            raise zipfile.BadZipFile(f"Truncated data for {info.filename}")
+        output.write(chunk)
+        remaining -= len(chunk)
+
+
+def _dos_timestamp(date_time: tuple) -> tuple:
+    year, month, day, hour, minute, second = date_time
+    dos_time = (hour << 11) | (minute << 5) | (second // 2)
+    dos_date = (max(year, 1980) - 1980) << 9 | (month << 5) | day
+    return dos_time, dos_date
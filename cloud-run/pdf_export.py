@@ -0,0 +1,111 @@
+"""
+Options for LibreOffice's PDF export.
+
+Jobs may trade PDF size against fidelity with "pdfOptions":
+
+    {"pdfA": 2, "imageQuality": 75, "maxImageResolution": 150, "losslessImages": false}
+
+which become the FilterData of the writer_pdf_Export filter. Options a job
+leaves out fall back to the PDF_* environment defaults, and those to
+LibreOffice's own.
+"""
+import json
+import os
+
+# Archival PDF/A part to produce by default: 1, 2 or 3 (the "b" level), or
+# empty for a regular PDF
+PDF_A_VERSION = os.getenv("PDF_A_VERSION", "")
+# JPEG quality of exported images, 1-100; LibreOffice defaults to 90
+PDF_IMAGE_QUALITY = os.getenv("PDF_IMAGE_QUALITY", "")
+# Downsample images above this DPI; empty keeps their resolution
+PDF_MAX_IMAGE_RESOLUTION = os.getenv("PDF_MAX_IMAGE_RESOLUTION", "")
+
+PDF_FILTER = "writer_pdf_Export"
+# Resolutions LibreOffice offers for MaxImageResolution
+IMAGE_RESOLUTIONS = (75, 150, 300, 600, 1200)
+OPTIONS = ("pdfA", "imageQuality", "maxImageResolution", "losslessImages")
+
+
+def _defaults() -> dict:
+    defaults = {}
+    if PDF_A_VERSION:
+        defaults["pdfA"] = int(PDF_A_VERSION)
+    if PDF_IMAGE_QUALITY:
+        defaults["imageQuality"] = int(PDF_IMAGE_QUALITY)
+    if PDF_MAX_IMAGE_RESOLUTION:
+        defaults["maxImageResolution"] = int(PDF_MAX_IMAGE_RESOLUTION)
+    return defaults
+
+
+def _is_int(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def filter_data(options: dict = None) -> dict:
+    """
+    Builds the export FilterData for a job's pdfOptions.
+
+    Args:
+        options: The job's pdfOptions, or None for the defaults
+
+    Returns:
+        Dictionary of FilterData property to value; empty for LibreOffice's
+        own defaults
+
+    Raises:
+        ValueError: When an option is unknown or out of range
+    """
+    if options is not None and not isinstance(options, dict):
+        raise ValueError("pdfOptions must be an object")
+    unknown = set(options or {}) - set(OPTIONS)
+    if unknown:
+        raise ValueError(f"Unknown pdfOptions: {', '.join(sorted(unknown))}; expected {', '.join(OPTIONS)}")
+    options = {**_defaults(), **(options or {})}
+
+    data = {}
+    pdf_a = options.get("pdfA")
+    if pdf_a is True:
+        pdf_a = 2
+    if pdf_a:
+        if not _is_int(pdf_a) or pdf_a not in (1, 2, 3):
+            raise ValueError("pdfOptions.pdfA must be 1, 2, 3 or true")
+        # SelectPdfVersion 1-3 are PDF/A-1b, PDF/A-2b and PDF/A-3b
+        data["SelectPdfVersion"] = pdf_a
+
+    quality = options.get("imageQuality")
+    if quality is not None:
+        if not _is_int(quality) or not 1 <= quality <= 100:
+            raise ValueError("pdfOptions.imageQuality must be between 1 and 100")
+        data["Quality"] = quality
+        data["UseLosslessCompression"] = False
+
+    lossless = options.get("losslessImages")
+    if lossless is not None:
+        if not isinstance(lossless, bool):
+            raise ValueError("pdfOptions.losslessImages must be true or false")
+        data["UseLosslessCompression"] = lossless
+
+    resolution = options.get("maxImageResolution")
+    if resolution:
+        if not _is_int(resolution) or resolution not in IMAGE_RESOLUTIONS:
+            raise ValueError(
+                f"pdfOptions.maxImageResolution must be one of {', '.join(map(str, IMAGE_RESOLUTIONS))}"
+            )
+        data["ReduceImageResolution"] = True
+        data["MaxImageResolution"] = resolution
+    return data
+
+
+def convert_to_argument(data: dict) -> str:
+    """
+    The soffice --convert-to argument for data, in the JSON filter options
+    syntax of LibreOffice 7.4 and later.
+    """
+    if not data:
+        return "pdf"
+    typed = {
+        name: {"type": "boolean", "value": "true" if value else "false"} if isinstance(value, bool)
+        else {"type": "long", "value": str(value)}
+        for name, value in sorted(data.items())
+    }
+    return f"pdf:{PDF_FILTER}:{json.dumps(typed, separators=(',', ':'))}"
@@ -0,0 +1,624 @@
+import functools
+import logging
+import os
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack, nullcontext
+
+import firestore_utils
+import incremental
+import libreoffice_pool
+import libreoffice_utils
+import memory_budget
+import metrics
+import pdf_export
+import render_cache
+import resilience
+
+logger = logging.getLogger(__name__)
+
+BATCH_MAX_PARALLEL = int(os.getenv("BATCH_MAX_PARALLEL", "4"))
+# Number of finished jobs buffered before their statuses are written in one batch
+BATCH_STATUS_FLUSH_SIZE = int(os.getenv("BATCH_STATUS_FLUSH_SIZE", "20"))
+# Upload the filled DOCX while LibreOffice converts it to PDF
+PIPELINE_OVERLAP_UPLOAD = os.getenv("PIPELINE_OVERLAP_UPLOAD", "true").lower() == "true"
+# Also set the job status to "docx_ready" once the DOCX is uploaded
+PIPELINE_DOCX_READY_STATUS = os.getenv("PIPELINE_DOCX_READY_STATUS", "false").lower() == "true"
+# Documents handed to one LibreOffice invocation in bulk merges
+MERGE_CONVERT_CHUNK = int(os.getenv("MERGE_CONVERT_CHUNK", "25"))
+MERGE_MAX_DOCUMENTS = int(os.getenv("MERGE_MAX_DOCUMENTS", "500"))
+# Conversions of a deferred PDF before giving up on a form that keeps
+# being generated again
+DEFERRED_PDF_ATTEMPTS = 2
+
+_overlap_executor = ThreadPoolExecutor(thread_name_prefix="overlap-upload")
+# Deferred PDF conversions of one form run one at a time
+_pdf_locks = [threading.Lock() for _ in range(64)]
+
+
+def generate_documents(form_id: str, form_data: dict, template=None, job_id: str = None,
+                       fill_engine: str = None, context=None, formats: tuple = None,
+                       pdf_options: dict = None, defer_pdf: bool = False) -> dict:
+    """
+    Fills the form's template, converts it and uploads both artifacts.
+
+    A regeneration in which no placeholder value changed reuses the files of
+    the last one, and a DOCX-only regeneration patches the last DOCX (see
+    incremental).
+
+    Args:
+        form_id: ID of the form document
+        form_data: Form document data
+        template: Compiled template, fetched from the form when not given
+        job_id: Document job to report a DOCX-ready status on, if enabled
+        fill_engine: Fill engine to use (see libreoffice_utils.FILL_ENGINES)
+        context: firestore_utils.JobContext of the job; when given, the
+            form's URLs and the job status are written together
+        formats: File types to produce, from render_cache.FILE_TYPES; all
+            of them when not given
+        pdf_options: The job's pdfOptions (see pdf_export)
+        defer_pdf: Leave the PDF out now and convert it on its first
+            download (see generate_deferred_pdf)
+
+    Returns:
+        Dictionary with the formId and the PDF and DOCX URLs; a file type
+        that was not produced has no URL
+    """
+    # Verify office ID
+    office_id = form_data.get("officeId")
+    if not office_id:
+        raise ValueError("officeId is required in form data")
+
+    if template is None:
+        template = firestore_utils.get_template(form_data)
+    field_data = form_data.get("formData", {})
+    formats = tuple(file_type for file_type in render_cache.FILE_TYPES if file_type in (formats or render_cache.FILE_TYPES))
+    if defer_pdf:
+        # The DOCX is what the PDF is converted from later
+        formats = ("docx",)
+    filter_data = pdf_export.filter_data(pdf_options)
+
+    # Compare with what the form's last generation used
+    digests = incremental.field_digests(template, field_data)
+    state = form_data.get(firestore_utils.RENDER_STATE_FIELD)
+    changed = incremental.changed_fields(state, template, digests)
+    uploads = None
+    if changed is not None and not changed:
+        uploads = incremental.reuse_files(state, formats, filter_data)
+    elif changed and formats == ("docx",) and (state.get("files") or {}).get("docx"):
+        uploads = _patch_and_upload(form_id, office_id, template, field_data, state["files"]["docx"], changed)
+
+    # Unchanged template and data: copy the earlier result instead of rendering
+    cache_key = None
+    if uploads is None and render_cache.RENDER_CACHE:
+        cache_key = render_cache.cache_key(template, field_data, filter_data)
+        uploads = render_cache.reuse(cache_key, form_id, office_id, template, formats)
+
+    if uploads is None:
+        # Waits here while running jobs hold the instance's memory budget
+        engine = fill_engine or libreoffice_utils.FILL_ENGINE
+        streaming = memory_budget.use_streaming(template, engine)
+        reserved = memory_budget.estimate(template, engine, streaming)
+        # Each file is added to the render cache as soon as it is uploaded
+        on_uploaded = functools.partial(render_cache.store, cache_key) if cache_key else None
+        with memory_budget.get_budget().reserve(reserved, streaming=streaming), \
+                libreoffice_utils.job_workspace() as workspace:
+            uploads = _convert_and_upload(
+                form_id, office_id, template, field_data, workspace, job_id, fill_engine, context,
+                streaming, formats, filter_data, on_uploaded
+            )
+    pdf_path, pdf_url = uploads.get("pdf", (None, None))
+    docx_path, docx_url = uploads.get("docx", (None, None))
+
+    # Update form with generated files in a single write
+    render_state = incremental.render_state(template, digests, uploads, filter_data)
+    if context:
+        context.complete(pdf_path, docx_path, pdf_url, docx_url, render_state)
+    else:
+        firestore_utils.update_document_urls(form_id, pdf_path, docx_path, pdf_url, docx_url, render_state)
+
+    result = {
+        "formId": form_id,
+        "pdf_url": pdf_url,
+        "docx_url": docx_url
+    }
+    if defer_pdf and not pdf_url:
+        result["pdf_deferred"] = True
+    return result
+
+
+def generate_deferred_pdf(form_id: str) -> dict:
+    """
+    Converts the form's last DOCX to PDF, with the export options of that
+    generation, unless a current PDF already exists.
+
+    Called on the first download of a PDF whose job deferred it; requests
+    for the same form on this instance wait for a conversion in progress
+    instead of starting another. The PDF is named after the DOCX generation
+    it was converted from, so a conversion that loses the race with a new
+    generation never overwrites that generation's files; it is discarded
+    and the new generation is served instead.
+
+    Returns:
+        Dictionary with the formId and the PDF URL
+    """
+    with _pdf_locks[hash(form_id) % len(_pdf_locks)], resilience.deadline(resilience.JOB_DEADLINE_SECONDS):
+        for _ in range(DEFERRED_PDF_ATTEMPTS):
+            form_data = firestore_utils.fetch_form_data(form_id)
+            if not form_data:
+                raise ValueError(f"Form {form_id} not found")
+            state = form_data.get(firestore_utils.RENDER_STATE_FIELD) or {}
+            files = state.get("files") or {}
+            if files.get("pdf"):
+                return {"formId": form_id, "pdf_url": firestore_utils.generate_signed_url(files["pdf"])}
+            if not files.get("docx"):
+                raise ValueError(f"Form {form_id} has no generated DOCX to convert")
+
+            with metrics.job_trace(formId=form_id, deferred=True), libreoffice_utils.job_workspace() as workspace:
+                docx_path, generation = firestore_utils.download_result(
+                    files["docx"], os.path.join(workspace, os.path.basename(files["docx"]))
+                )
+                output_pdf = libreoffice_utils.convert_to_pdf(docx_path, state.get("pdfOptions"))
+                stem = os.path.splitext(os.path.basename(files["docx"]))[0]
+                file_name = f"{stem}_{generation}.pdf"
+                pdf_path, pdf_url = firestore_utils.upload_result(
+                    form_id, output_pdf, "pdf", form_data.get("officeId"), file_name
+                )
+            render_state = {**state, "files": {**files, "pdf": pdf_path}}
+            if firestore_utils.add_generated_pdf(form_id, pdf_path, pdf_url, state, render_state):
+                return {"formId": form_id, "pdf_url": pdf_url}
+            firestore_utils.delete_result(pdf_path)
+        raise RuntimeError(f"Form {form_id} kept being generated again while its PDF was converted")
+
+
+def _patch_and_upload(form_id: str, office_id: str, template, field_data: dict,
+                      previous_path: str, changed: set) -> dict:
+    """
+    Regenerates only the DOCX by patching the changed placeholders into the
+    form's last DOCX.
+
+    Returns:
+        Dictionary with the DOCX's (blob_path, url), or None when the last
+        DOCX cannot be patched and the form has to be rendered in full
+    """
+    file_name = f"{template.template_id}_filled.docx"
+    # The template part and the earlier one are parsed side by side
+    reserved = 2 * memory_budget.estimate(template, "ooxml", True)
+    try:
+        with memory_budget.get_budget().reserve(reserved, streaming=True), \
+                libreoffice_utils.job_workspace() as workspace:
+            previous, _ = firestore_utils.download_result(previous_path, os.path.join(workspace, "previous.docx"))
+            patched = os.path.join(workspace, file_name)
+            with metrics.stage("patch_docx", changed=len(changed)) as attributes:
+                attributes["placeholders"] = incremental.patch_docx(
+                    template, previous, patched, field_data, changed
+                )
+            return {"docx": firestore_utils.upload_result(form_id, patched, "docx", office_id, file_name)}
+    except Exception as e:
+        logger.warning(f"Could not patch the last DOCX of form {form_id}, rendering it in full: {str(e)}")
+        return None
+
+
+def _convert_and_upload(form_id: str, office_id: str, template, field_data: dict,
+                        workspace: str, job_id: str = None, fill_engine: str = None,
+                        context=None, streaming: bool = False,
+                        formats: tuple = render_cache.FILE_TYPES, filter_data: dict = None,
+                        on_uploaded=None) -> dict:
+    """
+    Fills the template in memory and uploads the DOCX from that buffer. The
+    DOCX is written to the job workspace only for LibreOffice to read, and
+    the PDF is uploaded from there. In streaming mode the DOCX is filled
+    straight into the workspace and uploaded from the file. Only the file
+    types in formats are uploaded, and without "pdf" nothing is converted.
+    on_uploaded is handed to every upload (see firestore_utils.upload_result).
+
+    With PIPELINE_OVERLAP_UPLOAD the DOCX upload starts before the PDF
+    conversion, so the job costs max(convert, upload) instead of their sum.
+
+    Returns:
+        Dictionary of file type to (blob_path, url)
+    """
+    if streaming:
+        file_name = f"{template.template_id}_filled.docx"
+        filled_docx_path = libreoffice_utils.stream_docx(
+            template, field_data, os.path.join(workspace, file_name)
+        )
+        docx_source = filled_docx_path
+    else:
+        file_name, docx_source = libreoffice_utils.render_docx(template, field_data, fill_engine)
+        filled_docx_path = os.path.join(workspace, file_name)
+        if "pdf" in formats:
+            with open(filled_docx_path, "wb") as f:
+                f.write(docx_source)
+
+    docx_timing = {}
+
+    def upload_docx():
+        started = time.monotonic()
+        try:
+            result = firestore_utils.upload_result(
+                form_id, docx_source, "docx", office_id, file_name, on_uploaded
+            )
+            if context and PIPELINE_DOCX_READY_STATUS:
+                context.set_status("docx_ready", force=True)
+            elif job_id and PIPELINE_DOCX_READY_STATUS:
+                firestore_utils.update_document_job(job_id, "docx_ready")
+            return result
+        finally:
+            docx_timing["seconds"] = time.monotonic() - started
+
+    if "pdf" not in formats:
+        return {"docx": upload_docx()}
+    if "docx" not in formats:
+        output_pdf = libreoffice_utils.convert_to_pdf(filled_docx_path, filter_data)
+        return {"pdf": firestore_utils.upload_result(form_id, output_pdf, "pdf", office_id, on_uploaded=on_uploaded)}
+
+    overlap_started = time.monotonic()
+    upload_docx = metrics.in_current_context(upload_docx)
+    docx_future = _overlap_executor.submit(upload_docx) if PIPELINE_OVERLAP_UPLOAD else None
+    try:
+        output_pdf = libreoffice_utils.convert_to_pdf(filled_docx_path, filter_data)
+    except Exception:
+        if docx_future:
+            # Let the upload finish before the workspace is removed
+            docx_future.exception()
+        raise
+    convert_seconds = time.monotonic() - overlap_started
+
+    if docx_future is None:
+        docx_future = _overlap_executor.submit(upload_docx)
+    pdf_future = firestore_utils.submit_upload(form_id, output_pdf, "pdf", office_id, on_uploaded=on_uploaded)
+    docx_result = docx_future.result()
+    if PIPELINE_OVERLAP_UPLOAD:
+        _record_overlap(convert_seconds, docx_timing.get("seconds", 0.0), time.monotonic() - overlap_started)
+    return {"pdf": pdf_future.result(), "docx": docx_result}
+
+
+def _record_overlap(convert_seconds: float, docx_upload_seconds: float, overlapped_seconds: float) -> None:
+    # Time the DOCX upload would have added after the conversion
+    saved = max(0.0, convert_seconds + docx_upload_seconds - overlapped_seconds)
+    metrics.observe_overlap_saved(saved)
+    logger.info(json.dumps({
+        "event": "pipeline_overlap",
+        "convert_seconds": round(convert_seconds, 3),
+        "docx_upload_seconds": round(docx_upload_seconds, 3),
+        "saved_seconds": round(saved, 3),
+    }))
+
+
+def process_job(job_id: str, form_id: str, fill_engine: str = None, template_id: str = None,
+                form_data: dict = None, formats: tuple = None, pdf_options: dict = None,
+                defer_pdf: bool = False) -> dict:
+    """
+    Runs one document job end to end, recording its status on document_jobs.
+
+    form_data is the form document when it was already read, e.g. to find
+    the office the job is scheduled under.
+    """
+    with metrics.job_trace(jobId=job_id, formId=form_id):
+        return _process_job(job_id, form_id, fill_engine, template_id, form_data, formats,
+                            pdf_options, defer_pdf)
+
+
+def _process_job(job_id: str, form_id: str, fill_engine: str = None, template_id: str = None,
+                 form_data: dict = None, formats: tuple = None, pdf_options: dict = None,
+                 defer_pdf: bool = False) -> dict:
+    context = None
+
+    def attempt(number):
+        if not form_id:
+            raise ValueError("formId is required in payload")
+
+        logger.info(f"Started processing document job {job_id} for form: {form_id} (attempt {number})")
+
+        # Fetch form data, and the template with it when its id is known
+        form_data = context.load()
+        if not form_data:
+            raise ValueError(f"Form {form_id} not found")
+
+        with firestore_utils.template_lease(form_data, context.template_data) as template:
+            context.set_status("pending")
+
+            # Marks the job completed together with the form's URLs
+            result = generate_documents(
+                form_id, form_data, template, job_id=job_id, fill_engine=fill_engine, context=context,
+                formats=formats, pdf_options=pdf_options, defer_pdf=defer_pdf
+            )
+        return {"status": "success", "jobId": job_id, **result}
+
+    try:
+        # Inside the try: building the context may be the first use of the clients
+        context = firestore_utils.JobContext(job_id, form_id, template_id, form_data)
+        context.set_status("pending")
+        return resilience.run_job(
+            attempt, lambda number, e: context.retry(str(e)[:500]), _retryable, context.max_attempts
+        )
+    except Exception as e:
+        logger.error(f"Failed to process document job: {str(e)}", exc_info=True)
+        if context:
+            context.fail(str(e)[:500])  # Truncate long error messages
+        else:
+            try:
+                firestore_utils.update_document_job(job_id, "failed", str(e)[:500])
+            except Exception:
+                # Already logged; the original error is the one to raise
+                pass
+        raise
+
+
+def _retryable(error: Exception) -> bool:
+    """Failures worth running a job again for: transient storage errors and hung conversions"""
+    return resilience.is_transient(error) or isinstance(error, libreoffice_pool.ConversionTimeout)
+
+
+def process_batch(jobs: list, hold=None):
+    """
+    Processes many document jobs, grouped by template, with bounded parallelism.
+
+    Each template is fetched once per group. Job statuses are written to
+    Firestore in batched writes, and one JSON line per finished job is
+    yielded as soon as it completes. A job without a document_jobs record
+    fails on its own, without running, and never holds up the other jobs'
+    statuses.
+
+    Args:
+        jobs: List of {"jobId": ..., "formId": ...} dictionaries, each with
+            an optional "fillEngine", "formats", "pdfOptions" and "deferPdf"
+        hold: Called with a job's office id; the context manager it returns
+            is held while the job runs (see job_queue.JobQueue.hold)
+    """
+    hold = hold or _no_hold
+    statuses = []
+    statuses_lock = threading.Lock()
+
+    # Retry budget of each started job, written with its statuses
+    budgets = {}
+
+    def record(job_id, status, error=None, fields=None):
+        with statuses_lock:
+            statuses.append((job_id, status, error, dict(fields or {})))
+            if len(statuses) < BATCH_STATUS_FLUSH_SIZE:
+                return
+            pending_writes = list(statuses)
+            statuses.clear()
+        _write_statuses(pending_writes)
+
+    def flush():
+        with statuses_lock:
+            pending_writes = list(statuses)
+            statuses.clear()
+        if pending_writes:
+            _write_statuses(pending_writes)
+
+    def line(payload):
+        return json.dumps(payload) + "\n"
+
+    def failed(job, error):
+        return line({"status": "failed", "jobId": job["jobId"], "formId": job["formId"], "error": error})
+
+    try:
+        try:
+            existing = firestore_utils.existing_document_jobs([job["jobId"] for job in jobs])
+            forms = firestore_utils.fetch_forms([job["formId"] for job in jobs if job["jobId"] in existing])
+        except Exception as e:
+            logger.error(f"Could not read the batch's jobs and forms: {str(e)}", exc_info=True)
+            for job in jobs:
+                yield failed(job, str(e))
+            return
+
+        # Jobs without a record have nowhere to report to, so they only get their line
+        for job in jobs:
+            if job["jobId"] not in existing:
+                yield failed(job, f"Document job {job['jobId']} not found")
+        jobs = [job for job in jobs if job["jobId"] in existing]
+        _write_statuses([(job["jobId"], "pending", None) for job in jobs])
+
+        groups = {}
+        for job in jobs:
+            form_data = forms.get(job["formId"])
+            if not form_data:
+                error = f"Form {job['formId']} not found"
+                record(job["jobId"], "failed", error)
+                yield failed(job, error)
+                continue
+            groups.setdefault(form_data.get("templateId"), []).append((job, form_data))
+
+        def run(job, form_data, template):
+            budget = budgets[job["jobId"]] = {"attempts": 1, "maxAttempts": resilience.JOB_MAX_ATTEMPTS}
+
+            def attempt(number):
+                budget["attempts"] = number
+                return generate_documents(
+                    job["formId"], form_data, template, job["jobId"], job.get("fillEngine"),
+                    formats=job.get("formats"), pdf_options=job.get("pdfOptions"),
+                    defer_pdf=bool(job.get("deferPdf"))
+                )
+
+            def retry(number, e):
+                record(job["jobId"], "retrying", None, {**budget, "lastError": str(e)[:500]})
+
+            with hold(form_data.get("officeId")), metrics.job_trace(jobId=job["jobId"], formId=job["formId"]):
+                result = resilience.run_job(attempt, retry, _retryable)
+            record(job["jobId"], "completed", None, budget)
+            return {"status": "success", "jobId": job["jobId"], **result}
+
+        # Leases are released after the executor has finished every job
+        with ExitStack() as leases, ThreadPoolExecutor(max_workers=BATCH_MAX_PARALLEL) as executor:
+            futures = {}
+            for template_id, group in groups.items():
+                try:
+                    template = leases.enter_context(firestore_utils.template_lease(group[0][1]))
+                except Exception as e:
+                    for job, _ in group:
+                        record(job["jobId"], "failed", str(e)[:500])
+                        yield failed(job, str(e))
+                    continue
+                print(f"Batch: {len(group)} jobs for template {template_id}")
+                for job, form_data in group:
+                    futures[executor.submit(run, job, form_data, template)] = job
+
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    yield line(future.result())
+                except Exception as e:
+                    logger.error(f"Failed to process document job {job['jobId']}: {str(e)}", exc_info=True)
+                    record(job["jobId"], "failed", str(e)[:500], budgets.get(job["jobId"]))
+                    yield failed(job, str(e))
+    finally:
+        flush()
+
+
+def _no_hold(office_id: str):
+    return nullcontext()
+
+
+def _write_statuses(updates: list) -> None:
+    """
+    Writes batch job statuses in batched writes. When a batched write
+    fails, each status is written on its own, so one bad record costs only
+    its own status; a status that still cannot be written is logged.
+    """
+    try:
+        firestore_utils.update_document_jobs(updates)
+        return
+    except Exception as e:
+        logger.warning(f"Batched write of {len(updates)} job statuses failed, writing them one by one: {str(e)}")
+    for job_id, status, error, *fields in updates:
+        try:
+            firestore_utils.update_document_job(job_id, status, error, **(fields[0] if fields else {}))
+        except Exception as e:
+            logger.error(f"Could not record status {status} of document job {job_id}: {str(e)}")
+
+
+def process_merge(form_ids: list, merge_id: str, combine: bool = True, fill_engine: str = None,
+                  pdf_options: dict = None, hold=None) -> dict:
+    """
+    Mail-merge style generation: fills one document per form and converts
+    them in chunks of MERGE_CONVERT_CHUNK per LibreOffice invocation, so the
+    per-conversion overhead is paid once per chunk instead of once per form.
+
+    With combine, the PDFs of each template are concatenated, in the order
+    of form_ids, into one file uploaded under
+    generated_documents/{office_id}/merges/{merge_id}/. Without it, every
+    form gets its own PDF and DOCX as with a regular job.
+
+    Args:
+        form_ids: Forms to generate, all from the same office
+        merge_id: Identifier of this merge, used in the output path
+        combine: Produce one combined PDF per template
+        fill_engine: Fill engine to use (see libreoffice_utils.FILL_ENGINES)
+        pdf_options: PDF export options (see pdf_export)
+        hold: Called with the office id; the context manager it returns is
+            held while a chunk converts (see job_queue.JobQueue.hold)
+
+    Returns:
+        Dictionary with the generated files per template and the failures
+    """
+    if len(form_ids) > MERGE_MAX_DOCUMENTS:
+        raise ValueError(f"A merge can hold at most {MERGE_MAX_DOCUMENTS} documents")
+    filter_data = pdf_export.filter_data(pdf_options)
+
+    forms = firestore_utils.fetch_forms(form_ids)
+    failed = [{"formId": form_id, "error": "Form not found"} for form_id in form_ids if form_id not in forms]
+    office_ids = {form_data.get("officeId") for form_data in forms.values()}
+    if None in office_ids or len(office_ids) > 1:
+        raise ValueError("Every form in a merge needs the same officeId")
+    office_id = office_ids.pop() if office_ids else None
+
+    groups = {}
+    for form_id in dict.fromkeys(form_ids):
+        if form_id in forms:
+            groups.setdefault(forms[form_id].get("templateId"), []).append(form_id)
+
+    results = []
+    with metrics.job_trace(mergeId=merge_id, documents=len(forms)):
+        for template_id, group in groups.items():
+            try:
+                with firestore_utils.template_lease(forms[group[0]]) as template, \
+                        libreoffice_utils.job_workspace() as workspace:
+                    results.append(_merge_group(
+                        merge_id, office_id, template, group, forms, workspace, combine, fill_engine,
+                        filter_data, hold or _no_hold
+                    ))
+            except Exception as e:
+                logger.error(f"Merge {merge_id} failed for template {template_id}: {str(e)}", exc_info=True)
+                failed.extend({"formId": form_id, "error": str(e)[:500]} for form_id in group)
+
+    return {"mergeId": merge_id, "results": results, "failed": failed}
+
+
+def _merge_group(merge_id: str, office_id: str, template, form_ids: list, forms: dict,
+                 workspace: str, combine: bool, fill_engine: str, filter_data: dict = None,
+                 hold=None) -> dict:
+    hold = hold or _no_hold
+    engine = fill_engine or libreoffice_utils.FILL_ENGINE
+    streaming = memory_budget.use_streaming(template, engine)
+    reserved = memory_budget.estimate(template, engine, streaming)
+
+    def render(position):
+        form_id = form_ids[position]
+        field_data = forms[form_id].get("formData", {})
+        # Numbered so documents keep their order and never share a name
+        docx_path = os.path.join(workspace, f"{position:05d}_{form_id}.docx")
+        with memory_budget.get_budget().reserve(reserved, streaming=streaming):
+            if streaming:
+                return libreoffice_utils.stream_docx(template, field_data, docx_path)
+            _, content = libreoffice_utils.render_docx(template, field_data, fill_engine)
+            with open(docx_path, "wb") as f:
+                f.write(content)
+        return docx_path
+
+    with ThreadPoolExecutor(max_workers=BATCH_MAX_PARALLEL) as executor:
+        docx_paths = list(executor.map(metrics.in_current_context(render), range(len(form_ids))))
+        chunks = [
+            docx_paths[start:start + MERGE_CONVERT_CHUNK]
+            for start in range(0, len(docx_paths), MERGE_CONVERT_CHUNK)
+        ]
+        # Chunks run side by side on the LibreOffice pool's workers, each
+        # in one of the office's slots
+        def convert_chunk(chunk):
+            with hold(office_id):
+                return libreoffice_utils.convert_many_to_pdf(chunk, filter_data)
+
+        convert = metrics.in_current_context(convert_chunk)
+        pdf_paths = [pdf_path for chunk_pdfs in executor.map(convert, chunks) for pdf_path in chunk_pdfs]
+
+    if combine:
+        file_name = f"{template.template_id}_merged.pdf"
+        merged_path = libreoffice_utils.merge_pdfs(pdf_paths, os.path.join(workspace, file_name))
+        # Stored under generated_documents/{office_id}/merges/{merge_id}/
+        pdf_path, pdf_url = firestore_utils.upload_result(
+            f"merges/{merge_id}", merged_path, "pdf", office_id, file_name
+        )
+        return {
+            "templateId": template.template_id,
+            "formIds": form_ids,
+            "pdf_path": pdf_path,
+            "pdf_url": pdf_url,
+        }
+
+    documents = []
+    for form_id, docx_path, pdf_path in zip(form_ids, docx_paths, pdf_paths):
+        file_name = f"{template.template_id}_filled"
+        uploads = {
+            "pdf": firestore_utils.submit_upload(form_id, pdf_path, "pdf", office_id, file_name + ".pdf"),
+            "docx": firestore_utils.submit_upload(form_id, docx_path, "docx", office_id, file_name + ".docx"),
+        }
+        documents.append((form_id, uploads))
+
+    files = []
+    for form_id, uploads in documents:
+        pdf_path, pdf_url = uploads["pdf"].result()
+        docx_path, docx_url = uploads["docx"].result()
+        # Keeps the next regeneration from reusing files of an older state
+        field_data = forms[form_id].get("formData", {})
+        render_state = incremental.render_state(
+            template, incremental.field_digests(template, field_data),
+            {"pdf": (pdf_path, pdf_url), "docx": (docx_path, docx_url)}, filter_data
+        )
+        firestore_utils.update_document_urls(form_id, pdf_path, docx_path, pdf_url, docx_url, render_state)
+        files.append({"formId": form_id, "pdf_url": pdf_url, "docx_url": docx_url})
+    return {"templateId": template.template_id, "formIds": form_ids, "documents": files}
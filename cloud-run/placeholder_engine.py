@@ -0,0 +1,194 @@
+import bisect
+import re
+
+W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+XML_SPACE = "{http://www.w3.org/XML/1998/namespace}space"
+W_P = f"{{{W_NS}}}p"
+W_T = f"{{{W_NS}}}t"
+W_BR = f"{{{W_NS}}}br"
+W_TAB = f"{{{W_NS}}}tab"
+
+PLACEHOLDER_PATTERN = re.compile(r"\{\{([^}]+)\}\}")
+
+# Parts of a .docx package that can carry placeholders
+TEMPLATE_PART_PATTERN = re.compile(
+    r"^/?word/(document|header\d*|footer\d*|footnotes|endnotes)\.xml$"
+)
+
+
+def normalize_values(form_data: dict) -> dict:
+    """
+    Converts form data into a flat mapping of placeholder name to text.
+
+    Field data is either a plain value or an object with a 'value' key, as
+    saved by the form modals.
+    """
+    return {
+        key: str(field_data.get('value', '')) if isinstance(field_data, dict) else str(field_data)
+        for key, field_data in form_data.items()
+    }
+
+
+def is_template_part(part_name: str) -> bool:
+    return bool(TEMPLATE_PART_PATTERN.match(str(part_name)))
+
+
+def iter_paragraphs(root):
+    """Yields every paragraph in a part, including text boxes and nested tables"""
+    return root.iter(W_P)
+
+
+def paragraph_text_nodes(paragraph) -> list:
+    """Returns the run text nodes that belong to this paragraph, not to nested ones"""
+    nodes = []
+    for text_node in paragraph.iter(W_T):
+        owner = text_node.getparent()
+        while owner is not None and owner.tag != W_P:
+            owner = owner.getparent()
+        if owner is paragraph:
+            nodes.append(text_node)
+    return nodes
+
+
+def substitute_paragraph(paragraph, values: dict) -> int:
+    """
+    Replaces every known placeholder in a paragraph in a single pass.
+
+    The text of all runs is joined so placeholders split across runs are
+    found; replacement text goes into the run where the placeholder starts,
+    keeping that run's formatting, and the remainder is trimmed from the
+    following runs.
+
+    Returns:
+        Number of placeholders replaced
+    """
+    nodes = paragraph_text_nodes(paragraph)
+    if not nodes:
+        return 0
+
+    texts = [node.text or "" for node in nodes]
+    joined = "".join(texts)
+    if "{{" not in joined:
+        return 0
+
+    matches = [m for m in PLACEHOLDER_PATTERN.finditer(joined) if m.group(1) in values]
+    if not matches:
+        return 0
+
+    offsets = []
+    position = 0
+    for text in texts:
+        offsets.append(position)
+        position += len(text)
+
+    lengths = [len(text) for text in texts]
+
+    def node_at(char_index):
+        # The last non-empty node starting at or before char_index holds it
+        index = bisect.bisect_right(offsets, char_index) - 1
+        while index > 0 and not lengths[index]:
+            index -= 1
+        return index
+
+    # Work backwards so earlier offsets stay valid while texts change
+    for match in reversed(matches):
+        start, end = match.span()
+        first = node_at(start)
+        last = node_at(end - 1)
+        value = values[match.group(1)]
+        if first == last:
+            local = start - offsets[first]
+            texts[first] = texts[first][:local] + value + texts[first][local + end - start:]
+        else:
+            texts[first] = texts[first][:start - offsets[first]] + value
+            for i in range(first + 1, last):
+                texts[i] = ""
+            texts[last] = texts[last][end - offsets[last]:]
+
+    for node, text in zip(nodes, texts):
+        if text != (node.text or ""):
+            set_node_text(node, text)
+
+    return len(matches)
+
+
+def set_node_text(text_node, text: str) -> None:
+    """
+    Sets the text of a w:t node, turning line breaks and tabs into w:br and
+    w:tab siblings the same way python-docx's Run.text setter does.
+    """
+    if "\n" not in text and "\t" not in text and "\r" not in text:
+        _assign_text(text_node, text)
+        return
+
+    parent = text_node.getparent()
+    position = parent.index(text_node)
+    siblings = []
+    kept_text = False
+    for piece in re.split(r"(\r\n|\n|\r|\t)", text):
+        if not piece:
+            continue
+        if piece == "\t":
+            siblings.append(text_node.makeelement(W_TAB, {}))
+        elif piece in ("\r\n", "\n", "\r"):
+            siblings.append(text_node.makeelement(W_BR, {}))
+        elif not kept_text and not siblings:
+            # The existing node keeps the leading text
+            _assign_text(text_node, piece)
+            kept_text = True
+        else:
+            element = text_node.makeelement(W_T, {})
+            _assign_text(element, piece)
+            siblings.append(element)
+    if not kept_text:
+        _assign_text(text_node, "")
+    for offset, element in enumerate(siblings, start=1):
+        parent.insert(position + offset, element)
+
+
+def _assign_text(text_node, text: str) -> None:
+    text_node.text = text
+    if text != text.strip():
+        text_node.set(XML_SPACE, "preserve")
+
+
+def fill_part(root, values: dict, ordinals: list = None) -> int:
+    """
+    Substitutes placeholders in one XML part, either in every paragraph or
+    only in the paragraphs at the given document-order ordinals.
+    """
+    paragraphs = list(iter_paragraphs(root))
+    if ordinals is not None:
+        paragraphs = [paragraphs[ordinal] for ordinal in ordinals if ordinal < len(paragraphs)]
+    replaced = 0
+    for paragraph in paragraphs:
+        replaced += substitute_paragraph(paragraph, values)
+    return replaced
+
+
+def fill_document(document, form_data: dict, index: dict = None) -> int:
+    """
+    Substitutes placeholders across the body, headers, footers, footnotes,
+    endnotes, text boxes and nested tables of a python-docx Document.
+
+    Args:
+        document: python-docx Document to modify in place
+        form_data: Dictionary containing form data to fill in the template
+        index: Optional placeholder location index (see template_cache);
+            when given only the indexed paragraphs are visited
+
+    Returns:
+        Number of placeholders replaced
+    """
+    values = normalize_values(form_data)
+    replaced = 0
+    for part in document.part.package.iter_parts():
+        if not is_template_part(part.partname) or not hasattr(part, "element"):
+            continue
+        if index is None:
+            replaced += fill_part(part.element, values)
+            continue
+        located = index["parts"].get(str(part.partname).lstrip("/"))
+        if located:
+            replaced += fill_part(part.element, values, located["paragraphs"])
+    return replaced
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import logging
+import os
+
+import firestore_utils
+import metrics
+import placeholder_engine
+import resilience
+
+logger = logging.getLogger(__name__)
+
+# Reuse earlier output when a form is regenerated with unchanged data
+RENDER_CACHE = os.getenv("RENDER_CACHE", "true").lower() == "true"
+# Entries are expired by the output bucket's lifecycle rule on this prefix
+# (see render_cache_lifecycle.json)
+RENDER_CACHE_PREFIX = os.getenv("RENDER_CACHE_PREFIX", "rendered_cache").strip("/")
+# Bump when a change to filling or conversion alters the generated files
+RENDER_VERSION = 1
+
+FILE_TYPES = ("pdf", "docx")
+
+
+def cache_key(template, field_data: dict, filter_data: dict = None) -> str:
+    """
+    Content address of a rendering: the template version plus the values
+    of the placeholders it actually uses, canonicalized the way the fill
+    step reads them, and the PDF export options. Fields the template does
+    not use, and the fill engine, do not change the output and are left out.
+    """
+    values = placeholder_engine.normalize_values(field_data)
+    material = {
+        "version": RENDER_VERSION,
+        "template": template.template_id,
+        "generation": template.generation,
+        "values": {name: values.get(name) for name in sorted(template.placeholders)},
+    }
+    if filter_data:
+        # Left out when empty so keys of default exports stay the same
+        material["pdf"] = filter_data
+    canonical = json.dumps(material, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _cached_name(key: str, file_type: str) -> str:
+    return f"{RENDER_CACHE_PREFIX}/{key}.{file_type}"
+
+
+def _bucket():
+    bucket_name = os.getenv("OUTPUT_BUCKET", "")
+    if not bucket_name:
+        raise ValueError("OUTPUT_BUCKET environment variable not set")
+    return firestore_utils.get_storage_client().bucket(bucket_name)
+
+
+def reuse(key: str, form_id: str, office_id: str, template, formats: tuple = FILE_TYPES) -> dict:
+    """
+    Copies the wanted files of a cached rendering into the form's
+    generated_documents path.
+
+    The lookup is a single listing of the key's prefix; the copies are
+    server-side, so nothing is downloaded or converted.
+
+    Returns:
+        Dictionary of file type to (blob_path, url), or None on a miss
+    """
+    try:
+        bucket = _bucket()
+        with metrics.stage("render_cache_lookup") as attributes:
+            found = {
+                blob.name.rsplit(".", 1)[-1]: blob
+                for blob in bucket.list_blobs(prefix=f"{RENDER_CACHE_PREFIX}/{key}.")
+            }
+            attributes["hit"] = all(file_type in found for file_type in formats)
+        if not attributes["hit"]:
+            return None
+
+        def copy(file_type):
+            blob_name = f"generated_documents/{office_id}/{form_id}/{template.template_id}_filled.{file_type}"
+            with metrics.stage("render_cache_copy", format=file_type):
+                resilience.call(
+                    bucket.copy_blob, found[file_type], bucket, blob_name,
+                    stage="render_cache_copy", timeout=resilience.STORAGE_TIMEOUT_SECONDS
+                )
+            return blob_name, firestore_utils.generate_signed_url(blob_name, verify_exists=False)
+
+        futures = {
+            file_type: firestore_utils.submit_storage_task(copy, file_type)
+            for file_type in formats
+        }
+        results = {file_type: future.result() for file_type, future in futures.items()}
+        print(f"Reused cached rendering {key} for form {form_id}")
+        return results
+
+    except Exception as e:
+        # A cache problem must never fail the job; render it instead
+        logger.warning(f"Render cache lookup failed for {key}: {str(e)}")
+        return None
+
+
+def store(key: str, file_type: str, blob) -> None:
+    """
+    Copies a freshly uploaded file into the cache in the background.
+
+    The copy is made only from the generation the upload wrote, so when the
+    form is generated again with other data before it runs, the new file
+    is not stored under this key.
+    """
+    generation = blob.generation
+    if not generation:
+        return
+
+    def copy():
+        try:
+            bucket = _bucket()
+            bucket.copy_blob(
+                blob, bucket, _cached_name(key, file_type), if_source_generation_match=generation
+            )
+        except Exception as e:
+            logger.warning(f"Could not store {file_type} of rendering {key} in the render cache: {str(e)}")
+
+    firestore_utils.submit_storage_task(copy)
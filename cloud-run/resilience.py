@@ -0,0 +1,191 @@
+"""
+Deadlines and retries for document jobs.
+
+Every job runs under a deadline of JOB_DEADLINE_SECONDS. The stages it goes
+through have their own limits: STORAGE_TIMEOUT_SECONDS per Cloud Storage
+call, FIRESTORE_TIMEOUT_SECONDS per Firestore call, and the LibreOffice
+pool's conversion timeout. Each limit is cut to what is left of the job's
+deadline, so a job that hangs anywhere ends with DeadlineExceeded rather
+than holding a worker forever.
+
+Storage and Firestore calls made through call() are retried with full
+jitter exponential backoff when they fail with a transient error: 429 and
+5xx answers, timeouts and dropped connections. Only idempotent calls go
+through it: reads, and writes that set the same fields or overwrite the
+same blob. A job that still fails with such an error is run again, up to
+JOB_MAX_ATTEMPTS times in all (see run_job).
+"""
+import contextvars
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+
+import metrics
+
+try:
+    from google.api_core import exceptions as api_exceptions
+except ImportError:
+    api_exceptions = None
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+try:
+    from google.auth import exceptions as auth_exceptions
+except ImportError:
+    auth_exceptions = None
+
+logger = logging.getLogger(__name__)
+
+# Attempts per Storage or Firestore call, and the backoff between them
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", "4"))
+RETRY_BASE_SECONDS = float(os.getenv("RETRY_BASE_SECONDS", "0.5"))
+RETRY_MAX_SECONDS = float(os.getenv("RETRY_MAX_SECONDS", "8"))
+STORAGE_TIMEOUT_SECONDS = float(os.getenv("STORAGE_TIMEOUT_SECONDS", "120"))
+FIRESTORE_TIMEOUT_SECONDS = float(os.getenv("FIRESTORE_TIMEOUT_SECONDS", "30"))
+# Whole job, all attempts included
+JOB_DEADLINE_SECONDS = float(os.getenv("JOB_DEADLINE_SECONDS", "900"))
+# Runs of a job, the first included, before it is marked failed
+JOB_MAX_ATTEMPTS = max(1, int(os.getenv("JOB_MAX_ATTEMPTS", "3")))
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "2"))
+JOB_RETRY_MAX_SECONDS = float(os.getenv("JOB_RETRY_MAX_SECONDS", "30"))
+
+_TRANSIENT_ERRORS = (ConnectionError,)
+if api_exceptions:
+    _TRANSIENT_ERRORS += (
+        api_exceptions.TooManyRequests,
+        api_exceptions.InternalServerError,
+        api_exceptions.BadGateway,
+        api_exceptions.ServiceUnavailable,
+        api_exceptions.GatewayTimeout,
+        api_exceptions.DeadlineExceeded,
+        api_exceptions.Aborted,
+    )
+if requests:
+    _TRANSIENT_ERRORS += (
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        requests.exceptions.ChunkedEncodingError,
+    )
+if auth_exceptions:
+    _TRANSIENT_ERRORS += (auth_exceptions.TransportError,)
+
+# Absolute time.monotonic() by which the current job must finish
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when a job runs out of time."""
+
+
+@contextmanager
+def deadline(seconds: float):
+    """Bounds everything in the block, and in threads it hands work to, to seconds"""
+    current = _deadline.get()
+    ends = time.monotonic() + seconds
+    token = _deadline.set(ends if current is None else min(current, ends))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> float:
+    """Seconds left before the current deadline, or None without one"""
+    ends = _deadline.get()
+    return None if ends is None else ends - time.monotonic()
+
+
+def stage_timeout(limit: float) -> float:
+    """The limit of one stage, cut to what is left of the deadline"""
+    left = remaining()
+    if left is None:
+        return limit
+    if left <= 0:
+        raise DeadlineExceeded("Job deadline exceeded")
+    return min(limit, left) if limit else left
+
+
+def is_transient(error: BaseException) -> bool:
+    """Whether error, or an error it was raised from, is worth retrying"""
+    while error is not None:
+        if isinstance(error, DeadlineExceeded):
+            return False
+        if isinstance(error, _TRANSIENT_ERRORS) or type(error) is TimeoutError:
+            return True
+        error = error.__cause__
+    return False
+
+
+def backoff(attempt: int, base: float = RETRY_BASE_SECONDS, cap: float = RETRY_MAX_SECONDS) -> float:
+    """Full jitter: a random wait up to base * 2^attempt, capped"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def _has_time_for(delay: float) -> bool:
+    left = remaining()
+    return left is None or delay < left
+
+
+def call(fn, *args, stage: str, timeout: float = None, attempts: int = RETRY_ATTEMPTS, **kwargs):
+    """
+    Calls fn(*args, **kwargs), retrying transient errors with backoff.
+
+    Args:
+        fn: Idempotent call to make
+        stage: Name the retries are counted under
+        timeout: Limit per attempt, passed to fn as its timeout argument
+            after cutting it to the deadline; fn gets none when not given
+        attempts: Attempts in all, the first included
+    """
+    for attempt in range(attempts):
+        if timeout is not None:
+            kwargs["timeout"] = stage_timeout(timeout)
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            delay = backoff(attempt)
+            if attempt + 1 >= attempts or not is_transient(e) or not _has_time_for(delay):
+                raise
+            logger.warning(
+                f"{stage} failed ({type(e).__name__}: {str(e)[:200]}), "
+                f"retrying in {delay:.2f}s ({attempt + 1}/{attempts - 1})"
+            )
+            metrics.observe_retry(stage)
+            time.sleep(delay)
+
+
+def run_job(run, on_retry=None, retryable=is_transient, max_attempts: int = JOB_MAX_ATTEMPTS):
+    """
+    Runs a job under JOB_DEADLINE_SECONDS, running it again after a
+    retryable failure while its attempts and deadline last.
+
+    Args:
+        run: Called with the attempt number, starting at 1
+        on_retry: Called with the attempt number and the error before the
+            job is run again, e.g. to record it on the job
+        retryable: Decides whether an error is worth another run
+        max_attempts: Runs in all, the first included
+    """
+    with deadline(JOB_DEADLINE_SECONDS):
+        attempt = 1
+        while True:
+            try:
+                return run(attempt)
+            except Exception as e:
+                delay = backoff(attempt - 1, JOB_RETRY_BASE_SECONDS, JOB_RETRY_MAX_SECONDS)
+                if attempt >= max_attempts or not retryable(e) or not _has_time_for(delay):
+                    raise
+                logger.warning(
+                    f"Job attempt {attempt}/{max_attempts} failed ({type(e).__name__}: {str(e)[:200]}), "
+                    f"running it again in {delay:.2f}s"
+                )
+                metrics.observe_retry("job")
+                if on_retry:
+                    on_retry(attempt, e)
+                time.sleep(delay)
+                attempt += 1
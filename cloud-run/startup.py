@@ -0,0 +1,147 @@
+"""
+Instance warm-up for the Cloud Run container.
+
+main imports this module before anything else and calls begin() once the app
+is loaded. A background thread then, all at the same time, builds the
+Firebase clients, starts the fill processes and converts a throwaway
+document on every LibreOffice worker, so soffice has its profile, font
+cache and first-load costs behind it before a user's job arrives.
+
+A phase that fails, e.g. on a transient credentials error, is retried with
+backoff until it succeeds. /readyz answers 200 only when every phase has
+finished; the Cloud Run startup probe (see deploy-cloudrun in the Makefile)
+points there, so no request is routed to a cold instance, and an instance
+that never gets ready is replaced.
+"""
+import logging
+import os
+import threading
+import time
+
+# Taken before the service's own modules load, so it marks the start of the
+# app import
+STARTED = time.monotonic()
+
+from concurrent.futures import ThreadPoolExecutor
+
+from docx import Document
+
+import firestore_utils
+import libreoffice_pool
+import libreoffice_utils
+import metrics
+import resilience
+
+logger = logging.getLogger(__name__)
+
+# Set to false to skip the warm-up and report ready as soon as the app loads
+WARMUP = os.getenv("WARMUP", "true").lower() == "true"
+# Backoff between runs of a failed warm-up phase
+WARMUP_RETRY_BASE_SECONDS = float(os.getenv("WARMUP_RETRY_BASE_SECONDS", "1"))
+WARMUP_RETRY_MAX_SECONDS = float(os.getenv("WARMUP_RETRY_MAX_SECONDS", "30"))
+
+_state = {"ready": False, "warming": False, "timings": {}, "errors": {}}
+_state_lock = threading.Lock()
+
+
+def begin() -> None:
+    """Records how long the app took to import and starts the warm-up"""
+    _record("import", time.monotonic() - STARTED)
+    with _state_lock:
+        if _state["warming"] or _state["ready"]:
+            return
+        if not WARMUP:
+            _state["ready"] = True
+            return
+        _state["warming"] = True
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+
+def warm_up() -> None:
+    phases = {
+        "clients": firestore_utils.init_clients,
+        "fill_pool": _warm_fill_pool,
+        "libreoffice": _warm_libreoffice,
+    }
+    with ThreadPoolExecutor(max_workers=len(phases), thread_name_prefix="warm-up") as executor:
+        for future in [executor.submit(_run_phase, name, phase) for name, phase in phases.items()]:
+            future.result()
+
+    _record("ready", time.monotonic() - STARTED)
+    with _state_lock:
+        _state["warming"] = False
+        _state["ready"] = True
+        timings = dict(_state["timings"])
+    print(f"Warm-up finished: {timings}")
+
+
+def is_ready() -> bool:
+    with _state_lock:
+        return _state["ready"]
+
+
+def status() -> dict:
+    with _state_lock:
+        return {
+            "ready": _state["ready"],
+            "warming": _state["warming"],
+            "timings": dict(_state["timings"]),
+            "errors": dict(_state["errors"]),
+        }
+
+
+def _run_phase(name: str, phase) -> None:
+    """Runs a warm-up phase until it succeeds; its last error shows in status() meanwhile"""
+    attempt = 0
+    while True:
+        try:
+            _timed(name, phase)
+            with _state_lock:
+                _state["errors"].pop(name, None)
+            return
+        except Exception as e:
+            delay = resilience.backoff(attempt, WARMUP_RETRY_BASE_SECONDS, WARMUP_RETRY_MAX_SECONDS)
+            logger.error(
+                f"Warm-up phase {name} failed (attempt {attempt + 1}), retrying in {delay:.2f}s: {str(e)}",
+                exc_info=True
+            )
+            with _state_lock:
+                _state["errors"][name] = str(e)
+            metrics.observe_retry(f"warm_up_{name}")
+            time.sleep(delay)
+            attempt += 1
+
+
+def _timed(name: str, phase) -> None:
+    phase_started = time.monotonic()
+    phase()
+    _record(name, time.monotonic() - phase_started)
+
+
+def _record(phase: str, seconds: float) -> None:
+    with _state_lock:
+        _state["timings"][phase] = round(seconds, 3)
+    metrics.observe_startup(phase, seconds)
+
+
+def _warm_fill_pool() -> None:
+    if libreoffice_utils.FILL_PROCESSES <= 0:
+        return
+    pool = libreoffice_utils.get_fill_pool()
+    # The executor starts a process per task it cannot hand to an idle one
+    futures = [pool.submit(os.getpid) for _ in range(libreoffice_utils.FILL_PROCESSES)]
+    for future in futures:
+        future.result()
+
+
+def _warm_libreoffice() -> None:
+    """Converts a one-line document on every worker"""
+    with libreoffice_utils.job_workspace() as workspace:
+        sample_path = os.path.join(workspace, "warm-up.docx")
+        document = Document()
+        document.add_paragraph("Warm-up")
+        document.save(sample_path)
+        warm_up_started = time.monotonic()
+        first_done = libreoffice_pool.get_pool().warm_up(sample_path, workspace)
+    # Counted from the start of the import: what a first user would have waited
+    _record("first_conversion", warm_up_started + first_done - STARTED)
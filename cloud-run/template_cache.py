@@ -0,0 +1,397 @@
+import io
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+
+from docx import Document
+from lxml import etree
+
+import placeholder_engine
+
+logger = logging.getLogger(__name__)
+
+CACHE_MAX_BYTES = int(os.getenv("TEMPLATE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# Optional local-disk tier; disabled when empty
+CACHE_DIR = os.getenv("TEMPLATE_CACHE_DIR", "")
+CACHE_DISK_MAX_BYTES = int(os.getenv("TEMPLATE_CACHE_DISK_MAX_BYTES", str(1024 * 1024 * 1024)))
+# How long a template's storage generation is trusted before asking GCS again
+GENERATION_TTL_SECONDS = float(os.getenv("TEMPLATE_GENERATION_TTL", "60"))
+# Templates larger than this are downloaded to the spool directory and
+# streamed from there instead of being held in memory
+STREAM_TEMPLATE_BYTES = int(os.getenv("STREAM_TEMPLATE_BYTES", str(32 * 1024 * 1024)))
+SPOOL_DIR = os.getenv("TEMPLATE_SPOOL_DIR") or os.path.join(tempfile.gettempdir(), "template-spool")
+# Spooled packages kept for reuse; on Cloud Run /tmp is held in memory too
+SPOOL_MAX_BYTES = int(os.getenv("TEMPLATE_SPOOL_MAX_BYTES", str(512 * 1024 * 1024)))
+
+INDEX_VERSION = 1
+
+
+class CompiledTemplate:
+    """
+    A downloaded template together with its placeholder location index.
+
+    The index maps each XML part name (as stored in the zip, e.g.
+    "word/document.xml") to the ordinals of the paragraphs that contain
+    placeholders, in document order, and to the placeholder counts:
+
+        {"version": 1, "parts": {"word/document.xml": {
+            "paragraphs": [0, 4], "placeholders": {"name": 2}}}}
+
+    The same index is precomputed by the processtemplate function and saved
+    next to the template; that copy also carries the template "generation".
+
+    Large templates are spooled: content is None and the package is read
+    from path whenever it is opened. Every spooled template has a file of
+    its own, which stays in place while jobs lease it (see
+    TemplateCache.acquire).
+    """
+
+    def __init__(self, template_id: str, generation: str, content: bytes, index: dict,
+                 path: str = None):
+        self.template_id = template_id
+        self.generation = str(generation)
+        self.content = content
+        self.index = index
+        self.path = path
+        # Taken once, so the entry can be accounted for after its file is gone
+        self.spool_bytes = os.path.getsize(path) if content is None else 0
+        self._members = None
+        # Guarded by the cache lock
+        self._leases = 0
+        self._evicted = False
+
+    @property
+    def key(self) -> tuple:
+        return (self.template_id, self.generation)
+
+    @property
+    def size(self) -> int:
+        """Bytes held in memory"""
+        return len(self.content) if self.content is not None else 0
+
+    @property
+    def spooled(self) -> bool:
+        return self.content is None
+
+    @property
+    def package_size(self) -> int:
+        return os.path.getsize(self.path) if self.spooled else len(self.content)
+
+    @property
+    def members(self) -> dict:
+        """Uncompressed size of every zip member, read from the central directory"""
+        if self._members is None:
+            with self.open() as source, zipfile.ZipFile(source) as package:
+                self._members = {info.filename: info.file_size for info in package.infolist()}
+        return self._members
+
+    @property
+    def placeholders(self) -> set:
+        return {
+            name
+            for part in self.index["parts"].values()
+            for name in part["placeholders"]
+        }
+
+    def open(self):
+        """Returns a file-like object over the template bytes"""
+        if self.spooled:
+            return open(self.path, "rb")
+        return io.BytesIO(self.content)
+
+
+def _index_part(root) -> dict:
+    paragraphs = []
+    counts = {}
+    for ordinal, paragraph in enumerate(placeholder_engine.iter_paragraphs(root)):
+        nodes = placeholder_engine.paragraph_text_nodes(paragraph)
+        text = "".join(node.text or "" for node in nodes)
+        names = placeholder_engine.PLACEHOLDER_PATTERN.findall(text)
+        if names:
+            paragraphs.append(ordinal)
+            for name in names:
+                counts[name] = counts.get(name, 0) + 1
+    if not paragraphs:
+        return None
+    return {"paragraphs": paragraphs, "placeholders": counts}
+
+
+def build_index(document) -> dict:
+    """Records where placeholders occur in a python-docx Document"""
+    parts = {}
+    for part in document.part.package.iter_parts():
+        if not placeholder_engine.is_template_part(part.partname) or not hasattr(part, "element"):
+            continue
+        located = _index_part(part.element)
+        if located:
+            parts[str(part.partname).lstrip("/")] = located
+    return {"version": INDEX_VERSION, "parts": parts}
+
+
+def build_package_index(template) -> dict:
+    """
+    Same as build_index, but reads the zip package directly and parses one
+    template part at a time, so large packages are never loaded whole.
+    """
+    parser = etree.XMLParser(remove_blank_text=True, resolve_entities=False)
+    parts = {}
+    with zipfile.ZipFile(template) as package:
+        for info in package.infolist():
+            if not placeholder_engine.is_template_part(info.filename):
+                continue
+            located = _index_part(etree.fromstring(package.read(info), parser))
+            if located:
+                parts[info.filename] = located
+    return {"version": INDEX_VERSION, "parts": parts}
+
+
+def spool_path(template_id: str, generation: str) -> str:
+    """
+    Creates the empty file a large template's package is kept in while it
+    is in use. Every call gets a new file, so removing the file of an
+    evicted entry never touches a newer download of the same template.
+    """
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    safe_id = re.sub(r"[^A-Za-z0-9_-]", "_", template_id)
+    fd, path = tempfile.mkstemp(prefix=f"{safe_id}-{generation}-", suffix=".docx", dir=SPOOL_DIR)
+    os.close(fd)
+    return path
+
+
+def index_matches(index: dict, generation: str) -> bool:
+    """
+    Checks that a precomputed index (the sidecar saved by processtemplate)
+    has a format this service understands and was built from this generation
+    """
+    return (
+        isinstance(index, dict)
+        and index.get("version") == INDEX_VERSION
+        and str(index.get("generation")) == str(generation)
+        and isinstance(index.get("parts"), dict)
+    )
+
+
+def compile_template(template_id: str, generation: str, content: bytes) -> CompiledTemplate:
+    document = Document(io.BytesIO(content))
+    return CompiledTemplate(template_id, generation, content, build_index(document))
+
+
+class TemplateCache:
+    """
+    Size-bounded LRU of compiled templates keyed by (templateId, generation),
+    with an optional local-disk tier that survives memory evictions.
+
+    Spooled templates are bounded separately, by the size of their files
+    against spool_max_bytes. Jobs lease a spooled template for as long as
+    they use it; its file is removed once it has left the cache and the
+    last lease is released.
+    """
+
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES, cache_dir: str = CACHE_DIR,
+                 disk_max_bytes: int = CACHE_DISK_MAX_BYTES, spool_max_bytes: int = SPOOL_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.spool_max_bytes = spool_max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._spool_bytes = 0
+        self._lock = threading.Lock()
+        self._generations = {}
+        self.hits = 0
+        self.misses = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, template_id: str, generation: str) -> CompiledTemplate:
+        key = (template_id, str(generation))
+        with self._lock:
+            compiled = self._entries.get(key)
+            if compiled is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return compiled
+
+        compiled = self._load_from_disk(template_id, str(generation))
+        with self._lock:
+            if compiled is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._store(compiled)
+        return compiled
+
+    def put(self, compiled: CompiledTemplate) -> None:
+        self._store(compiled)
+        self._save_to_disk(compiled)
+
+    def acquire(self, compiled: CompiledTemplate) -> bool:
+        """
+        Leases a template so a spooled one keeps its file until release().
+
+        Returns:
+            False when the template was evicted and its file removed before
+            it could be leased; the caller has to fetch it again
+        """
+        with self._lock:
+            if compiled._evicted and compiled._leases == 0:
+                return False
+            compiled._leases += 1
+            return True
+
+    def release(self, compiled: CompiledTemplate) -> None:
+        with self._lock:
+            compiled._leases -= 1
+            remove = compiled._evicted and compiled._leases == 0
+        if remove:
+            self._remove_spool(compiled)
+
+    def remember_generation(self, template_id: str, generation: str) -> None:
+        with self._lock:
+            self._generations[template_id] = (str(generation), time.monotonic())
+
+    def known_generation(self, template_id: str) -> str:
+        """Returns the template's generation if it was checked within the TTL"""
+        with self._lock:
+            entry = self._generations.get(template_id)
+        if entry and time.monotonic() - entry[1] < GENERATION_TTL_SECONDS:
+            return entry[0]
+        return None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "spool_bytes": self._spool_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _store(self, compiled: CompiledTemplate) -> None:
+        # A spooled template over the spool budget is still kept, alone, so
+        # its file is removed once something else takes its place
+        if compiled.size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(compiled.key, None)
+            dropped = [previous] if previous is not None and previous is not compiled else []
+            if previous is not None:
+                self._forget(previous)
+            self._entries[compiled.key] = compiled
+            self._bytes += compiled.size
+            self._spool_bytes += compiled.spool_bytes
+            # Drop older generations of the same template and the least recently used
+            older = [self._entries.pop(k) for k in list(self._entries)
+                     if k[0] == compiled.template_id and k != compiled.key]
+            for entry in older:
+                self._forget(entry)
+            dropped.extend(older)
+            dropped.extend(self._evict(lambda: self._bytes > self.max_bytes, spooled=False, keep=compiled))
+            dropped.extend(self._evict(lambda: self._spool_bytes > self.spool_max_bytes, spooled=True, keep=compiled))
+            unused = []
+            for entry in dropped:
+                entry._evicted = True
+                # Leased files are removed by the last release()
+                if entry.spooled and entry._leases == 0:
+                    unused.append(entry)
+        for entry in unused:
+            self._remove_spool(entry)
+
+    def _evict(self, over_budget, spooled: bool, keep: CompiledTemplate) -> list:
+        """Drops the least recently used entries of one kind while over_budget() holds"""
+        evicted = []
+        for key in list(self._entries):
+            if not over_budget():
+                break
+            entry = self._entries[key]
+            if entry.spooled == spooled and entry is not keep:
+                del self._entries[key]
+                self._forget(entry)
+                evicted.append(entry)
+        return evicted
+
+    def _forget(self, entry: CompiledTemplate) -> None:
+        self._bytes -= entry.size
+        self._spool_bytes -= entry.spool_bytes
+
+    def _remove_spool(self, entry: CompiledTemplate) -> None:
+        if not entry.spooled:
+            return
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+    def _disk_paths(self, template_id: str, generation: str) -> tuple:
+        safe_id = re.sub(r"[^A-Za-z0-9_-]", "_", template_id)
+        base = os.path.join(self.cache_dir, f"{safe_id}-{generation}")
+        return base + ".docx", base + ".index.json"
+
+    def _load_from_disk(self, template_id: str, generation: str) -> CompiledTemplate:
+        if not self.cache_dir:
+            return None
+        content_path, index_path = self._disk_paths(template_id, generation)
+        try:
+            with open(content_path, "rb") as f:
+                content = f.read()
+            with open(index_path) as f:
+                index = json.load(f)
+            if index.get("version") != INDEX_VERSION:
+                return None
+            os.utime(content_path)
+            return CompiledTemplate(template_id, generation, content, index)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable cached template {content_path}: {e}")
+            return None
+
+    def _save_to_disk(self, compiled: CompiledTemplate) -> None:
+        # Spooled packages already live on disk
+        if not self.cache_dir or compiled.spooled:
+            return
+        content_path, index_path = self._disk_paths(compiled.template_id, compiled.generation)
+        try:
+            for path, data, mode in (
+                (content_path, compiled.content, "wb"),
+                (index_path, json.dumps(compiled.index), "w"),
+            ):
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, mode) as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            self._trim_disk()
+        except Exception as e:
+            logger.warning(f"Could not write template {compiled.template_id} to disk cache: {e}")
+
+    def _trim_disk(self) -> None:
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".docx"):
+                path = os.path.join(self.cache_dir, name)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            for stale in (path, path[:-len(".docx")] + ".index.json"):
+                try:
+                    os.remove(stale)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+
+_cache = TemplateCache()
+
+
+def get_cache() -> TemplateCache:
+    return _cache
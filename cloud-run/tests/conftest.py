@@ -0,0 +1,56 @@
+import io
+import os
+import sys
+
+import pytest
+from docx import Document
+
+# The service modules are imported flat, the way gunicorn loads them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _add_runs(paragraph, runs):
+    for run in runs:
+        if isinstance(run, tuple):
+            text, bold = run
+            paragraph.add_run(text).bold = bold
+        else:
+            paragraph.add_run(run)
+
+
+@pytest.fixture
+def build_docx():
+    """
+    Builds a .docx from lists of runs, one list per paragraph, so tests can
+    split placeholders across runs the way Word does. A run given as
+    (text, True) is bold.
+    """
+    def build(paragraphs, header=None, table=None) -> bytes:
+        document = Document()
+        for runs in paragraphs:
+            _add_runs(document.add_paragraph(), runs)
+        if header:
+            _add_runs(document.sections[0].header.paragraphs[0], header)
+        if table:
+            cells = document.add_table(rows=1, cols=len(table)).rows[0].cells
+            for cell, runs in zip(cells, table):
+                _add_runs(cell.paragraphs[0], runs)
+        buffer = io.BytesIO()
+        document.save(buffer)
+        return buffer.getvalue()
+    return build
+
+
+def document_text(content: bytes) -> list:
+    """Text of every body, table and header paragraph of a .docx"""
+    document = Document(io.BytesIO(content))
+    texts = [paragraph.text for paragraph in document.paragraphs]
+    for table in document.tables:
+        texts.extend(cell.text for row in table.rows for cell in row.cells)
+    texts.extend(paragraph.text for paragraph in document.sections[0].header.paragraphs)
+    return texts
+
+
+@pytest.fixture
+def docx_text():
+    return document_text
@@ -0,0 +1,77 @@
+import io
+
+import pytest
+
+import incremental
+import ooxml_fill
+import render_cache
+import template_cache
+
+FIRST = {"name": "Ada", "city": {"value": "London"}, "ref": "R-1"}
+
+
+@pytest.fixture
+def template(build_docx):
+    content = build_docx(
+        [["Dear {{na", "me}},"], ["You live in {{city}}."], ["Plain paragraph"]],
+        header=["Ref {{ref}}"],
+    )
+    return template_cache.compile_template("t", "7", content)
+
+
+def state_for(template, form_data: dict) -> dict:
+    digests = incremental.field_digests(template, form_data)
+    return incremental.render_state(template, digests, {"docx": ("forms/f/t_filled.docx", "url")})
+
+
+def fill(template, form_data: dict) -> bytes:
+    output = io.BytesIO()
+    ooxml_fill.fill_package(template.open(), output, form_data, template.index)
+    return output.getvalue()
+
+
+def test_changed_fields_lists_only_changed_values(template):
+    state = state_for(template, FIRST)
+    digests = incremental.field_digests(template, {**FIRST, "city": {"value": "Paris"}})
+    assert incremental.changed_fields(state, template, digests) == {"city"}
+
+
+def test_unchanged_form_has_no_changed_fields(template):
+    state = state_for(template, FIRST)
+    assert incremental.changed_fields(state, template, incremental.field_digests(template, FIRST)) == set()
+
+
+def test_missing_field_counts_as_changed(template):
+    state = state_for(template, FIRST)
+    digests = incremental.field_digests(template, {"name": "Ada", "city": {"value": "London"}})
+    assert incremental.changed_fields(state, template, digests) == {"ref"}
+
+
+@pytest.mark.parametrize("stale", [
+    None,
+    {"version": render_cache.RENDER_VERSION - 1},
+    {"templateId": "other"},
+    {"generation": "6"},
+    {"fields": None},
+])
+def test_unusable_state_means_full_render(template, stale):
+    digests = incremental.field_digests(template, FIRST)
+    state = None if stale is None else {**state_for(template, FIRST), **stale}
+    assert incremental.changed_fields(state, template, digests) is None
+
+
+def test_patch_matches_a_full_render(template, docx_text):
+    previous = fill(template, FIRST)
+    second = {**FIRST, "name": "Grace", "ref": "R-2"}
+    output = io.BytesIO()
+
+    replaced = incremental.patch_docx(template, io.BytesIO(previous), output, second, {"name", "ref"})
+
+    assert replaced == 2
+    assert docx_text(output.getvalue()) == docx_text(fill(template, second))
+
+
+def test_patch_rejects_a_docx_from_another_template(template, build_docx):
+    other = build_docx([["Dear {{name}},"]], header=["Ref {{ref}}"])
+    with pytest.raises(incremental.PatchMismatch):
+        incremental.patch_docx(template, io.BytesIO(other), io.BytesIO(), FIRST, {"name"})
@@ -0,0 +1,114 @@
+import threading
+
+import pytest
+
+import job_queue
+
+
+class Recorder:
+    """Handler that records the order jobs start in and holds each until released"""
+
+    def __init__(self):
+        self.started = []
+        self.gate = threading.Event()
+        self.done = threading.Semaphore(0)
+        self._condition = threading.Condition()
+
+    def __call__(self, job_id, form_id):
+        with self._condition:
+            self.started.append(job_id)
+            self._condition.notify_all()
+        self.gate.wait(5)
+        self.done.release()
+
+    def wait_started(self, count: int):
+        with self._condition:
+            assert self._condition.wait_for(lambda: len(self.started) >= count, timeout=5)
+
+    def wait_for(self, count: int):
+        for _ in range(count):
+            assert self.done.acquire(timeout=5)
+
+
+def run_in_order(submissions, weights=None) -> list:
+    """Submits jobs behind one blocking job on a single worker and returns the dispatch order"""
+    handler = Recorder()
+    queue = job_queue.JobQueue(handler, workers=1, max_running=1, weights=weights or {})
+    queue.submit("blocker", "f", office_id="z")
+    handler.wait_started(1)
+    for office_id, job_id in submissions:
+        queue.submit(job_id, "f", office_id=office_id)
+    handler.gate.set()
+    handler.wait_for(len(submissions) + 1)
+    return handler.started[1:]
+
+
+def test_offices_take_turns():
+    order = run_in_order([("a", "a1"), ("a", "a2"), ("a", "a3"), ("a", "a4"), ("b", "b1"), ("b", "b2")])
+    assert order == ["a1", "b1", "a2", "b2", "a3", "a4"]
+
+
+def test_weights_share_capacity():
+    submissions = [("a", f"a{i}") for i in range(4)] + [("b", f"b{i}") for i in range(4)]
+    order = run_in_order(submissions, weights={"a": 2})
+    # Office a is served twice as often while both have work
+    assert [job[0] for job in order[:6]].count("a") == 4
+
+
+def test_office_cap_leaves_workers_for_others():
+    handler = Recorder()
+    queue = job_queue.JobQueue(handler, workers=2, max_running=1, weights={})
+    for job_id in ("a1", "a2"):
+        queue.submit(job_id, "f", office_id="a")
+    queue.submit("b1", "f", office_id="b")
+    try:
+        # a2 waits for a1; the second worker goes to b1
+        handler.wait_started(2)
+        assert sorted(handler.started) == ["a1", "b1"]
+    finally:
+        handler.gate.set()
+        handler.wait_for(3)
+
+
+def test_duplicate_submission_is_queued_once():
+    handler = Recorder()
+    queue = job_queue.JobQueue(handler, workers=1, max_running=1, weights={})
+    queue.submit("blocker", "f", office_id="z")
+    handler.wait_started(1)
+    queue.submit("a1", "f", office_id="a")
+    queue.submit("a1", "f", office_id="a")
+    assert queue.stats()["queued"] == 1
+    handler.gate.set()
+    handler.wait_for(2)
+
+
+def test_office_queue_limit():
+    handler = Recorder()
+    queue = job_queue.JobQueue(handler, workers=1, max_running=1, office_queue_size=1, weights={})
+    queue.submit("blocker", "f", office_id="a")
+    handler.wait_started(1)
+    queue.submit("a1", "f", office_id="a")
+    try:
+        with pytest.raises(job_queue.QueueFull):
+            queue.submit("a2", "f", office_id="a")
+    finally:
+        handler.gate.set()
+        handler.wait_for(2)
+
+
+def test_drain_fails_queued_and_unfinished_jobs():
+    handler = Recorder()
+    queue = job_queue.JobQueue(handler, workers=1, max_running=1, weights={})
+    queue.submit("running", "f1", office_id="a")
+    handler.wait_started(1)
+    queue.submit("queued", "f2", office_id="a")
+    dropped, interrupted = [], []
+    try:
+        queue.drain(lambda *job: dropped.append(job), lambda *job: interrupted.append(job), grace=0.1)
+        assert dropped == [("queued", "f2")]
+        assert interrupted == [("running", "f1")]
+        with pytest.raises(job_queue.QueueFull):
+            queue.submit("late", "f3", office_id="a")
+    finally:
+        handler.gate.set()
+        handler.wait_for(1)
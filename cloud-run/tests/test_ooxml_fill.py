@@ -0,0 +1,83 @@
+import io
+import zipfile
+
+import pytest
+
+import libreoffice_utils
+import ooxml_fill
+import template_cache
+
+FORM_DATA = {
+    "name": {"value": "Ada Lovelace"},
+    "city": "London",
+    "ref": {"value": "R-42"},
+    "note": "  padded  ",
+}
+
+
+@pytest.fixture
+def template(build_docx):
+    return build_docx(
+        [
+            ["Dear {{na", "me}},"],
+            [("{{city}}", True), " is ", "{{unknown}}"],
+            ["No placeholders here"],
+            ["{{note}}|{{name}}"],
+        ],
+        header=["Ref {{r", "ef}}"],
+        table=[["{{city}}"], ["{{na", "me}}"]],
+    )
+
+
+def fill_docx(template: bytes, index: dict = None) -> tuple:
+    output = io.BytesIO()
+    replaced = libreoffice_utils.fill_word_template(io.BytesIO(template), output, FORM_DATA, index)
+    return replaced, output.getvalue()
+
+
+def fill_ooxml(template: bytes, index: dict = None) -> tuple:
+    output = io.BytesIO()
+    replaced = ooxml_fill.fill_package(io.BytesIO(template), output, FORM_DATA, index)
+    return replaced, output.getvalue()
+
+
+def test_ooxml_matches_docx_engine(template, docx_text):
+    docx_replaced, docx_output = fill_docx(template)
+    ooxml_replaced, ooxml_output = fill_ooxml(template)
+
+    assert ooxml_replaced == docx_replaced == 7
+    assert docx_text(ooxml_output) == docx_text(docx_output)
+    assert "Dear Ada Lovelace," in docx_text(ooxml_output)
+    assert "  padded  |Ada Lovelace" in docx_text(ooxml_output)
+    assert "Ref R-42" in docx_text(ooxml_output)
+
+
+def test_index_gives_the_same_output(template, docx_text):
+    compiled = template_cache.compile_template("t", "1", template)
+
+    assert fill_ooxml(template, compiled.index) == fill_ooxml(template)
+    assert docx_text(fill_docx(template, compiled.index)[1]) == docx_text(fill_docx(template)[1])
+
+
+def test_untouched_members_are_copied_verbatim(template):
+    _, output = fill_ooxml(template)
+
+    with zipfile.ZipFile(io.BytesIO(template)) as before, zipfile.ZipFile(io.BytesIO(output)) as after:
+        assert after.testzip() is None
+        assert after.namelist() == before.namelist()
+        for info in before.infolist():
+            if info.filename in ("word/document.xml", "word/header1.xml"):
+                continue
+            copied = after.getinfo(info.filename)
+            assert (copied.CRC, copied.compress_size, copied.compress_type) == (
+                info.CRC, info.compress_size, info.compress_type
+            )
+
+
+def test_template_without_matches_is_copied_whole(build_docx):
+    template = build_docx([["Nothing to fill"]])
+    output = io.BytesIO()
+
+    assert ooxml_fill.fill_package(io.BytesIO(template), output, FORM_DATA) == 0
+    with zipfile.ZipFile(output) as package:
+        assert package.testzip() is None
@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+import pdf_export
+
+
+@pytest.fixture(autouse=True)
+def no_env_defaults(monkeypatch):
+    for name in ("PDF_A_VERSION", "PDF_IMAGE_QUALITY", "PDF_MAX_IMAGE_RESOLUTION"):
+        monkeypatch.setattr(pdf_export, name, "")
+
+
+def test_defaults_leave_filter_data_empty():
+    assert pdf_export.filter_data(None) == {}
+    assert pdf_export.filter_data({}) == {}
+
+
+def test_maps_options_to_filter_data():
+    data = pdf_export.filter_data({"pdfA": True, "imageQuality": 80, "maxImageResolution": 300})
+    assert data == {
+        "SelectPdfVersion": 2,
+        "Quality": 80,
+        "UseLosslessCompression": False,
+        "ReduceImageResolution": True,
+        "MaxImageResolution": 300,
+    }
+
+
+def test_lossless_images_override_quality():
+    data = pdf_export.filter_data({"imageQuality": 50, "losslessImages": True})
+    assert data["UseLosslessCompression"] is True
+
+
+@pytest.mark.parametrize("options", [
+    "pdfA",
+    {"unknown": 1},
+    {"pdfA": 4},
+    {"pdfA": 2.0},
+    {"pdfA": "2"},
+    {"imageQuality": 0},
+    {"imageQuality": 101},
+    {"imageQuality": 90.5},
+    {"imageQuality": True},
+    {"losslessImages": 1},
+    {"maxImageResolution": 299},
+    {"maxImageResolution": 300.0},
+    {"maxImageResolution": True},
+])
+def test_rejects_invalid_options(options):
+    with pytest.raises(ValueError):
+        pdf_export.filter_data(options)
+
+
+def test_environment_defaults_apply_to_omitted_options(monkeypatch):
+    monkeypatch.setattr(pdf_export, "PDF_MAX_IMAGE_RESOLUTION", "150")
+    assert pdf_export.filter_data({})["MaxImageResolution"] == 150
+    assert pdf_export.filter_data({"maxImageResolution": 600})["MaxImageResolution"] == 600
+
+
+def test_convert_to_argument_types_values():
+    assert pdf_export.convert_to_argument({}) == "pdf"
+    argument = pdf_export.convert_to_argument({"SelectPdfVersion": 2, "UseLosslessCompression": True})
+    prefix = f"pdf:{pdf_export.PDF_FILTER}:"
+    assert argument.startswith(prefix)
+    assert json.loads(argument[len(prefix):]) == {
+        "SelectPdfVersion": {"type": "long", "value": "2"},
+        "UseLosslessCompression": {"type": "boolean", "value": "true"},
+    }
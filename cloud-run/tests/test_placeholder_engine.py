@@ -0,0 +1,71 @@
+import io
+
+from docx import Document
+from lxml import etree
+
+import placeholder_engine
+
+W = placeholder_engine.W_NS
+
+
+def paragraph(*runs):
+    xml = "".join(f'<w:r><w:t xml:space="preserve">{text}</w:t></w:r>' for text in runs)
+    return etree.fromstring(f'<w:p xmlns:w="{W}">{xml}</w:p>')
+
+
+def texts(element):
+    return [node.text or "" for node in element.iter(placeholder_engine.W_T)]
+
+
+def test_replaces_placeholder_in_one_run():
+    p = paragraph("Dear {{name}},")
+    assert placeholder_engine.substitute_paragraph(p, {"name": "Ada"}) == 1
+    assert texts(p) == ["Dear Ada,"]
+
+
+def test_replaces_placeholder_split_across_runs():
+    p = paragraph("Dear {{na", "m", "e}}, welcome")
+    assert placeholder_engine.substitute_paragraph(p, {"name": "Ada"}) == 1
+    # The value goes where the placeholder starts; the rest is trimmed from the following runs
+    assert texts(p) == ["Dear Ada", "", ", welcome"]
+
+
+def test_replaces_several_placeholders_sharing_runs():
+    p = paragraph("{{first}} {{la", "st}} and {{first}}")
+    assert placeholder_engine.substitute_paragraph(p, {"first": "Ada", "last": "Lovelace"}) == 3
+    assert "".join(texts(p)) == "Ada Lovelace and Ada"
+
+
+def test_leaves_unknown_placeholders():
+    p = paragraph("{{known}} {{unknown}}")
+    assert placeholder_engine.substitute_paragraph(p, {"known": "x"}) == 1
+    assert texts(p) == ["x {{unknown}}"]
+
+
+def test_normalize_values_reads_modal_fields():
+    values = placeholder_engine.normalize_values({"a": {"value": 3}, "b": "text", "c": {}})
+    assert values == {"a": "3", "b": "text", "c": ""}
+
+
+def test_fill_part_visits_only_given_ordinals():
+    root = etree.fromstring(
+        f'<w:body xmlns:w="{W}">'
+        '<w:p><w:r><w:t>{{a}}</w:t></w:r></w:p>'
+        '<w:p><w:r><w:t>{{a}}</w:t></w:r></w:p>'
+        '</w:body>'
+    )
+    assert placeholder_engine.fill_part(root, {"a": "x"}, [1]) == 1
+    assert texts(root) == ["{{a}}", "x"]
+
+
+def test_fill_document_keeps_run_formatting(build_docx):
+    content = build_docx([[("{{na", True), ("me}}", False), " signed"]], header=["Ref {{ref}}"])
+    document = Document(io.BytesIO(content))
+
+    replaced = placeholder_engine.fill_document(document, {"name": "Ada", "ref": {"value": "R-1"}})
+
+    assert replaced == 2
+    runs = document.paragraphs[0].runs
+    assert runs[0].text == "Ada" and runs[0].bold
+    assert document.paragraphs[0].text == "Ada signed"
+    assert document.sections[0].header.paragraphs[0].text == "Ref R-1"
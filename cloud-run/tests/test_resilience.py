@@ -0,0 +1,88 @@
+import time
+
+import pytest
+
+import resilience
+
+
+@pytest.fixture(autouse=True)
+def no_waiting(monkeypatch):
+    monkeypatch.setattr(resilience, "backoff", lambda attempt, *args: 0.0)
+
+
+class Flaky:
+    """Fails with the given errors, in order, then returns "ok" """
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = []
+
+    def __call__(self, *args, **kwargs):
+        self.calls.append(kwargs)
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+def test_call_retries_transient_errors():
+    fn = Flaky(ConnectionError("reset"), TimeoutError("slow"))
+    assert resilience.call(fn, stage="test") == "ok"
+    assert len(fn.calls) == 3
+
+
+def test_call_raises_permanent_errors_at_once():
+    fn = Flaky(ValueError("bad request"))
+    with pytest.raises(ValueError):
+        resilience.call(fn, stage="test")
+    assert len(fn.calls) == 1
+
+
+def test_call_gives_up_after_its_attempts():
+    fn = Flaky(*[ConnectionError("reset")] * 5)
+    with pytest.raises(ConnectionError):
+        resilience.call(fn, stage="test", attempts=3)
+    assert len(fn.calls) == 3
+
+
+def test_transient_cause_is_retried():
+    wrapped = PermissionError("storage failed")
+    wrapped.__cause__ = ConnectionError("reset")
+    assert resilience.is_transient(wrapped)
+    assert not resilience.is_transient(resilience.DeadlineExceeded("late"))
+
+
+def test_call_cuts_timeout_to_the_deadline():
+    fn = Flaky()
+    with resilience.deadline(5):
+        resilience.call(fn, stage="test", timeout=60)
+    assert 0 < fn.calls[0]["timeout"] <= 5
+
+
+def test_call_without_time_left_raises_deadline_exceeded():
+    fn = Flaky()
+    with resilience.deadline(0.01):
+        time.sleep(0.02)
+        with pytest.raises(resilience.DeadlineExceeded):
+            resilience.call(fn, stage="test", timeout=60)
+    assert fn.calls == []
+
+
+def test_nested_deadline_never_extends_the_outer_one():
+    with resilience.deadline(1):
+        with resilience.deadline(60):
+            assert resilience.remaining() <= 1
+    assert resilience.remaining() is None
+
+
+def test_run_job_reruns_retryable_failures():
+    retries = []
+    run = Flaky(ConnectionError("reset"))
+    assert resilience.run_job(run, on_retry=lambda attempt, error: retries.append(attempt)) == "ok"
+    assert retries == [1]
+
+
+def test_run_job_stops_at_max_attempts():
+    run = Flaky(*[ConnectionError("reset")] * 5)
+    with pytest.raises(ConnectionError):
+        resilience.run_job(run, max_attempts=2)
+    assert len(run.calls) == 2
@@ -0,0 +1,87 @@
+import os
+import zipfile
+
+import pytest
+
+import template_cache
+
+
+@pytest.fixture
+def spool_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(template_cache, "SPOOL_DIR", str(tmp_path))
+    return tmp_path
+
+
+def spooled(template_id: str, size: int = 1000) -> template_cache.CompiledTemplate:
+    path = template_cache.spool_path(template_id, "1")
+    with zipfile.ZipFile(path, "w") as package:
+        package.writestr("word/document.xml", b"x" * size)
+    return template_cache.CompiledTemplate(template_id, "1", None, {"version": 1, "parts": {}}, path=path)
+
+
+def in_memory(template_id: str, size: int, generation: str = "1") -> template_cache.CompiledTemplate:
+    return template_cache.CompiledTemplate(template_id, generation, b"x" * size, {"version": 1, "parts": {}})
+
+
+def test_evicts_least_recently_used():
+    cache = template_cache.TemplateCache(max_bytes=250, cache_dir="")
+    for template_id in ("a", "b"):
+        cache.put(in_memory(template_id, 100))
+    assert cache.get("a", "1") is not None
+    cache.put(in_memory("c", 100))
+
+    assert cache.get("b", "1") is None
+    assert cache.get("a", "1") is not None
+    assert cache.stats()["bytes"] == 200
+
+
+def test_new_generation_replaces_old():
+    cache = template_cache.TemplateCache(cache_dir="")
+    cache.put(in_memory("a", 10, "1"))
+    cache.put(in_memory("a", 10, "2"))
+
+    assert cache.get("a", "1") is None
+    assert cache.get("a", "2") is not None
+
+
+def test_evicted_spool_file_is_removed(spool_dir):
+    first, second = spooled("a"), spooled("b")
+    cache = template_cache.TemplateCache(cache_dir="", spool_max_bytes=first.spool_bytes * 3 // 2)
+    cache.put(first)
+    cache.put(second)
+
+    assert not os.path.exists(first.path)
+    assert cache.stats()["spool_bytes"] == second.spool_bytes
+
+
+def test_leased_spool_file_outlives_eviction(spool_dir):
+    held = spooled("a")
+    cache = template_cache.TemplateCache(cache_dir="", spool_max_bytes=held.spool_bytes * 3 // 2)
+    cache.put(held)
+    assert cache.acquire(held)
+
+    # Evicted while a job still holds it
+    cache.put(spooled("b"))
+    assert cache.get("a", "1") is None
+    assert os.path.exists(held.path)
+    assert held.members == {"word/document.xml": 1000}
+
+    cache.release(held)
+    assert not os.path.exists(held.path)
+    # Gone for good: a job that has not leased it yet must fetch it again
+    assert not cache.acquire(held)
+
+
+def test_respooled_template_gets_its_own_file(spool_dir):
+    held = spooled("a")
+    cache = template_cache.TemplateCache(cache_dir="", spool_max_bytes=held.spool_bytes * 3 // 2)
+    cache.put(held)
+    assert cache.acquire(held)
+    cache.put(spooled("b"))
+
+    again = spooled("a")
+    cache.put(again)
+    cache.release(held)
+
+    assert again.path != held.path
+    assert os.path.exists(again.path)
@@ -0,0 +1,121 @@
+"""
+UNO bridge for a single warm LibreOffice worker.
+
+This script runs under the interpreter that ships the ``uno`` module (the
+system ``python3`` with ``python3-uno`` installed), not under the service's
+own interpreter. It connects to one long-lived ``soffice`` listener and
+serves conversion requests read from stdin, one JSON object per line,
+answering each with one JSON line on stdout.
+
+Requests:
+    {"op": "ping"}
+    {"op": "convert", "input": "/path/in.docx", "output": "/path/out.pdf",
+     "filter": "writer_pdf_Export", "filter_data": {"Quality": 75}}
+    {"op": "convert_many", "documents": [{"input": ..., "output": ...}, ...],
+     "filter": "writer_pdf_Export", "filter_data": {...}}
+
+"filter_data" is optional and holds the export filter's FilterData.
+"""
+import json
+import sys
+import time
+
+import uno
+from com.sun.star.beans import PropertyValue
+from com.sun.star.connection import NoConnectException
+
+
+def make_property(name, value):
+    prop = PropertyValue()
+    prop.Name = name
+    prop.Value = value
+    return prop
+
+
+def connect(port: int, timeout: float):
+    local_context = uno.getComponentContext()
+    resolver = local_context.ServiceManager.createInstanceWithContext(
+        "com.sun.star.bridge.UnoUrlResolver", local_context
+    )
+    url = f"uno:socket,host=127.0.0.1,port={port};urp;StarOffice.ComponentContext"
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            context = resolver.resolve(url)
+            return context.ServiceManager.createInstanceWithContext(
+                "com.sun.star.frame.Desktop", context
+            )
+        except NoConnectException:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.25)
+
+
+def convert(desktop, input_path: str, output_path: str, filter_name: str,
+            filter_data: dict = None) -> None:
+    document = desktop.loadComponentFromURL(
+        uno.systemPathToFileUrl(input_path),
+        "_blank",
+        0,
+        (make_property("Hidden", True), make_property("ReadOnly", True)),
+    )
+    try:
+        arguments = [make_property("FilterName", filter_name)]
+        if filter_data:
+            # FilterData must reach UNO as a sequence of PropertyValue
+            arguments.append(make_property("FilterData", uno.Any(
+                "[]com.sun.star.beans.PropertyValue",
+                tuple(make_property(name, value) for name, value in filter_data.items()),
+            )))
+        document.storeToURL(uno.systemPathToFileUrl(output_path), tuple(arguments))
+    finally:
+        document.close(True)
+
+
+def reply(payload: dict) -> None:
+    sys.stdout.write(json.dumps(payload) + "\n")
+    sys.stdout.flush()
+
+
+def main() -> None:
+    port = int(sys.argv[1])
+    connect_timeout = float(sys.argv[2]) if len(sys.argv) > 2 else 30.0
+    desktop = connect(port, connect_timeout)
+    reply({"ok": True, "ready": True})
+
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            request = json.loads(line)
+            if request.get("op") == "ping":
+                desktop.getCurrentComponent()
+                reply({"ok": True})
+            elif request.get("op") == "convert":
+                convert(
+                    desktop,
+                    request["input"],
+                    request["output"],
+                    request.get("filter", "writer_pdf_Export"),
+                    request.get("filter_data"),
+                )
+                reply({"ok": True})
+            elif request.get("op") == "convert_many":
+                for document in request["documents"]:
+                    convert(
+                        desktop,
+                        document["input"],
+                        document["output"],
+                        request.get("filter", "writer_pdf_Export"),
+                        request.get("filter_data"),
+                    )
+                reply({"ok": True, "converted": len(request["documents"])})
+            else:
+                reply({"ok": False, "error": f"Unknown op: {request.get('op')}"})
+        except Exception as e:
+            reply({"ok": False, "error": str(e)})
+
+
+if __name__ == "__main__":
+    main()
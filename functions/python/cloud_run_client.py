@@ -0,0 +1,67 @@
+import base64
+import json
+import os
+import threading
+import time
+
+import firebase_admin
+import requests
+from firebase_admin import credentials
+from google.auth.transport.requests import Request
+from google.oauth2 import id_token
+from requests.adapters import HTTPAdapter
+
+# Refresh ID tokens this long before they expire
+TOKEN_REFRESH_MARGIN_SECONDS = int(os.environ.get("TOKEN_REFRESH_MARGIN_SECONDS", "300"))
+# Used when a token's expiry cannot be read; Google ID tokens last an hour
+TOKEN_DEFAULT_LIFETIME_SECONDS = 3600
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "10"))
+
+# Shared by every invocation served by this instance, so job dispatches reuse
+# keep-alive connections to Cloud Run and to the metadata server
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+session.mount("http://", HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+_auth_request = Request(session=session)
+
+_tokens = {}
+_tokens_lock = threading.Lock()
+_firebase_lock = threading.Lock()
+
+
+def token_expiry(token: str) -> float:
+    """Reads the exp claim of a JWT without verifying it"""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        return time.time() + TOKEN_DEFAULT_LIFETIME_SECONDS
+
+
+def get_id_token(audience: str) -> str:
+    """Returns a cached ID token for the audience, fetching a new one shortly before expiry"""
+    with _tokens_lock:
+        cached = _tokens.get(audience)
+        if cached and cached[1] - TOKEN_REFRESH_MARGIN_SECONDS > time.time():
+            return cached[0]
+
+        token = id_token.fetch_id_token(_auth_request, audience)
+        _tokens[audience] = (token, token_expiry(token))
+        return token
+
+
+def get_firebase_app(app_name: str) -> firebase_admin.App:
+    """Initializes the named Firebase app from DOCGEN_SA once per process"""
+    with _firebase_lock:
+        app = firebase_admin._apps.get(app_name)
+        if app is not None:
+            return app
+
+        service_account_json = os.environ.get("DOCGEN_SA")
+        if not service_account_json:
+            print("❌ DOCGEN_SA not set in Firebase config!")
+            raise ValueError("❌ DOCGEN_SA not set in Firebase config!")
+
+        cred = credentials.Certificate(json.loads(service_account_json))
+        return firebase_admin.initialize_app(cred, name=app_name)
@@ -1,28 +1,32 @@
 from firebase_functions import firestore_fn, logger, params
-import firebase_admin
-from firebase_admin import initialize_app, storage, credentials
-from google.auth.transport.requests import Request
-from google.oauth2 import id_token
-import tempfile
+from firebase_admin import storage
 import os
-from docx import Document
-import re
-import requests
+import random
+import time
 from datetime import datetime, timezone
 import json
+import requests
+import cloud_run_client
+import placeholder_extractor
+
+# Read size when streaming templates from storage
+STREAM_CHUNK_SIZE = 1024 * 1024
+# Suffix of the placeholder location index saved next to each template
+INDEX_SUFFIX = ".index.json"
+# Attempts to hand a job to Cloud Run, and the time they may take in all;
+# keep the latter below the function's own timeout
+DISPATCH_ATTEMPTS = int(os.environ.get("DISPATCH_ATTEMPTS", "4"))
+DISPATCH_DEADLINE_SECONDS = float(os.environ.get("DISPATCH_DEADLINE_SECONDS", "50"))
+DISPATCH_TIMEOUT_SECONDS = 30
+DISPATCH_BACKOFF_SECONDS = 1.0
+DISPATCH_MAX_BACKOFF_SECONDS = 10.0
+# Answers worth another attempt: the service is overloaded or unreachable.
+# A 500 is the job itself failing after the service's own retries
+RETRYABLE_STATUSES = (429, 502, 503, 504)
 
 def initialize_firebase(app_name):
     try:
-        service_account_json = os.environ.get("DOCGEN_SA")
-        if not service_account_json:
-            print("❌ DOCGEN_SA not set in Firebase config!")
-            raise ValueError("❌ DOCGEN_SA not set in Firebase config!")
-        
-        service_account_info = json.loads(service_account_json)
-        cred = credentials.Certificate(service_account_info)
-        
-        return initialize_app(cred, name=app_name)
-    
+        return cloud_run_client.get_firebase_app(app_name)
     except Exception as e:
         print(f"🔥 Firebase init failed: {str(e)}")
         raise
@@ -38,7 +42,6 @@ def processtemplate(event: firestore_fn.Event[firestore_fn.DocumentSnapshot]) ->
         return
 
     template_data = snapshot.to_dict()
-    template_id = event.params["templateId"]
 
     try:
         snapshot.reference.update({"status": "processing"})
@@ -46,29 +49,37 @@ def processtemplate(event: firestore_fn.Event[firestore_fn.DocumentSnapshot]) ->
         file_path = template_data["storagePath"]
         bucket_name = template_data["downloadURL"].split('/')[5]
         bucket = storage.bucket(bucket_name)
-        
-        with tempfile.NamedTemporaryFile(suffix=".docx", delete=False) as temp_file:
-            temp_path = temp_file.name
-            blob = bucket.blob(file_path)
-            blob.download_to_filename(temp_path)
-            print(f"Downloaded template to {temp_path}")
-
-            placeholders = extract_placeholders(temp_path)
-            print(f"Found placeholders: {placeholders}")
-
-            placeholder_config = {
-                p: {
-                    "type": "long_text",
-                    "required": True,
-                    "alias": p.replace('_', ' ').title()
-                } for p in placeholders
-            }
+        blob = bucket.get_blob(file_path)
+        if blob is None:
+            raise ValueError(f"Template file {file_path} not found")
+
+        # Read the zip straight from storage; only the XML parts are fetched.
+        # Pinning the generation keeps the index consistent with the bytes read.
+        with blob.open("rb", chunk_size=STREAM_CHUNK_SIZE,
+                       if_generation_match=blob.generation) as stream:
+            extraction = placeholder_extractor.extract(stream)
+
+        placeholders = list(extraction["occurrences"])
+        print(f"Found placeholders: {extraction['occurrences']}")
+
+        placeholder_config = {
+            p: {
+                "type": "long_text",
+                "required": True,
+                "alias": p.replace('_', ' ').title()
+            } for p in placeholders
+        }
 
-            snapshot.reference.update({
-                "placeholders": placeholder_config,
-                "status": "processed"
-            })
-            print("Template processed successfully")
+        index_path = save_template_index(bucket, file_path, extraction, blob.generation)
+
+        snapshot.reference.update({
+            "placeholders": placeholder_config,
+            "placeholderOccurrences": extraction["occurrences"],
+            "indexPath": index_path,
+            "indexGeneration": str(blob.generation),
+            "status": "processed"
+        })
+        print("Template processed successfully")
 
     except Exception as error:
         print(f"Error processing template: {error}")
@@ -78,29 +89,18 @@ def processtemplate(event: firestore_fn.Event[firestore_fn.DocumentSnapshot]) ->
         })
         raise
 
-    finally:
-        # Clean up temporary file
-        if 'temp_path' in locals() and os.path.exists(temp_path):
-            os.remove(temp_path)
-
-def extract_placeholders(docx_path: str) -> list:
-    """Extracts all placeholder patterns from a DOCX file."""
-    doc = Document(docx_path)
-    placeholders = set()
-
-    # Check paragraphs
-    for paragraph in doc.paragraphs:
-        matches = re.findall(r'\{\{([^}]+)\}\}', paragraph.text)
-        placeholders.update(matches)
-
-    # Check tables
-    for table in doc.tables:
-        for row in table.rows:
-            for cell in row.cells:
-                matches = re.findall(r'\{\{([^}]+)\}\}', cell.text)
-                placeholders.update(matches)
-
-    return list(placeholders)
+def save_template_index(bucket, template_path: str, extraction: dict, generation) -> str:
+    """Saves the placeholder location index as a sidecar blob next to the template"""
+    index = placeholder_extractor.build_index(extraction, generation)
+    index_path = template_path + INDEX_SUFFIX
+    index_blob = bucket.blob(index_path)
+    index_blob.metadata = {"templateGeneration": str(generation)}
+    index_blob.upload_from_string(
+        json.dumps(index, separators=(",", ":")),
+        content_type="application/json"
+    )
+    print(f"Saved placeholder index to {index_path}")
+    return index_path
 
 # This function is triggered when a new document is created in the document_jobs collection
 # It calls the Cloud Run service to process the document
@@ -111,9 +111,7 @@ def process_document_job(event: firestore_fn.Event[firestore_fn.DocumentSnapshot
         print("Document no longer exists")
         return
     
-    app_name = 'process_document_job_app'
-    if firebase_admin._apps.get(app_name) is None:
-        initialize_firebase(app_name)
+    initialize_firebase('process_document_job_app')
 
     try:
         doc_data = snapshot.to_dict()
@@ -136,30 +134,21 @@ def process_document_job(event: firestore_fn.Event[firestore_fn.DocumentSnapshot
         
         # Ensure URL ends with / if not present
         cloud_run_url = cloud_run_url.rstrip('/') + '/'
-        
-        headers = {
-            "Authorization": f"Bearer {get_cloud_run_token(cloud_run_url)}",
-            "Content-Type": "application/json"
-        }
-        
-        response = requests.post(
-            cloud_run_url,
-            headers=headers,
-            json={
-                "jobId": job_id,
-                "formId": form_id
-            },
-            timeout=30
-        )
-
-        if response.status_code != 200:
+
+        response, attempts = dispatch_job(cloud_run_url, {"jobId": job_id, "formId": form_id})
+
+        # 202 means the service queued the job and will report progress on it
+        if response.status_code not in (200, 202):
             error_msg = f"Cloud Run request failed: {response.status_code} - {response.text}"
             print(error_msg)
             snapshot.reference.update({
                 "status": "failed",
                 "error": error_msg[:500],
-                "updatedAt": datetime.now(datetime.timezone.utc)
+                "dispatchAttempts": attempts,
+                "updatedAt": datetime.now(timezone.utc)
             })
+        elif response.status_code == 202:
+            print(f"Job {job_id} for form {form_id} accepted by Cloud Run")
         else:
             print(f"Successfully processed job {job_id} for form {form_id}")
 
@@ -170,13 +159,60 @@ def process_document_job(event: firestore_fn.Event[firestore_fn.DocumentSnapshot
             snapshot.reference.update({
                 "status": "failed",
                 "error": str(error)[:500],
-                "updatedAt": datetime.now(datetime.timezone.utc)
+                "updatedAt": datetime.now(timezone.utc)
             })
         raise
 
+def dispatch_job(cloud_run_url: str, payload: dict) -> tuple:
+    """
+    Posts a job to Cloud Run, trying again with full jitter backoff after a
+    retryable status or a failed connection, and waiting at least as long
+    as a Retry-After header asks.
+
+    A read timeout is not retried: the service may already be running the
+    job. A job posted twice while queued is accepted once by the service.
+
+    Returns:
+        Tuple of (last response, attempts made)
+    """
+    deadline = time.monotonic() + DISPATCH_DEADLINE_SECONDS
+    for attempt in range(1, DISPATCH_ATTEMPTS + 1):
+        response = None
+        try:
+            headers = {
+                "Authorization": f"Bearer {get_cloud_run_token(cloud_run_url)}",
+                "Content-Type": "application/json"
+            }
+            # Pooled keep-alive session shared by every invocation on this instance
+            response = cloud_run_client.session.post(
+                cloud_run_url,
+                headers=headers,
+                json=payload,
+                timeout=max(1.0, min(DISPATCH_TIMEOUT_SECONDS, deadline - time.monotonic()))
+            )
+            if response.status_code not in RETRYABLE_STATUSES:
+                return response, attempt
+            reason = f"status {response.status_code}"
+        except requests.exceptions.ConnectionError as error:
+            if attempt == DISPATCH_ATTEMPTS:
+                raise
+            reason = str(error)
+
+        delay = random.uniform(0, min(DISPATCH_MAX_BACKOFF_SECONDS, DISPATCH_BACKOFF_SECONDS * 2 ** (attempt - 1)))
+        retry_after = response.headers.get("Retry-After", "") if response is not None else ""
+        if retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        if attempt == DISPATCH_ATTEMPTS or time.monotonic() + delay >= deadline:
+            if response is None:
+                raise TimeoutError(f"Cloud Run unreachable after {attempt} attempts: {reason}")
+            return response, attempt
+        print(f"Dispatch of job {payload.get('jobId')} failed ({reason}), attempt {attempt} of {DISPATCH_ATTEMPTS}; retrying in {delay:.1f}s")
+        time.sleep(delay)
+
 def get_cloud_run_token(target_audience):
+    """ID token for Cloud Run, cached until shortly before it expires"""
     try:
-        return id_token.fetch_id_token(Request(), target_audience)
+        return cloud_run_client.get_id_token(target_audience)
     except Exception as e:
         print(f"Error getting ID token: {str(e)}")
         raise
@@ -0,0 +1,105 @@
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+
+W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+W_P = f"{{{W_NS}}}p"
+W_T = f"{{{W_NS}}}t"
+
+PLACEHOLDER_PATTERN = re.compile(r'\{\{([^}]+)\}\}')
+
+# Must match INDEX_VERSION in cloud-run/template_cache.py, which reads the index
+INDEX_VERSION = 1
+
+# Parts of a .docx package that can carry placeholders
+TEMPLATE_PART_PATTERN = re.compile(
+    r"^word/(document|header\d*|footer\d*|footnotes|endnotes)\.xml$"
+)
+
+
+def template_parts(package: zipfile.ZipFile) -> list:
+    """Lists the XML parts to scan, body first, in a stable order"""
+    names = [name for name in package.namelist() if TEMPLATE_PART_PATTERN.match(name)]
+    return sorted(names, key=lambda name: (name != "word/document.xml", name))
+
+
+def scan_part(stream, part_name: str, occurrences: dict, locations: dict) -> None:
+    """
+    Scans one XML part in a single streaming pass.
+
+    Paragraphs are numbered in document order (the order their start tags
+    appear), which is also how the Cloud Run fill step enumerates them.
+    Every element is detached once it has been read, so memory stays bounded
+    by the nesting depth plus the text of the current paragraph.
+    """
+    elements = []
+    paragraphs = []
+    ordinal = 0
+
+    for event, element in ET.iterparse(stream, events=("start", "end")):
+        if event == "start":
+            elements.append(element)
+            if element.tag == W_P:
+                paragraphs.append((ordinal, []))
+                ordinal += 1
+            continue
+
+        elements.pop()
+        if element.tag == W_T and paragraphs:
+            paragraphs[-1][1].append(element.text or "")
+        elif element.tag == W_P:
+            paragraph_ordinal, texts = paragraphs.pop()
+            text = "".join(texts)
+            if "{{" in text:
+                for name in PLACEHOLDER_PATTERN.findall(text):
+                    occurrences[name] = occurrences.get(name, 0) + 1
+                    locations.setdefault(name, []).append(
+                        {"part": part_name, "paragraph": paragraph_ordinal}
+                    )
+
+        if elements:
+            elements[-1].remove(element)
+        element.clear()
+
+
+def extract(fileobj) -> dict:
+    """
+    Extracts placeholders from a .docx given as a path or seekable file object.
+
+    The zip is read member by member straight from the source, and the body,
+    headers, footers, footnotes and endnotes are each parsed incrementally,
+    so split runs, text boxes and merged cells are handled in one pass.
+
+    Returns:
+        {"occurrences": {name: count},
+         "locations": {name: [{"part": ..., "paragraph": ...}, ...]}}
+    """
+    occurrences = {}
+    locations = {}
+    with zipfile.ZipFile(fileobj) as package:
+        for part_name in template_parts(package):
+            with package.open(part_name) as stream:
+                scan_part(stream, part_name, occurrences, locations)
+    return {"occurrences": occurrences, "locations": locations}
+
+
+def build_index(extraction: dict, generation) -> dict:
+    """
+    Turns extracted locations into the placeholder location index the
+    Cloud Run fill step uses to visit only the paragraphs with placeholders:
+
+        {"version": 1, "generation": "...", "parts": {"word/document.xml": {
+            "paragraphs": [0, 4], "placeholders": {"name": 2}}}}
+
+    The template's storage generation is recorded so a stale index is never
+    applied to a re-uploaded template.
+    """
+    parts = {}
+    for name, locations in extraction["locations"].items():
+        for location in locations:
+            part = parts.setdefault(location["part"], {"paragraphs": set(), "placeholders": {}})
+            part["paragraphs"].add(location["paragraph"])
+            part["placeholders"][name] = part["placeholders"].get(name, 0) + 1
+    for part in parts.values():
+        part["paragraphs"] = sorted(part["paragraphs"])
+    return {"version": INDEX_VERSION, "generation": str(generation), "parts": parts}